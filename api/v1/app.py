@@ -7,6 +7,7 @@ from flask import Flask, send_from_directory
 from flasgger import Swagger
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
+from api.v1.compression import compress_responses
 from api.v1.views.auth import login_required, role_required
 from api.v1.views.users import users_bp
 from api.v1.views.branches import branches_bp
@@ -21,8 +22,9 @@ app = Flask(__name__)
 app.url_map.strict_slashes = False
 app.config["JWT_SECRET_KEY"] = "super-secret"  # Change this in your application!
 jwt = JWTManager(app)
-CORS(app, resources={r"/*": {"origins": "*"}})
+CORS(app, resources={r"/*": {"origins": "*"}}, expose_headers=["X-Next-Cursor", "Link"])
 Swagger(app)
+compress_responses(app)
 
 # Register blueprints
 app.register_blueprint(users_bp, url_prefix='/api/v1/users')
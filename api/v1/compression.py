@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+"""
+Compresses the API's responses.
+
+JSON of UUID-heavy records shrinks about tenfold, so every response of a
+compressible content type goes out in the best encoding the client
+accepts: zstd or brotli when their packages (zstandard, brotli) are
+installed, otherwise gzip. Buffered responses smaller than
+COMPRESS_MIN_SIZE bytes are sent as they are. Streamed responses, such
+as the exports, are compressed chunk by chunk as the generator yields,
+each chunk flushed so the client can decode it at once.
+
+The app config sets the threshold and, per content type, the level of
+each encoding; types without levels are never compressed:
+
+    COMPRESS_MIN_SIZE  bytes (default 1024)
+    COMPRESS_LEVELS    {mimetype: {encoding: level}}
+
+The CPU time spent compressing is reported per response in a
+Server-Timing header (buffered responses only), and in total, with the
+bytes saved, by compression_stats(), for tuning the levels against the
+bandwidth they save.
+"""
+
+from collections import namedtuple
+import threading
+import time
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compress(data) returns what is ready, flush() what is left of the data
+# passed so far, finish() the end of the stream
+Encoder = namedtuple("Encoder", ["compress", "flush", "finish"])
+
+
+def _gzip(level):
+    """returns a gzip Encoder"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return Encoder(compressor.compress,
+                   lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+                   compressor.flush)
+
+
+def _brotli(level):
+    """returns a brotli Encoder"""
+    compressor = brotli.Compressor(quality=level)
+    return Encoder(compressor.process, compressor.flush, compressor.finish)
+
+
+def _zstd(level):
+    """returns a zstd Encoder"""
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return Encoder(compressor.compress,
+                   lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                   compressor.flush)
+
+
+# Encodings in order of preference when the client accepts several
+encoders = {}
+if zstandard is not None:
+    encoders["zstd"] = _zstd
+if brotli is not None:
+    encoders["br"] = _brotli
+encoders["gzip"] = _gzip
+
+DEFAULT_LEVELS = {"gzip": 6, "br": 5, "zstd": 3}
+# Exports are compressed while the client waits; favour speed
+STREAM_LEVELS = {"gzip": 4, "br": 4, "zstd": 3}
+
+DEFAULT_CONFIG = {
+    "COMPRESS_MIN_SIZE": 1024,
+    "COMPRESS_LEVELS": {
+        "application/json": DEFAULT_LEVELS,
+        "application/x-ndjson": STREAM_LEVELS,
+        "text/html": DEFAULT_LEVELS,
+        "text/plain": DEFAULT_LEVELS,
+    },
+}
+
+
+class CompressionStats:
+    """Thread-safe totals of the compression done per encoding"""
+
+    def __init__(self):
+        """starts with every total at zero"""
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """sets every total back to zero"""
+        with self.__lock:
+            self.__totals = {}
+
+    def record(self, encoding, size_in, size_out, cpu_seconds):
+        """adds one compressed response to the totals of its encoding"""
+        with self.__lock:
+            totals = self.__totals.setdefault(encoding, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += size_in
+            totals[2] += size_out
+            totals[3] += cpu_seconds
+
+    def snapshot(self):
+        """returns the totals of each encoding as a dict"""
+        with self.__lock:
+            return {encoding: {
+                "responses": responses,
+                "bytes_in": size_in,
+                "bytes_out": size_out,
+                "ratio": size_in / size_out if size_out else 0.0,
+                "cpu_seconds": cpu_seconds,
+                "cpu_seconds_per_mb": cpu_seconds / (size_in / 1e6)
+                if size_in else 0.0,
+            } for encoding, (responses, size_in, size_out, cpu_seconds)
+                in self.__totals.items()}
+
+
+stats = CompressionStats()
+
+
+def compression_stats():
+    """returns the compression totals of this process per encoding"""
+    return stats.snapshot()
+
+
+def compress_stream(chunks, encoding, level):
+    """yields the compressed chunks of a streamed body"""
+    encoder = encoders[encoding](level)
+    size_in = size_out = 0
+    cpu_seconds = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            start = time.thread_time()
+            out = encoder.compress(chunk) + encoder.flush()
+            cpu_seconds += time.thread_time() - start
+            size_in += len(chunk)
+            size_out += len(out)
+            if out:
+                yield out
+        start = time.thread_time()
+        out = encoder.finish()
+        cpu_seconds += time.thread_time() - start
+        size_out += len(out)
+        yield out
+    finally:
+        stats.record(encoding, size_in, size_out, cpu_seconds)
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response):
+    """compresses a response in the best encoding the client accepts"""
+    if request.method == "HEAD" or response.status_code < 200 or \
+            response.status_code in (204, 304) or \
+            response.direct_passthrough or \
+            "Content-Encoding" in response.headers:
+        return response
+    levels = current_app.config["COMPRESS_LEVELS"].get(response.mimetype)
+    if not levels:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(
+        [name for name in encoders if name in levels])
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding,
+                                            levels[encoding])
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        start = time.thread_time()
+        encoder = encoders[encoding](levels[encoding])
+        body = encoder.compress(data) + encoder.finish()
+        cpu_seconds = time.thread_time() - start
+        stats.record(encoding, len(data), len(body), cpu_seconds)
+        response.set_data(body)
+        response.headers["Server-Timing"] = 'compress;dur={:.3f};desc="{}"'.format(
+            cpu_seconds * 1000, encoding)
+    response.headers["Content-Encoding"] = encoding
+    # The bytes differ per encoding, so a strong validator no longer holds
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def compress_responses(app):
+    """compresses every response of app"""
+    for name, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(name, value)
+    app.after_request(compress_response)
+    return app
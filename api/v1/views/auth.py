@@ -1,14 +1,108 @@
 #!/usr/bin/python3
 """
 Contains authentication decorators and utilities.
+
+role_required authorizes from the signed `role` claim that login_user puts
+in every access token, as long as the token was issued after its user
+was last changed (users.updated_at); otherwise the user's current role
+applies, and a deleted user has none. The users' rows are read through a
+small per-process cache of principals, so every worker sees a change
+within PRINCIPAL_CACHE_TTL seconds, and the one that made it at once.
+Routes that must see the current role on every request ask for
+fresh=True and always read the user's row.
 """
 
+from collections import OrderedDict, namedtuple
+import calendar
 from functools import wraps
-from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+import threading
+import time
+from flask_jwt_extended import get_jwt, get_jwt_identity, verify_jwt_in_request
 from models import storage
 from models.tables import User, UserRole
+from models.transitions import naive_utc
 from flask import jsonify
 
+# Principals kept in the cache, and for how many seconds each is trusted
+PRINCIPAL_CACHE_SIZE = 1024
+PRINCIPAL_CACHE_TTL = 60
+
+# What role_required needs to know about a user; changed_at is when the
+# user was last changed, in seconds since the epoch
+Principal = namedtuple("Principal", ["id", "role", "branch_id", "changed_at"])
+
+
+def load_principal(user_id):
+    """returns the Principal of a user from the database, None if missing"""
+    user = storage.get(User, user_id)
+    if user is None:
+        return None
+    changed = naive_utc(user.updated_at or user.created_at)
+    changed_at = calendar.timegm(changed.timetuple()) + \
+        changed.microsecond / 1e6 if changed else 0.0
+    return Principal(user.id, user.role.value, user.branch_id, changed_at)
+
+
+def trusts(principal, issued_at):
+    """tells whether a token issued at issued_at still vouches for a user"""
+    return principal is not None and issued_at is not None and \
+        issued_at > principal.changed_at
+
+
+class PrincipalCache:
+    """
+    A thread-safe, size-bounded LRU cache of principals, each kept for at
+    most ttl seconds
+    """
+
+    def __init__(self, size=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL,
+                 load=load_principal):
+        """starts empty"""
+        self.size = size
+        self.ttl = ttl
+        self.load = load
+        self.__lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """forgets every principal"""
+        with self.__lock:
+            self.__principals = OrderedDict()
+            self.__generation = 0
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, user_id):
+        """returns the Principal of a user, loading it on a miss"""
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__principals.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.__principals.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.__generation
+        principal = self.load(user_id)
+        with self.__lock:
+            # Not cached if the user changed while it was being loaded
+            if principal is not None and generation == self.__generation:
+                self.__principals[user_id] = (now + self.ttl, principal)
+                self.__principals.move_to_end(user_id)
+                while len(self.__principals) > self.size:
+                    self.__principals.popitem(last=False)
+        return principal
+
+    def invalidate(self, user_id):
+        """drops a user's principal, so this process rereads it at once"""
+        with self.__lock:
+            self.__generation += 1
+            self.__principals.pop(user_id, None)
+
+
+principals = PrincipalCache()
+
+
 def login_required(fn):
     """Decorator to protect routes that require authentication."""
     @wraps(fn)
@@ -20,17 +114,22 @@ def login_required(fn):
             return jsonify({"error": "Authentication required", "details": str(e)}), 401
     return wrapper
 
-def role_required(role):
-    """Decorator to protect routes that require a specific role."""
+def role_required(role, fresh=False):
+    """
+    Decorator to protect routes that require a specific role, read from
+    the token's claims unless fresh is set or the user changed since.
+    """
     def decorator(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
             user_id = get_jwt_identity()
-            user = storage.get(User, user_id)
-            if not user or user.role.value.upper() != role.upper():
+            claims = get_jwt()
+            principal = principals.load(user_id) if fresh else principals.get(user_id)
+            user_role = claims.get("role")
+            if fresh or user_role is None or not trusts(principal, claims.get("iat")):
+                user_role = principal.role if principal else None
+            if not user_role or user_role.upper() != role.upper():
                 return jsonify({"error": f"{role} access required"}), 403
             return fn(*args, **kwargs)
         return wrapper
     return decorator
-
-
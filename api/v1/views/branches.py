@@ -6,11 +6,35 @@ Contains the API endpoints for managing branches.
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required
 from api.v1.views.auth import login_required, role_required
+from api.v1.views.bulk import bulk_import
 from models.tables import Branch
 from models import storage
+from models.reference import reference
+from models.versions import mark_written
+from api.v1.views.pagination import paginate
+from api.v1.views.conditional import conditional
+from datetime import datetime
+import uuid
 
 branches_bp = Blueprint('branches_bp', __name__)
 
+def validate_branch(data):
+    """Checks a branch payload, returning (fields, error)."""
+    if not data or not data.get('name'):
+        return None, "Missing branch name"
+    return {"name": data['name'], "is_hq": bool(data.get('is_hq', False))}, None
+
+def insert_branches(chunk):
+    """Bulk inserts a chunk of validated branches with one multi-row INSERT."""
+    now = datetime.utcnow()
+    connection = storage.connection()
+    connection.execute(Branch.__table__.insert(), [
+        dict(fields, id=str(uuid.uuid4()), created_at=now, updated_at=now)
+        for _, fields in chunk
+    ])
+    mark_written(storage.session_info(), [Branch])
+    return []
+
 @branches_bp.route('', methods=['POST'])
 def create_branch():
     """
@@ -39,35 +63,69 @@ def create_branch():
       500:
         description: Internal server error.
     """
-    data = request.get_json()
-    if not data or not data.get('name'):
-        return jsonify({"error": "Missing branch name"}), 400
+    fields, error = validate_branch(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
 
-    new_branch = Branch(
-        name=data['name'],
-        is_hq=data.get('is_hq', False)
-    )
+    new_branch = Branch(**fields)
     storage.new(new_branch)
     storage.save()
     return jsonify(new_branch.to_dict()), 201
 
+@branches_bp.route('/bulk', methods=['POST'])
+def bulk_create_branches():
+    """
+    Imports many branches in one request.
+
+    ---
+    consumes:
+      - application/x-ndjson
+      - application/json
+    parameters:
+      - name: body
+        in: body
+        required: true
+        description: NDJSON (one branch per line) or a JSON array of branches, with the fields of POST /branches.
+        schema:
+          type: array
+          items:
+            type: object
+
+    responses:
+      200:
+        description: Import summary with the inserted and failed row counts, and an error for each failed row.
+    """
+    return jsonify(bulk_import(validate_branch, insert_branches))
+
 @branches_bp.route('', methods=['GET'])
+@conditional(Branch, cache_control='max-age=60')
 def get_branches():
     """
-    Retrieves all branches.
+    Retrieves branches, one page at a time.
 
     ---
-
+    parameters:
+        - name: limit
+          in: query
+          type: integer
+          required: false
+          default: 100
+          description: Page size, at most 1000.
+        - name: cursor
+          in: query
+          type: string
+          required: false
+          description: The X-Next-Cursor header of the previous page.
     responses:
         200:
-            description: A list of all branches.
+            description: A page of branches, with an X-Next-Cursor header when more follow.
         500:
             description: Internal server error.
     """
-    branches = storage.all(Branch).values()
-    return jsonify([branch.to_dict() for branch in branches])
+    return paginate(Branch, cache=reference)
 
 @branches_bp.route('/<branch_id>', methods=['GET'])
+@conditional(Branch, cache_control='max-age=60')
 def get_branch(branch_id):
     """
     Retrieves a specific branch.
@@ -83,7 +141,7 @@ def get_branch(branch_id):
       404:
         description: Branch not found.
     """
-    branch = storage.get(Branch, id=branch_id)
+    branch = reference.get(Branch, branch_id)
     if not branch:
         return jsonify({"error": "Branch not found"}), 404
-    return jsonify(branch.to_dict())
+    return jsonify(branch)
@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+"""
+Contains the helpers shared by the bulk import endpoints.
+
+Bodies are either NDJSON (one JSON object per line) or a single JSON array
+of objects. Both are parsed incrementally from the request stream, so a
+large import never has to be held in memory at once.
+"""
+
+import codecs
+import json
+import logging
+from flask import request
+from sqlalchemy.exc import IntegrityError
+from models import storage
+
+logger = logging.getLogger(__name__)
+
+# Rows validated, inserted and committed together
+BULK_CHUNK_SIZE = 1000
+# Characters read from the request body at a time
+READ_SIZE = 65536
+# Longest single JSON array element accepted, in characters
+MAX_RECORD_CHARS = 1048576
+# Per-row errors echoed back; the failed count still covers every row
+MAX_REPORTED_ERRORS = 1000
+# What a client is told about a row the database refused; the details,
+# which quote SQL and parameters, only go to the log
+INTEGRITY_ERROR = "Duplicate or invalid reference"
+STORAGE_ERROR = "Row could not be stored"
+
+_decoder = json.JSONDecoder()
+
+
+def _iter_lines(reader, buffer):
+    """yields (row, record, error) for each non-blank NDJSON line"""
+    row = 0
+    while True:
+        chunk = reader.read(READ_SIZE)
+        buffer += chunk
+        lines = buffer.split("\n")
+        buffer = lines.pop() if chunk else ""
+        for line in lines:
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                yield row, json.loads(line), None
+            except ValueError as e:
+                yield row, None, f"Invalid JSON: {e}"
+        if not chunk:
+            return
+
+
+def _iter_array(reader, buffer):
+    """yields (row, record, error) for each element of a JSON array"""
+    row = 0
+    pos = buffer.index("[") + 1
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            if pos == len(buffer):
+                raise ValueError("need more input")
+            record, end = _decoder.raw_decode(buffer, pos)
+            # A value ending right at the buffer edge may be cut short
+            if end == len(buffer) and not eof:
+                raise ValueError("need more input")
+        except ValueError as e:
+            if eof:
+                if pos < len(buffer):
+                    yield row + 1, None, f"Invalid JSON: {e}"
+                else:
+                    yield row + 1, None, "Unterminated JSON array"
+                return
+            if len(buffer) - pos > MAX_RECORD_CHARS:
+                yield row + 1, None, f"Invalid JSON: {e}"
+                return
+            chunk = reader.read(READ_SIZE)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        row += 1
+        yield row, record, None
+        pos = end
+
+
+def iter_records(stream):
+    """
+    Parses a request body stream as a JSON array or as NDJSON, yielding
+    (row, record, error) tuples with 1-based row numbers
+    """
+    reader = codecs.getreader("utf-8")(stream, errors="replace")
+    buffer = ""
+    while not buffer.strip():
+        chunk = reader.read(READ_SIZE)
+        if not chunk:
+            return iter(())
+        buffer += chunk
+    if buffer.lstrip().startswith("["):
+        return _iter_array(reader, buffer)
+    return _iter_lines(reader, buffer)
+
+
+def bulk_import(validate, insert, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Streams the current request's records through validate(record), which
+    returns (fields, error), and hands each chunk of valid
+    (row, fields) pairs to insert(chunk). insert returns the (row, error)
+    pairs it rejected and inserts the rest; each chunk commits on its own.
+    A chunk the database refuses is retried row by row, so a row the
+    validation let through but the database does not accept fails alone.
+    Returns the JSON summary of the import.
+    """
+    inserted = failed = 0
+    errors = []
+
+    def reject(row, error):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"row": row, "error": error})
+
+    def flush(chunk):
+        nonlocal inserted
+        try:
+            with storage.unit_of_work():
+                rejected = insert(chunk)
+        except Exception as e:
+            if len(chunk) == 1:
+                logger.exception("bulk import row %s refused", chunk[0][0])
+                reject(chunk[0][0], INTEGRITY_ERROR if isinstance(e, IntegrityError)
+                       else STORAGE_ERROR)
+                return
+            # One bad row fails the whole statement; find it by inserting
+            # the rows one at a time, so only it is rejected
+            for pair in chunk:
+                flush([pair])
+            return
+        finally:
+            storage.close()
+        for row, error in rejected:
+            reject(row, error)
+        inserted += len(chunk) - len(rejected)
+
+    chunk = []
+    for row, record, error in iter_records(request.stream):
+        if error is None:
+            if not isinstance(record, dict):
+                error = "Row must be a JSON object"
+            else:
+                fields, error = validate(record)
+        if error is not None:
+            reject(row, error)
+            continue
+        chunk.append((row, fields))
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+
+    return {"inserted": inserted, "failed": failed, "errors": errors}
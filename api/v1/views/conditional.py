@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""
+Contains the conditional GET support of the polled endpoints.
+
+An endpoint decorated with conditional(Branch, ...) reads the versions
+of the tables it reads (models.versions) before doing any other work:
+the ETag names the versions and the requested URL, and Last-Modified is
+the time of the latest change. When the client's If-None-Match shows it
+already holds the current version, the response is an empty 304 Not
+Modified and no row is loaded or serialized. Since any insert or delete
+changes a version, that ETag came from a 200 for this very URL, whose
+resource still exists as it was; an ETag taken from another URL never
+matches. Otherwise the endpoint runs, and its 200 response is given the
+validators and the endpoint's Cache-Control, or turned into a 304 when
+the client's If-Modified-Since (without If-None-Match) is not older than
+Last-Modified: dates name no URL, so they are only trusted once the
+endpoint found the resource.
+
+The versions are read before the endpoint loads its rows, so a response
+may be newer than its ETag, never older: a change that commits meanwhile
+only costs the client one more full download. A write to a counted table
+is only seen once its counter is bumped, a few milliseconds after it
+commits. Bodies served from the reference cache (models.reference) are
+stamped with the same versions, so they are never older than the ETag
+either.
+"""
+
+from functools import wraps
+from hashlib import blake2b
+from flask import Response, make_response, request
+from models import storage
+from models.reference import reference
+from models.versions import table_versions
+
+# Cache-Control of the polled endpoints: clients keep the response, but
+# revalidate it on every poll
+REVALIDATE = "no-cache"
+
+
+def validators(classes, resource=""):
+    """
+    returns the (ETag, Last-Modified) of resource in the current state of
+    the tables of classes
+    """
+    versions = table_versions(storage, classes)
+    for cls, (version, _) in zip(classes, versions):
+        reference.observe(cls, version)
+    key = ";".join(["{}={}".format(cls.__tablename__, version)
+                    for cls, (version, _) in zip(classes, versions)] +
+                   [resource])
+    etag = blake2b(key.encode(), digest_size=12).hexdigest()
+    changed = [changed_at for _, changed_at in versions if changed_at is not None]
+    return etag, max(changed) if changed else None
+
+
+def etag_matches(etag):
+    """tells whether the request's If-None-Match names etag"""
+    return bool(request.if_none_match) and \
+        request.if_none_match.contains_weak(etag)
+
+
+def unmodified_since(last_modified):
+    """
+    tells whether the request's If-Modified-Since, when it has no
+    If-None-Match, is not older than last_modified
+    """
+    since = request.if_modified_since
+    return not request.if_none_match and since is not None and \
+        last_modified is not None and \
+        last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+
+
+def conditional(*classes, cache_control=REVALIDATE):
+    """
+    Decorator answering GET requests with 304 Not Modified when none of
+    the tables of classes changed since the client's copy, and setting
+    the ETag, Last-Modified and Cache-Control of full responses.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = validators(classes, request.full_path)
+            if etag_matches(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(fn(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if unmodified_since(last_modified):
+                    response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return wrapper
+    return decorator
@@ -3,17 +3,84 @@
 Contains the API endpoints for managing consignments.
 """
 
+from sqlalchemy.orm.exc import StaleDataError
 from flask import Blueprint, request, jsonify
-from models.tables import Consignment, Invoice, Branch, Truck, Dispatch, ConsignmentStatus, TruckStatus
+from api.v1.views.bulk import bulk_import
+from models.tables import Branch, Consignment, Invoice, ConsignmentStatus, DestinationStat
 from models import storage
+from api.v1.views.pagination import paginate
+from api.v1.views.routing import replica_reads
+from models.lanes import add_delta, apply_lane_deltas, enqueue_lane_events
+from models.stats import add_stat, apply_stat_deltas
+from models.transitions import naive_utc
 from sqlalchemy import func
-from datetime import datetime, timedelta
+from datetime import date, datetime
+import uuid
 
 consignments_bp = Blueprint('consignments_bp', __name__)
 
 def calculate_charge(volume, destination):
     return volume * 100
 
+def validate_consignment(data):
+    """Checks a consignment payload, returning (fields, error)."""
+    if not data:
+        return None, "No input data provided"
+
+    required_fields = ['volume_cubic_meters', 'destination_address', 'sender_address', 'receiver_name', 'origin_branch_id']
+    for field in required_fields:
+        if field not in data:
+            return None, f"Missing required field: {field}"
+
+    try:
+        volume_cubic_meters = data['volume_cubic_meters']
+        if volume_cubic_meters is None:
+            return None, "volume_cubic_meters cannot be null."
+        volume_cubic_meters = float(volume_cubic_meters)
+    except (TypeError, ValueError):
+        return None, "Invalid volume_cubic_meters. Must be a number."
+
+    fields = {field: data[field] for field in required_fields}
+    fields['volume_cubic_meters'] = volume_cubic_meters
+    return fields, None
+
+def insert_consignments(chunk):
+    """
+    Bulk inserts a chunk of validated consignments and their invoices with
+    one multi-row INSERT per table, then updates and queues each affected
+    lane and updates each affected stats row once. Returns the (row, error)
+    pairs that were rejected.
+    """
+    branches = storage.get_many(Branch, {fields['origin_branch_id'] for _, fields in chunk})
+    now = datetime.utcnow()
+    rejected, consignments, invoices, deltas, stats = [], [], [], {}, {}
+    for row, fields in chunk:
+        if fields['origin_branch_id'] not in branches:
+            rejected.append((row, "Branch not found"))
+            continue
+        consignment_id = str(uuid.uuid4())
+        consignments.append(dict(fields, id=consignment_id, status=ConsignmentStatus.AWAITING_DISPATCH,
+                                 version_id=1, created_at=now, updated_at=now))
+        amount = calculate_charge(fields['volume_cubic_meters'], fields['destination_address'])
+        invoices.append(dict(id=str(uuid.uuid4()), consignment_id=consignment_id,
+                             amount=amount, created_at=now, updated_at=now))
+        add_delta(deltas, fields['origin_branch_id'], fields['destination_address'],
+                  fields['volume_cubic_meters'], 1)
+        add_stat(stats, (fields['destination_address'], fields['origin_branch_id'], now.date()),
+                 1, fields['volume_cubic_meters'], amount)
+
+    if consignments:
+        # Core executemany inserts skip the ORM flush hooks, so the lane
+        # backlog, dispatch queue and destination stats are maintained here
+        # for the chunk.
+        connection = storage.connection()
+        connection.execute(Consignment.__table__.insert(), consignments)
+        connection.execute(Invoice.__table__.insert(), invoices)
+        apply_lane_deltas(connection, deltas)
+        enqueue_lane_events(connection, deltas)
+        apply_stat_deltas(connection, stats)
+    return rejected
+
 @consignments_bp.route('', methods=['POST'])
 def create_consignment():
     """
@@ -43,59 +110,71 @@ def create_consignment():
       400:
         description: Missing required consignment data.
     """
-    data = request.get_json()
-    if not data:
-        return jsonify({"error": "No input data provided"}), 400
+    fields, error = validate_consignment(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
 
-    required_fields = ['volume_cubic_meters', 'destination_address', 'sender_address', 'receiver_name', 'origin_branch_id']
-    for field in required_fields:
-        if field not in data:
-            return jsonify({"error": f"Missing required field: {field}"}), 400
-
-    try:
-        volume_cubic_meters = data['volume_cubic_meters']
-        if volume_cubic_meters is None:
-            return jsonify({"error": "volume_cubic_meters cannot be null."}), 400
-        volume_cubic_meters = float(volume_cubic_meters)
-    except ValueError:
-        return jsonify({"error": "Invalid volume_cubic_meters. Must be a number."}), 400
-
-    # Create the consignment
-    new_consignment = Consignment(
-        volume_cubic_meters=volume_cubic_meters,
-        destination_address=data['destination_address'],
-        sender_address=data['sender_address'],
-        receiver_name=data['receiver_name'],
-        origin_branch_id=data['origin_branch_id']
-    )
-    storage.new(new_consignment)
-    storage.save()
+    # Record the consignment and its invoice in a single transaction
+    with storage.unit_of_work():
+        new_consignment = Consignment(**fields)
+        storage.new(new_consignment)
 
-    # Create the invoice
-    charge = calculate_charge(new_consignment.volume_cubic_meters, new_consignment.destination_address)
-    new_invoice = Invoice(
-        consignment_id=new_consignment.id,
-        amount=charge
-    )
-    storage.new(new_invoice)
-    storage.save()
-
-    # Check if the total volume for the destination is enough to dispatch a truck
-    check_and_dispatch_truck(new_consignment.origin_branch_id, new_consignment.destination_address)
+        charge = calculate_charge(new_consignment.volume_cubic_meters, new_consignment.destination_address)
+        new_invoice = Invoice(
+            consignment_id=new_consignment.id,
+            amount=charge
+        )
+        storage.new(new_invoice)
 
+    # Saving the consignment queued a lane event; the dispatch worker decides
+    # whether the lane now has enough volume to send out a truck.
     return jsonify(new_consignment.to_dict()), 201
 
+@consignments_bp.route('/bulk', methods=['POST'])
+def bulk_create_consignments():
+    """
+    Imports many consignments, each with its invoice, in one request.
+    ---
+    consumes:
+      - application/x-ndjson
+      - application/json
+    parameters:
+      - name: body
+        in: body
+        required: true
+        description: NDJSON (one consignment per line) or a JSON array of consignments, with the fields of POST /consignments.
+        schema:
+          type: array
+          items:
+            type: object
+    responses:
+      200:
+        description: Import summary with the inserted and failed row counts, and an error for each failed row.
+    """
+    return jsonify(bulk_import(validate_consignment, insert_consignments))
+
 @consignments_bp.route('', methods=['GET'])
 def get_consignments():
     """
-    Retrieves all consignments.
+    Retrieves consignments, one page at a time.
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        default: 100
+        description: Page size, at most 1000.
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: The X-Next-Cursor header of the previous page.
     responses:
       200:
-        description: A list of all consignments.
+        description: A page of consignments, with an X-Next-Cursor header when more follow.
     """
-    consignments = storage.all(Consignment).values()
-    return jsonify([consignment.to_dict() for consignment in consignments])
+    return paginate(Consignment)
 
 @consignments_bp.route('/<consignment_id>', methods=['GET'])
 def get_consignment(consignment_id):
@@ -144,6 +223,8 @@ def update_consignment(consignment_id):
         description: Consignment not found.
       400:
         description: No data provided or invalid status.
+      409:
+        description: The consignment was changed concurrently, e.g. dispatched; retry.
     """
     consignment = storage.get(Consignment, id=consignment_id)
     if not consignment:
@@ -159,7 +240,11 @@ def update_consignment(consignment_id):
         except ValueError:
             return jsonify({"error": "Invalid status"}), 400
     
-    storage.save()
+    try:
+        storage.save()
+    except StaleDataError:
+        storage.rollback()
+        return jsonify({"error": "Consignment was changed concurrently, retry"}), 409
     return jsonify(consignment.to_dict())
 
 @consignments_bp.route('/status/<consignment_id>', methods=['GET'])
@@ -184,6 +269,7 @@ def get_consignment_status(consignment_id):
     return jsonify({"status": consignment.status.value})
 
 @consignments_bp.route('/stats', methods=['GET'])
+@replica_reads
 def get_consignment_stats():
     """
     Retrieves consignment statistics.
@@ -194,110 +280,113 @@ def get_consignment_stats():
         type: string
         required: true
         description: The destination to filter by.
+      - name: origin_branch_id
+        in: query
+        type: string
+        required: false
+        description: Only count consignments sent from this branch.
+      - name: since
+        in: query
+        type: string
+        format: date
+        required: false
+        description: First day (YYYY-MM-DD, UTC) of consignments to count.
+      - name: until
+        in: query
+        type: string
+        format: date
+        required: false
+        description: Last day (YYYY-MM-DD, UTC) of consignments to count.
     responses:
       200:
         description: Consignment statistics for the given destination.
       400:
-        description: Missing destination.
+        description: Missing destination or invalid date.
     """
     destination = request.args.get('destination')
     if not destination:
         return jsonify({"error": "Missing destination"}), 400
 
-    all_consignments = storage.all(Consignment).values()
-    consignments = [c for c in all_consignments if c.destination_address == destination]
-    total_volume = sum(c.volume_cubic_meters for c in consignments)
-    total_revenue = sum(c.invoice.amount for c in consignments if c.invoice)
+    # The totals are kept per destination, branch and day by models.stats
+    criteria = {"destination_address": destination}
+    if request.args.get('origin_branch_id'):
+        criteria['origin_branch_id'] = request.args['origin_branch_id']
+    try:
+        if request.args.get('since'):
+            criteria['day__gte'] = date.fromisoformat(request.args['since'])
+        if request.args.get('until'):
+            criteria['day__lte'] = date.fromisoformat(request.args['until'])
+    except ValueError:
+        return jsonify({"error": "Invalid date. Use YYYY-MM-DD."}), 400
+
+    total_consignments, total_volume, total_revenue = storage.aggregate(
+        DestinationStat, 'sum', ['consignment_count', 'total_volume', 'total_revenue'], **criteria)
 
     return jsonify({
         "destination": destination,
-        "total_consignments": len(consignments),
-        "total_volume": total_volume,
-        "total_revenue": total_revenue
+        "total_consignments": total_consignments or 0,
+        "total_volume": total_volume or 0,
+        "total_revenue": total_revenue or 0
     })
 
 @consignments_bp.route('/average_wait_time', methods=['GET'])
+@replica_reads
 def get_average_wait_time():
     """
-    Calculates the average waiting time for consignments.
+    Calculates the waiting time between creation and dispatch for consignments.
     ---
+    parameters:
+      - name: origin_branch_id
+        in: query
+        type: string
+        required: false
+        description: Only include consignments sent from this branch.
+      - name: destination
+        in: query
+        type: string
+        required: false
+        description: Only include consignments to this destination.
+      - name: since
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: Only include consignments dispatched at or after this UTC time (ISO 8601).
+      - name: until
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: Only include consignments dispatched before this UTC time (ISO 8601).
     responses:
       200:
-        description: The average waiting time for consignments in seconds.
+        description: The average, p50, p95 and p99 waiting time for dispatched consignments in seconds.
+      400:
+        description: Invalid time.
     """
-    consignments = storage.all(Consignment).values()
-    total_wait_time = timedelta()
-    dispatched_consignments = 0
-
-    for consignment in consignments:
-        if consignment.status != ConsignmentStatus.AWAITING_DISPATCH:
-            dispatch_time = consignment.dispatch.created_at
-            wait_time = dispatch_time - consignment.created_at
-            total_wait_time += wait_time
-            dispatched_consignments += 1
-    
-    average_wait_time = total_wait_time / dispatched_consignments if dispatched_consignments > 0 else timedelta(0)
-
-    return jsonify({"average_wait_time_seconds": average_wait_time.total_seconds()})
-
-def check_and_dispatch_truck(branch_id, destination_address):
-    print(f"DEBUG: check_and_dispatch_truck called for branch_id={branch_id}, destination_address={destination_address}")
-    branch = storage.get(Branch, id=branch_id)
-    if not branch:
-        print(f"DEBUG: Branch {branch_id} not found.")
-        return
-
-    # Get all consignments
-    all_consignments = storage.all(Consignment).values()
-
-    # Filter in Python
-    consignments_for_destination = [
-        c for c in all_consignments
-        if c.origin_branch_id == branch_id and
-            c.destination_address == destination_address and
-            c.status == ConsignmentStatus.AWAITING_DISPATCH
-    ]
-    print(f"DEBUG: Found {len(consignments_for_destination)} consignments for dispatch criteria.")
-
-    # Now compute the volume
-    total_volume = sum(c.volume_cubic_meters for c in consignments_for_destination)
-    print(f"DEBUG: Total volume for {destination_address} at {branch_id}: {total_volume} cubic meters.")
-
-    if total_volume >= 500:
-        print(f"DEBUG: Volume threshold (500m³) met. Total volume: {total_volume}.")
-        all_trucks = storage.all(Truck).values()
-        # Find an available truck at the branch
-        available_truck = [
-            truck for truck in all_trucks
-            if truck.current_branch_id == branch_id and
-            truck.status == TruckStatus.AVAILABLE
-        ]
-        if available_truck:
-            available_truck = available_truck[0]
-            print(f"DEBUG: Found available truck: {available_truck.truck_number} (ID: {available_truck.id}).")
-        else:
-            print("DEBUG: No available truck found at this branch.")
-            # If no available truck, we cannot dispatch
-            return
+    criteria = {"dispatched_at__ne": None}
+    if request.args.get('origin_branch_id'):
+        criteria['origin_branch_id'] = request.args['origin_branch_id']
+    if request.args.get('destination'):
+        criteria['destination_address'] = request.args['destination']
+    try:
+        if request.args.get('since'):
+            criteria['dispatched_at__gte'] = naive_utc(datetime.fromisoformat(request.args['since']))
+        if request.args.get('until'):
+            criteria['dispatched_at__lt'] = naive_utc(datetime.fromisoformat(request.args['until']))
+    except ValueError:
+        return jsonify({"error": "Invalid time. Use ISO 8601."}), 400
 
-        if available_truck:
-            # Create a new dispatch
-            new_dispatch = Dispatch(
-                truck_id=available_truck.id,
-                destination_address=destination_address
-            )
-            storage.new(new_dispatch)
-            storage.save()
-            print(f"DEBUG: New dispatch created with ID: {new_dispatch.id}.")
+    # wait_seconds is stamped when a consignment is dispatched, so the
+    # metrics are computed by the database over the matching rows
+    dispatched_consignments = storage.count(Consignment, **criteria)
+    average_wait_time = storage.aggregate(Consignment, 'avg', 'wait_seconds', **criteria)
+    p50, p95, p99 = storage.percentiles(Consignment, 'wait_seconds', (0.5, 0.95, 0.99), **criteria)
 
-            # Update consignments and truck
-            for consignment in consignments_for_destination:
-                consignment.dispatch_id = new_dispatch.id
-                consignment.status = ConsignmentStatus.DISPATCHED
-                print(f"DEBUG: Consignment {consignment.id} status updated to DISPATCHED.")
-            available_truck.status = TruckStatus.IN_TRANSIT
-            print(f"DEBUG: Truck {available_truck.truck_number} status updated to IN_TRANSIT.")
-            storage.save()
-            print("DEBUG: All changes saved.")
-    else:
-        print(f"DEBUG: Volume threshold (500m³) not met. Current volume: {total_volume}.")
\ No newline at end of file
+    return jsonify({
+        "dispatched_consignments": dispatched_consignments,
+        "average_wait_time_seconds": average_wait_time or 0.0,
+        "p50_wait_time_seconds": p50,
+        "p95_wait_time_seconds": p95,
+        "p99_wait_time_seconds": p99
+    })
@@ -6,23 +6,39 @@ Contains the API endpoints for managing dispatches.
 from flask import Blueprint, jsonify
 from models.tables import Dispatch
 from models import storage
+from api.v1.views.pagination import paginate
+from api.v1.views.conditional import conditional
+from api.v1.views.routing import route_reads_to_replica
 
-dispatches_bp = Blueprint('dispatches_bp', __name__)
+dispatches_bp = route_reads_to_replica(Blueprint('dispatches_bp', __name__))
 
 @dispatches_bp.route('', methods=['GET'])
+@conditional(Dispatch)
 def get_dispatches():
     """
-    Retrieves all dispatches.
+    Retrieves dispatches, one page at a time.
 
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        default: 100
+        description: Page size, at most 1000.
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: The X-Next-Cursor header of the previous page.
     responses:
       200:
-        description: A list of all dispatches.
+        description: A page of dispatches, with an X-Next-Cursor header when more follow.
     """
-    dispatches = storage.all(Dispatch).values()
-    return jsonify([dispatch.to_dict() for dispatch in dispatches])
+    return paginate(Dispatch)
 
 @dispatches_bp.route('/<dispatch_id>', methods=['GET'])
+@conditional(Dispatch)
 def get_dispatch(dispatch_id):
     """
     Retrieves a specific dispatch.
@@ -6,21 +6,34 @@ Contains the API endpoints for managing invoices.
 from flask import Blueprint, jsonify
 from models.tables import Invoice
 from models import storage
+from api.v1.views.pagination import paginate
+from api.v1.views.routing import route_reads_to_replica
 
-invoices_bp = Blueprint('invoices_bp', __name__)
+invoices_bp = route_reads_to_replica(Blueprint('invoices_bp', __name__))
 
 @invoices_bp.route('', methods=['GET'])
 def get_invoices():
     """
-    Retrieves all invoices.
+    Retrieves invoices, one page at a time.
 
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        default: 100
+        description: Page size, at most 1000.
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: The X-Next-Cursor header of the previous page.
     responses:
       200:
-        description: A list of all invoices.
+        description: A page of invoices, with an X-Next-Cursor header when more follow.
     """
-    invoices = storage.all(Invoice).values()
-    return jsonify([invoice.to_dict() for invoice in invoices])
+    return paginate(Invoice)
 
 @invoices_bp.route('/<invoice_id>', methods=['GET'])
 def get_invoice(invoice_id):
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+"""
+Contains the cursor pagination shared by the list endpoints.
+
+Lists are returned in (created_at, id) order, at most `limit` items at a
+time. When more items follow, the response carries an opaque cursor in the
+X-Next-Cursor header (and a Link rel="next" header); passing it back as the
+`cursor` query parameter returns the next page.
+
+With `export=ndjson` or `export=json` the whole list is streamed instead,
+read from the database in batches and written out as it is serialized.
+
+Both modes read plain result rows rather than ORM instances and encode
+them with the model's precompiled serializer (models.serializer).
+"""
+
+import base64
+import json
+from datetime import datetime
+from urllib.parse import urlencode
+from flask import Response, jsonify, request, stream_with_context
+from models import storage
+from models.base_model import time
+from models.serializer import dumps, serializer_for
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+# Rows fetched from the database per round trip while exporting
+EXPORT_BATCH_SIZE = 1000
+
+export_types = {"ndjson": "application/x-ndjson", "json": "application/json"}
+
+
+def encode_cursor(obj):
+    """returns the opaque cursor pointing just after obj"""
+    key = json.dumps([obj.created_at.strftime(time), obj.id])
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """returns the (created_at, id) key encoded in cursor"""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    created_at, id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    return datetime.strptime(created_at, time), id
+
+
+def page_args():
+    """
+    Reads the limit and cursor query parameters, returning
+    (limit, after, error)
+    """
+    limit = request.args.get('limit', DEFAULT_PAGE_LIMIT, type=int)
+    if limit is None or limit < 1:
+        return None, None, "limit must be a positive integer"
+    limit = min(limit, MAX_PAGE_LIMIT)
+
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return limit, None, None
+    try:
+        return limit, decode_cursor(cursor), None
+    except (ValueError, TypeError):
+        return None, None, "Invalid cursor"
+
+
+def export(cls, serialize, export_type, **criteria):
+    """
+    Streams every cls object matching criteria as NDJSON or as one JSON
+    array. Memory stays flat: rows are fetched EXPORT_BATCH_SIZE at a time
+    and each batch is written out before the next is read.
+    """
+    ndjson = export_type == "ndjson"
+
+    def generate():
+        batch = []
+        first = True
+        if not ndjson:
+            yield b"["
+        for row in storage.stream(cls, EXPORT_BATCH_SIZE, rows=True, **criteria):
+            batch.append(dumps(serialize(row)))
+            if len(batch) == EXPORT_BATCH_SIZE:
+                yield _join(batch, ndjson, first)
+                batch, first = [], False
+        if batch:
+            yield _join(batch, ndjson, first)
+        if not ndjson:
+            yield b"]\n"
+
+    filename = "{}.{}".format(cls.__tablename__, export_type)
+    # stream_with_context keeps the request, and so the database session,
+    # open until the generator is exhausted
+    return Response(stream_with_context(generate()), mimetype=export_types[export_type],
+                    headers={"Content-Disposition": "attachment; filename=" + filename})
+
+
+def _join(batch, ndjson, first):
+    """returns one written chunk of an export"""
+    if ndjson:
+        return b"\n".join(batch) + b"\n"
+    return (b"" if first else b",") + b",".join(batch)
+
+
+def paginate(cls, serialize=None, cache=None, **criteria):
+    """
+    Returns the response for one page of the cls objects matching
+    criteria, or the streamed export of all of them when `export` is
+    requested. serialize turns one result row into a dict; by default it
+    is the model's precompiled serializer. Pages of the default
+    serialization may be kept in cache, a models.reference.ReferenceCache
+    """
+    if serialize is None:
+        serialize = serializer_for(cls).row_to_dict
+
+    export_type = request.args.get('export')
+    if export_type:
+        if export_type not in export_types:
+            return jsonify({"error": "export must be one of: " + ", ".join(export_types)}), 400
+        return export(cls, serialize, export_type, **criteria)
+
+    limit, after, error = page_args()
+    if error:
+        return jsonify({"error": error}), 400
+
+    def load():
+        """returns the page's JSON body and the cursor of the next one"""
+        items = storage.page(cls, limit + 1, after, rows=True, **criteria)
+        more = len(items) > limit
+        items = items[:limit]
+        return dumps([serialize(item) for item in items]), encode_cursor(items[-1]) if more else None
+
+    if cache is None:
+        body, cursor = load()
+    else:
+        body, cursor = cache.fetch(cls, ("page", limit, after, tuple(sorted(criteria.items()))), load)
+    response = Response(body, mimetype='application/json')
+    if cursor:
+        response.headers['X-Next-Cursor'] = cursor
+        args = request.args.to_dict()
+        args.update(cursor=cursor, limit=limit)
+        response.headers['Link'] = '<{}?{}>; rel="next"'.format(request.base_url, urlencode(args))
+    return response
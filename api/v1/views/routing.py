@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+"""
+Contains the read replica routing of the API.
+
+Reporting endpoints tolerate a little replication lag, so their reads can
+go to a read replica (TCC_DATABASE_REPLICA_URLS) and keep that load off
+the primary. Routing is chosen per endpoint with the replica_reads
+decorator, or for every read-only request of a blueprint with
+route_reads_to_replica. A request that writes is pinned to the primary
+from its first write on, so it always reads what it wrote; routing ends
+with the request, when the app tears the storage session down.
+"""
+
+from functools import wraps
+from flask import request
+from models import storage
+
+# Requests that never write, and may read from a replica
+READ_ONLY_METHODS = ('GET', 'HEAD')
+
+
+def replica_reads(fn):
+    """Decorator routing the storage reads of an endpoint to a replica."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        storage.route_reads()
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def route_reads_to_replica(blueprint, methods=READ_ONLY_METHODS):
+    """Routes the storage reads of a blueprint's read-only requests to a replica."""
+    @blueprint.before_request
+    def use_replica():
+        if request.method in methods:
+            storage.route_reads()
+    return blueprint
@@ -3,15 +3,76 @@
 Contains the API endpoints for managing trucks.
 """
 
+from sqlalchemy.orm.exc import StaleDataError
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required
 from api.v1.views.auth import login_required, role_required
-from models.tables import Truck, TruckStatus
+from api.v1.views.bulk import bulk_import
+from models.tables import Branch, Truck, TruckStatus, TruckStatusEvent
 from models import storage
-from datetime import datetime, timedelta
+from models.reference import reference
+from models.versions import mark_written
+from models.lanes import enqueue_ready_lanes
+from models.truck_status import initial_status, status_event, status_seconds, zero_totals
+from models.transitions import naive_utc
+from models.truck_usage import buckets, usage_rows
+from models.stats import day_of
+from api.v1.views.pagination import paginate
+from api.v1.views.conditional import conditional
+from api.v1.views.routing import replica_reads
+from datetime import date, datetime, timedelta
+import uuid
 
 trucks_bp = Blueprint('trucks_bp', __name__)
 
+def validate_truck(data):
+    """Checks a truck payload, returning (fields, error)."""
+    if not data or not data.get('truck_number'):
+        return None, "Missing truck number"
+    try:
+        capacity = float(data.get('capacity_cubic_meters', 500.0))
+    except (TypeError, ValueError):
+        return None, "Invalid capacity_cubic_meters. Must be a number."
+    return {
+        "truck_number": data['truck_number'],
+        "capacity_cubic_meters": capacity,
+        "current_branch_id": data.get('current_branch_id')
+    }, None
+
+def insert_trucks(chunk):
+    """
+    Bulk inserts a chunk of validated trucks with one multi-row INSERT,
+    along with their first status events, rejecting duplicate truck
+    numbers and unknown branches.
+    Returns the (row, error) pairs that were rejected.
+    """
+    numbers = [fields['truck_number'] for _, fields in chunk]
+    taken = {truck.truck_number for truck in storage.filter(Truck, truck_number=numbers)}
+    branches = storage.get_many(Branch, {fields['current_branch_id'] for _, fields in chunk})
+    now = datetime.utcnow()
+    rejected, trucks = [], []
+    for row, fields in chunk:
+        if fields['truck_number'] in taken:
+            rejected.append((row, "Truck number already exists"))
+            continue
+        if fields['current_branch_id'] is not None and fields['current_branch_id'] not in branches:
+            rejected.append((row, "Branch not found"))
+            continue
+        taken.add(fields['truck_number'])
+        trucks.append(dict(fields, id=str(uuid.uuid4()), status=TruckStatus.AVAILABLE,
+                           version_id=1, created_at=now, updated_at=now, **initial_status(now)))
+    if trucks:
+        # Core inserts skip the ORM flush hooks, so the status log is
+        # started, and the branches' ready lanes woken, here for the chunk.
+        connection = storage.connection()
+        connection.execute(Truck.__table__.insert(), trucks)
+        connection.execute(TruckStatusEvent.__table__.insert(), [
+            status_event(truck['id'], truck['status'], now, zero_totals())
+            for truck in trucks])
+        mark_written(storage.session_info(), [Truck])
+        enqueue_ready_lanes(connection, {truck['current_branch_id'] for truck in trucks} - {None})
+    return rejected
+
 @trucks_bp.route('', methods=['POST'])
 @jwt_required()
 @role_required('MANAGER')
@@ -46,34 +107,69 @@ def create_truck():
         400:
             description: Missing required truck number.
     """
-    data = request.get_json()
-    if not data or not data.get('truck_number'):
-        return jsonify({"error": "Missing truck number"}), 400
+    fields, error = validate_truck(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
 
-    new_truck = Truck(
-        truck_number=data['truck_number'],
-        capacity_cubic_meters=data.get('capacity_cubic_meters', 500.0),
-        current_branch_id=data.get('current_branch_id')
-    )
+    new_truck = Truck(**fields)
     storage.new(new_truck)
     storage.save()
     return jsonify(new_truck.to_dict()), 201
 
+@trucks_bp.route('/bulk', methods=['POST'])
+@jwt_required()
+@role_required('MANAGER')
+def bulk_create_trucks():
+    """
+    Imports many trucks in one request.
+
+    ---
+    consumes:
+        - application/x-ndjson
+        - application/json
+    parameters:
+        - name: body
+          in: body
+          required: true
+          description: NDJSON (one truck per line) or a JSON array of trucks, with the fields of POST /trucks.
+          schema:
+            type: array
+            items:
+              type: object
+    responses:
+        200:
+            description: Import summary with the inserted and failed row counts, and an error for each failed row.
+    """
+    return jsonify(bulk_import(validate_truck, insert_trucks))
+
 @trucks_bp.route('', methods=['GET'])
+@conditional(Truck)
 def get_trucks():
     """
-    Retrieves all trucks.
+    Retrieves trucks, one page at a time.
 
     ---
+    parameters:
+        - name: limit
+          in: query
+          type: integer
+          required: false
+          default: 100
+          description: Page size, at most 1000.
+        - name: cursor
+          in: query
+          type: string
+          required: false
+          description: The X-Next-Cursor header of the previous page.
     responses:
         200:
-            description: A list of all trucks.
+            description: A page of trucks, with an X-Next-Cursor header when more follow.
             
     """
-    trucks = storage.all(Truck).values()
-    return jsonify([truck.to_dict() for truck in trucks])
+    return paginate(Truck, cache=reference)
 
 @trucks_bp.route('/<truck_id>', methods=['GET'])
+@conditional(Truck)
 def get_truck(truck_id):
     """
     Retrieves a specific truck.
@@ -91,10 +187,10 @@ def get_truck(truck_id):
         404:
             description: Truck not found.
     """
-    truck = storage.get(Truck, id=truck_id)
+    truck = reference.get(Truck, truck_id)
     if not truck:
         return jsonify({"error": "Truck not found"}), 404
-    return jsonify(truck.to_dict())
+    return jsonify(truck)
 
 @trucks_bp.route('/<truck_id>', methods=['PUT'])
 def update_truck(truck_id):
@@ -125,6 +221,8 @@ def update_truck(truck_id):
             description: Truck not found.
         400:
             description: No data provided or invalid data.
+        409:
+            description: The truck was changed concurrently, e.g. dispatched; retry.
     """
     truck = storage.get(Truck, id=truck_id)
     if not truck:
@@ -139,10 +237,15 @@ def update_truck(truck_id):
     if 'current_branch_id' in data:
         truck.current_branch_id = data['current_branch_id']
     
-    storage.save()
+    try:
+        storage.save()
+    except StaleDataError:
+        storage.rollback()
+        return jsonify({"error": "Truck was changed concurrently, retry"}), 409
     return jsonify(truck.to_dict())
 
 @trucks_bp.route('/status', methods=['GET'])
+@conditional(Truck)
 def get_truck_statuses():
     """
     Retrieves the status of all trucks.
@@ -154,70 +257,156 @@ def get_truck_statuses():
           type: string
           required: false
           description: Filter trucks by status
+        - name: limit
+          in: query
+          type: integer
+          required: false
+          default: 100
+          description: Page size, at most 1000.
+        - name: cursor
+          in: query
+          type: string
+          required: false
+          description: The X-Next-Cursor header of the previous page.
     responses:
         200:
-            description: A list of all trucks with their statuses.
-            
+            description: A page of trucks with their statuses, with an X-Next-Cursor header when more follow.
+        400:
+            description: Invalid status, limit or cursor.
     """
-    trucks = storage.all(Truck).values()
-    return jsonify([{"id": truck.id, "truck_number": truck.truck_number, "status": truck.status.value} for truck in trucks])
+    criteria = {}
+    if request.args.get('status'):
+        try:
+            criteria['status'] = TruckStatus(request.args['status'])
+        except ValueError:
+            return jsonify({"error": "Invalid status"}), 400
+    return paginate(Truck, lambda truck: {"id": truck.id, "truck_number": truck.truck_number,
+                                          "status": truck.status.value}, **criteria)
 
 @trucks_bp.route('/usage', methods=['GET'])
+@replica_reads
 def get_truck_usage():
     """
-    Retrieves the usage of all trucks over a given period.
+    Retrieves the usage of trucks over a given period, in day, week or month buckets.
     ---
     parameters:
+      - name: since
+        in: query
+        type: string
+        format: date
+        required: false
+        description: First day (YYYY-MM-DD, UTC) of the period. Defaults to `days` days ago.
+      - name: until
+        in: query
+        type: string
+        format: date
+        required: false
+        description: Last day (YYYY-MM-DD, UTC) of the period. Defaults to today.
       - name: days
         in: query
         type: integer
         required: false
         default: 7
-        description: The number of days to look back for usage statistics.
+        description: The number of days to look back when since is not given.
+      - name: bucket
+        in: query
+        type: string
+        required: false
+        default: day
+        enum: [day, week, month]
+        description: The size of the usage buckets.
+      - name: branch_id
+        in: query
+        type: string
+        required: false
+        description: Only include the trucks currently at this branch.
     responses:
         200:
-            description: A list of trucks with their usage statistics.
-            
+            description: Every truck with its usage statistics over the period, in total and per bucket; trucks not dispatched have zero counts and no buckets.
+        400:
+            description: Invalid date or bucket.
     """
-    days = request.args.get('days', 7, type=int)
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=days)
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in buckets:
+        return jsonify({"error": "Invalid bucket. Use day, week or month."}), 400
+    try:
+        until = request.args.get('until')
+        until = date.fromisoformat(until) if until else datetime.utcnow().date()
+        since = request.args.get('since')
+        since = date.fromisoformat(since) if since else \
+            until - timedelta(days=request.args.get('days', 7, type=int))
+    except ValueError:
+        return jsonify({"error": "Invalid date. Use YYYY-MM-DD."}), 400
+
+    # The trucks left-joined to their rollup rows, one per day used, kept
+    # by models.truck_usage
+    usage, numbers = {}, {}
+    for truck_id, truck_number, day, *counts in usage_rows(storage, since, until,
+                                                           request.args.get('branch_id')):
+        numbers[truck_id] = truck_number
+        truck_buckets = usage.setdefault(truck_id, {})
+        if day is None:
+            continue
+        start = buckets[bucket](day_of(day)).isoformat()
+        truck_buckets[start] = [a + b for a, b in zip(truck_buckets.get(start, (0, 0.0, 0.0)), counts)]
+
+    def usage_dict(dispatch_count, volume_carried, capacity_offered):
+        return {
+            "dispatch_count": dispatch_count,
+            "volume_carried": volume_carried,
+            "utilization": volume_carried / capacity_offered if capacity_offered else 0.0
+        }
 
-    trucks = storage.all(Truck).values()
     truck_usage = []
-    for truck in trucks:
-        dispatches = [d for d in truck.dispatches if start_date <= d.created_at <= end_date]
-        truck_usage.append({
-            "truck_id": truck.id,
-            "truck_number": truck.truck_number,
-            "dispatch_count": len(dispatches)
-        })
+    for truck_id, truck_buckets in usage.items():
+        total = [sum(values) for values in zip(*truck_buckets.values())] or [0, 0.0, 0.0]
+        truck_usage.append(dict(
+            usage_dict(*total),
+            truck_id=truck_id,
+            truck_number=numbers[truck_id],
+            buckets=[dict(usage_dict(*values), start=start) for start, values in truck_buckets.items()]))
 
     return jsonify(truck_usage)
 
 @trucks_bp.route('/average_idle_time', methods=['GET'])
+@replica_reads
 def get_average_idle_time():
     """
-    Calculates the average idle time for trucks.
+    Calculates the average idle time for trucks from their status history.
     ---
+    parameters:
+      - name: since
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: Start of the window (ISO 8601, UTC). Defaults to the start of the status history.
+      - name: until
+        in: query
+        type: string
+        format: date-time
+        required: false
+        description: End of the window (ISO 8601, UTC). Defaults to now.
     responses:
       200:
-        description: The average idle time of trucks in seconds.
+        description: The average idle time of trucks in seconds, and the fleet's total seconds in each status over the window.
+      400:
+        description: Invalid time.
     """
-    trucks = storage.all(Truck).values()
-    total_idle_time = timedelta()
-    total_trucks = 0
-
-    for truck in trucks:
-        # This is a simplified calculation. A more accurate calculation would
-        # require tracking the history of truck status changes.
-        if truck.status == TruckStatus.IDLE:
-            # Assuming the truck has been idle since its last dispatch
-            last_dispatch = max(d.created_at for d in truck.dispatches) if truck.dispatches else truck.created_at
-            idle_time = datetime.utcnow() - last_dispatch
-            total_idle_time += idle_time
-            total_trucks += 1
+    try:
+        since = request.args.get('since')
+        since = naive_utc(datetime.fromisoformat(since)) if since else None
+        until = request.args.get('until')
+        until = naive_utc(datetime.fromisoformat(until)) if until else None
+    except ValueError:
+        return jsonify({"error": "Invalid time. Use ISO 8601."}), 400
 
-    average_idle_time = total_idle_time / total_trucks if total_trucks > 0 else timedelta(0)
+    # Two lookups of each truck's last status event before since and until
+    total_trucks, seconds = status_seconds(storage, since, until)
+    average_idle_time = seconds[TruckStatus.IDLE] / total_trucks if total_trucks > 0 else 0.0
 
-    return jsonify({"average_idle_time_seconds": average_idle_time.total_seconds()})
+    return jsonify({
+        "average_idle_time_seconds": average_idle_time,
+        "trucks": total_trucks,
+        "fleet_status_seconds": {status.value: seconds[status] for status in TruckStatus}
+    })
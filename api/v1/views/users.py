@@ -3,15 +3,24 @@
 Contains the API endpoints for managing users.
 """
 
+from datetime import datetime
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import create_access_token, jwt_required
-from api.v1.views.auth import login_required, role_required
+from api.v1.views.auth import login_required, principals, role_required
 from models.tables import User, UserRole, Branch
 from models import storage
-from werkzeug.security import generate_password_hash, check_password_hash
+from api.v1.views.pagination import paginate
+from models.passwords import PasswordQueueFull, passwords
+from models.reference import reference
 
 users_bp = Blueprint('users_bp', __name__)
 
+def busy():
+    """Returns the response to a request the password pool cannot take."""
+    response = jsonify({"error": "Too many logins in progress, try again shortly"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @users_bp.route('/register', methods=['POST'])
 def register_user():
     """
@@ -41,21 +50,25 @@ def register_user():
             description: Missing username or password.
         409:
             description: User already exists.
+        503:
+            description: Too many passwords being hashed; retry later.
     """
     data = request.get_json()
     if not data or not data.get('username') or not data.get('password') or not data.get('branch_id'):
         return jsonify({"error": "Missing required fields"}), 400
 
     # Check if the branch exists
-    branch = storage.get(Branch, id=data['branch_id'])
+    branch = reference.get(Branch, data['branch_id'])
     if not branch:
         return jsonify({"error": "Branch not found"}), 404
 
-    all_users = storage.all(User).values()
-    if any(user.username == data['username'] for user in all_users):
+    if storage.exists(User, username=data['username']):
         return jsonify({"error": "User already exists"}), 409
 
-    password_hash = generate_password_hash(data['password'])
+    try:
+        password_hash = passwords.hash(data['password'])
+    except PasswordQueueFull:
+        return busy()
     new_user = User(
         username=data['username'],
         password_hash=password_hash,
@@ -89,17 +102,27 @@ def login_user():
         description: Missing username or password.
       401:
         description: Invalid username or password.
+      503:
+        description: Too many passwords being checked; retry later.
     """
     data = request.get_json()
     if not data or not data.get('username') or not data.get('password'):
         return jsonify({"error": "Missing username or password"}), 400
 
-    all_users = storage.all(User).values()
-    user = next((user for user in all_users if user.username == data['username']), None)
-    if not user or not check_password_hash(user.password_hash, data['password']):
+    user = storage.first(User, username=data['username'])
+    if not user:
+        return jsonify({"error": "Invalid username or password"}), 401
+    user_id, role, password_hash = user.id, user.role.value, user.password_hash
+    # Give the connection back while the password is being checked
+    storage.close()
+    try:
+        valid = passwords.verify(password_hash, data['password'])
+    except PasswordQueueFull:
+        return busy()
+    if not valid:
         return jsonify({"error": "Invalid username or password"}), 401
 
-    access_token = create_access_token(identity=user.id, additional_claims={"role": user.role.value})
+    access_token = create_access_token(identity=user_id, additional_claims={"role": role})
     return jsonify(access_token=access_token)
 
 @users_bp.route('/me', methods=['GET'])
@@ -117,14 +140,25 @@ def get_current_user():
 @role_required('ADMIN')
 def get_users():
     """
-    Retrieves all users.
+    Retrieves users, one page at a time.
     ---
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        default: 100
+        description: Page size, at most 1000.
+      - name: cursor
+        in: query
+        type: string
+        required: false
+        description: The X-Next-Cursor header of the previous page.
     responses:
       200:
-        description: A list of all users.
+        description: A page of users, with an X-Next-Cursor header when more follow.
     """
-    users = storage.all(User).values()
-    return jsonify([user.to_dict() for user in users])
+    return paginate(User)
 
 @users_bp.route('/<user_id>', methods=['GET'])
 @jwt_required()
@@ -151,7 +185,7 @@ def get_user(user_id):
 
 @users_bp.route('/<user_id>', methods=['PUT'])
 @jwt_required()
-@role_required('ADMIN')
+@role_required('ADMIN', fresh=True)
 def update_user(user_id):
     """
     Updates a user's information.
@@ -196,13 +230,15 @@ def update_user(user_id):
         user.role = UserRole(data['role'])
     if 'branch_id' in data:
         user.branch_id = data['branch_id']
-    
+    # Tokens issued before this no longer vouch for the user's role
+    user.updated_at = datetime.utcnow()
     storage.save()
+    principals.invalidate(user.id)
     return jsonify(user.to_dict())
 
 @users_bp.route('/<user_id>', methods=['DELETE'])
 @jwt_required()
-@role_required('ADMIN')
+@role_required('ADMIN', fresh=True)
 def delete_user(user_id):
     """
     Deletes a user.
@@ -224,4 +260,5 @@ def delete_user(user_id):
 
     storage.delete(user)
     storage.save()
+    principals.invalidate(user.id)
     return '', 204
\ No newline at end of file
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+"""
+Benchmarks a login storm.
+
+Many client threads log in at once through POST /api/v1/users/login,
+first with passwords checked in the request thread (0 workers), then on
+password pools of growing size. Throughput should grow with the number
+of workers up to the number of cores, since checking a password no
+longer holds the GIL of the API process.
+
+    python -m benchmarks.bench_login [--users 32] [--threads 32]
+        [--logins 4] [--method scrypt:32768:8:1] [--workers 0,1,2,4]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def storm(app, usernames, threads, logins):
+    """returns the logins per second of threads clients logging in at once"""
+    failures = []
+
+    def client(offset):
+        http = app.test_client()
+        for i in range(logins):
+            username = usernames[(offset + i) % len(usernames)]
+            response = http.post('/api/v1/users/login', data=json.dumps(
+                {"username": username, "password": "password"}),
+                content_type='application/json')
+            if response.status_code != 200:
+                failures.append(response.status_code)
+
+    clients = [threading.Thread(target=client, args=(n,))
+               for n in range(threads)]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return (threads * logins - len(failures)) / elapsed, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--logins", type=int, default=4)
+    parser.add_argument("--method", default=None)
+    parser.add_argument("--workers", default=None)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    workers = [int(n) for n in args.workers.split(",")] if args.workers \
+        else sorted({0, 1, max(cores // 2, 1), cores})
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["TCC_DATABASE_URL"] = "sqlite:///" + path
+    from api.v1.app import app
+    from models import storage
+    from models.passwords import passwords
+    from models.tables import Branch, User
+
+    storage.create_schema()
+    branch = Branch(name="Bench Branch")
+    storage.new(branch)
+    passwords.configure(workers=0, method=args.method)
+    password_hash = passwords.hash("password")
+    usernames = ["bench{}".format(n) for n in range(args.users)]
+    for username in usernames:
+        storage.new(User(username=username, password_hash=password_hash,
+                         branch_id=branch.id))
+    storage.save()
+    storage.close()
+
+    print("{} cores, {} client threads".format(cores, args.threads))
+    print("{:>8} {:>14} {:>8}".format("workers", "logins/s", "refused"))
+    for count in workers:
+        passwords.configure(workers=count, queue_size=args.threads,
+                            method=args.method)
+        storm(app, usernames, count or 1, 1)  # start the pool
+        rate, refused = storm(app, usernames, args.threads, args.logins)
+        print("{:>8} {:>14.1f} {:>8}".format(count, rate, refused))
+    passwords.shutdown()
+    storage.drop_schema()
+
+
+if __name__ == "__main__":
+    main()
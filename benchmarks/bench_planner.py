@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+"""
+Benchmarks the dispatch planner on a large lane backlog.
+
+The planner has to pack a 100k consignment backlog in under a second.
+
+    python -m benchmarks.bench_planner [--consignments N] [--trucks N]
+"""
+
+import argparse
+import random
+import time
+from collections import namedtuple
+from models.planner import plan_dispatch
+
+Item = namedtuple("Item", ["id", "volume_cubic_meters"])
+Truck = namedtuple("Truck", ["id", "capacity_cubic_meters"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--consignments", type=int, default=100000)
+    parser.add_argument("--trucks", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    items = [Item(i, rng.uniform(0.1, 20.0)) for i in range(args.consignments)]
+    trucks = [Truck(i, rng.choice([100.0, 250.0, 500.0, 750.0]))
+              for i in range(args.trucks)]
+
+    start = time.perf_counter()
+    loads, unassigned = plan_dispatch(items, trucks, threshold=500,
+                                      min_fill=0.5)
+    elapsed = time.perf_counter() - start
+
+    total = sum(item.volume_cubic_meters for item in items)
+    packed = sum(load.volume for load in loads)
+    capacity = sum(load.truck.capacity_cubic_meters for load in loads)
+    print("consignments: {}  trucks: {}".format(len(items), len(trucks)))
+    print("loads: {}  unassigned: {}".format(len(loads), len(unassigned)))
+    print("packed {:.1f} of {:.1f} m3, fill {:.1%}".format(
+        packed, total, packed / capacity if capacity else 0))
+    print("planned in {:.3f}s ({})".format(
+        elapsed, "ok" if elapsed < 1.0 else "over the 1s budget"))
+
+
+if __name__ == "__main__":
+    main()
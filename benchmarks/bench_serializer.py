@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+"""
+Benchmarks model serialization for list responses.
+
+Compares the original __dict__ walking to_dict with the precompiled
+per-model serializer, on instances loaded from a scratch SQLite database
+and on plain result rows of the same consignments.
+
+    python -m benchmarks.bench_serializer [--objects N]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time as timer
+from datetime import datetime
+from enum import Enum
+
+
+def legacy_to_dict(obj):
+    """the to_dict implementation the serializer replaced"""
+    from models.base_model import time
+    new_dict = obj.__dict__.copy()
+    for key, value in new_dict.items():
+        if isinstance(value, datetime):
+            new_dict[key] = value.strftime(time)
+        elif isinstance(value, Enum):
+            new_dict[key] = value.name
+    new_dict["__class__"] = obj.__class__.__name__
+    if "_sa_instance_state" in new_dict:
+        del new_dict["_sa_instance_state"]
+    return new_dict
+
+
+def timed(label, fn, count, repeat=3):
+    """prints the best of repeat runs of fn over count objects"""
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = timer.perf_counter()
+        fn()
+        elapsed = min(elapsed, timer.perf_counter() - start)
+    print("{:<34} {:>8.1f} ms {:>10.0f} objs/s".format(
+        label, elapsed * 1000, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--objects", type=int, default=20000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["TCC_DATABASE_URL"] = "sqlite:///" + path
+    from models import storage
+    from models.serializer import dumps, serializer_for
+    from models.tables import Branch, Consignment
+
+    storage.create_schema()
+    branch = Branch(name="Bench Branch")
+    storage.new(branch)
+    for i in range(args.objects):
+        storage.new(Consignment(volume_cubic_meters=float(i % 50),
+                                destination_address="Bench Destination",
+                                sender_address="Bench Sender",
+                                receiver_name="Bench Receiver {}".format(i),
+                                origin_branch_id=branch.id))
+    storage.save()
+    storage.close()
+    objs = storage.filter(Consignment)
+    rows = storage.page(Consignment, args.objects, rows=True)
+    serializer = serializer_for(Consignment)
+
+    timed("legacy to_dict", lambda: [legacy_to_dict(o) for o in objs],
+          len(objs))
+    timed("serializer to_dict", lambda: [serializer.to_dict(o) for o in objs],
+          len(objs))
+    timed("serializer rows", lambda: [serializer.row_to_dict(r) for r in rows],
+          len(rows))
+    timed("legacy to_dict + json.dumps",
+          lambda: json.dumps([legacy_to_dict(o) for o in objs]), len(objs))
+    timed("serializer to_dict + dumps",
+          lambda: dumps([serializer.to_dict(o) for o in objs]), len(objs))
+    timed("serializer rows + dumps",
+          lambda: dumps([serializer.row_to_dict(r) for r in rows]), len(rows))
+    storage.drop_schema()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+"""
+Benchmarks worker cold start.
+
+Each round starts a fresh interpreter that imports the API application
+(or the models alone), then serves its first storage query, and reports
+how long each phase took. Importing should do no database work at all;
+the first query pays for connecting and the one-off schema check.
+
+    python -m benchmarks.bench_startup [--rounds N] [--url URL]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Run in the child interpreter; prints the phase timings as JSON
+CHILD = """
+import json, time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+from models import storage
+from models.tables import Branch
+storage.count(Branch)
+queried = time.perf_counter()
+print(json.dumps([imported - start, queried - imported]))
+"""
+
+
+def run(module, url, rounds):
+    """returns the (import, first query) seconds of each round"""
+    env = dict(os.environ, TCC_DATABASE_URL=url)
+    timings = []
+    for _ in range(rounds):
+        output = subprocess.run([sys.executable, "-c",
+                                 CHILD.format(module=module)],
+                                env=env, check=True, capture_output=True,
+                                text=True).stdout
+        timings.append(json.loads(output.strip().splitlines()[-1]))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    url = args.url
+    if url is None:
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        url = "sqlite:///" + path
+        os.environ["TCC_DATABASE_URL"] = url
+        from models.engine.db import DBStorage
+        storage = DBStorage(url)
+        storage.create_schema()
+        storage.close()
+
+    print("{:<12} {:>12} {:>16}".format("module", "import (ms)",
+                                         "first query (ms)"))
+    for module in ("models", "api.v1.app"):
+        timings = run(module, url, args.rounds)
+        imports = sorted(t[0] for t in timings)
+        queries = sorted(t[1] for t in timings)
+        print("{:<12} {:>12.1f} {:>16.1f}".format(
+            module, imports[len(imports) // 2] * 1000,
+            queries[len(queries) // 2] * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+"""
+Benchmarks DBStorage.get and DBStorage.get_many against growing tables.
+
+Latency should stay flat as the consignments table grows, since both
+calls resolve through the primary key index instead of a table scan.
+
+    python -m benchmarks.bench_storage_get [--url URL] [--sizes 1000,10000]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from models.engine.db import DBStorage
+from models.tables import Branch, Consignment
+
+
+def seed(storage, branch, count):
+    """insert count consignments for branch, returning their ids"""
+    ids = []
+    for _ in range(count):
+        consignment = Consignment(volume_cubic_meters=1.0,
+                                  destination_address="Bench Destination",
+                                  sender_address="Bench Sender",
+                                  receiver_name="Bench Receiver",
+                                  origin_branch_id=branch.id)
+        storage.new(consignment)
+        ids.append(consignment.id)
+    storage.save()
+    return ids
+
+
+def timed(fn, rounds):
+    """returns the mean latency of fn over rounds calls in microseconds"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    url = args.url
+    if url is None:
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        url = "sqlite:///" + path
+
+    storage = DBStorage(url)
+    storage.create_schema()
+    branch = Branch(name="Bench Branch")
+    storage.new(branch)
+    storage.save()
+
+    ids = []
+    print("{:>10} {:>14} {:>20}".format("rows", "get (us)", "get_many x50 (us)"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        ids.extend(seed(storage, branch, size - len(ids)))
+        # Start every round from an empty identity map so the lookups
+        # measure the database round trip rather than the session cache.
+        storage.close()
+
+        def one():
+            storage.get(Consignment, random.choice(ids))
+            storage.close()
+
+        def many():
+            storage.get_many(Consignment, random.sample(ids, 50))
+            storage.close()
+
+        print("{:>10} {:>14.1f} {:>20.1f}".format(
+            size, timed(one, args.rounds), timed(many, args.rounds // 10)))
+
+    storage.close()
+    storage.drop_schema()
+
+
+if __name__ == "__main__":
+    main()
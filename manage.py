@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+"""
+Maintenance commands for the TCC backend.
+
+    python manage.py create-schema
+    python manage.py drop-schema --yes
+    python manage.py migrate [--target N]
+    python manage.py check-indexes
+    python manage.py rebuild-lanes
+    python manage.py rebuild-stats [--check]
+    python manage.py rebuild-usage [--check]
+    python manage.py prune-truck-events [--days N]
+    python manage.py dispatch-worker [--poll-interval S] [--batch-size N]
+"""
+
+import argparse
+import logging
+from models import storage
+
+
+def create_schema(args):
+    """creates every table and index of an empty database"""
+    storage.create_schema()
+    print("schema created")
+
+
+def drop_schema(args):
+    """drops every table, deleting all data"""
+    if not args.yes:
+        raise SystemExit("drop-schema deletes all data; pass --yes to confirm")
+    storage.drop_schema()
+    print("schema dropped")
+
+
+def migrate(args):
+    """applies the pending schema migrations"""
+    from models.migrations import current_version, upgrade
+    for number, description in upgrade(storage.engine(), args.target):
+        print("applied {:04d} {}".format(number, description))
+    print("schema at version {}".format(current_version(storage.engine())))
+
+
+def check_indexes(args):
+    """fails if a declared hot query has no covering index in the database"""
+    from models.migrations import check_indexes as uncovered
+    missing = uncovered(storage.engine())
+    for query in missing:
+        print("no index on {}({}): {}".format(
+            query.table, ", ".join(query.columns), query.description))
+    if missing:
+        raise SystemExit(1)
+    print("every hot query has a covering index")
+
+
+def rebuild_lanes(args):
+    """recomputes the lane backlog from the consignments table"""
+    from models.lanes import rebuild_lane_backlog
+    repaired = rebuild_lane_backlog(storage)
+    for branch_id, destination in repaired:
+        print("repaired lane {} -> {}".format(branch_id, destination))
+    print("{} lane(s) repaired".format(len(repaired)))
+
+
+def rebuild_stats(args):
+    """verifies the destination stats against the consignments and invoices"""
+    from models.stats import rebuild_destination_stats
+    drifted = rebuild_destination_stats(storage, repair=not args.check)
+    for destination, branch_id, day in drifted:
+        print("{} stats {} from {} on {}".format(
+            "drifted" if args.check else "repaired", destination, branch_id,
+            day))
+    print("{} stats row(s) {}".format(
+        len(drifted), "drifted" if args.check else "repaired"))
+    if args.check and drifted:
+        raise SystemExit(1)
+
+
+def rebuild_usage(args):
+    """verifies the truck usage rollup against the dispatch history"""
+    from models.truck_usage import rebuild_truck_usage
+    drifted = rebuild_truck_usage(storage, repair=not args.check)
+    for truck_id, day in drifted:
+        print("{} usage of {} on {}".format(
+            "drifted" if args.check else "repaired", truck_id, day))
+    print("{} usage row(s) {}".format(
+        len(drifted), "drifted" if args.check else "repaired"))
+    if args.check and drifted:
+        raise SystemExit(1)
+
+
+def prune_truck_events(args):
+    """deletes truck status events older than --days days"""
+    from datetime import datetime, timedelta
+    from models.truck_status import prune_status_events
+    deleted = prune_status_events(
+        storage, datetime.utcnow() - timedelta(days=args.days))
+    print("{} truck status event(s) deleted".format(deleted))
+
+
+def dispatch_worker(args):
+    """runs the dispatch worker over the queued lane events"""
+    from models.dispatcher import run_worker
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        run_worker(args.poll_interval, args.batch_size, args.once)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TCC maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("create-schema", help=create_schema.__doc__)
+    command.set_defaults(func=create_schema)
+
+    command = commands.add_parser("drop-schema", help=drop_schema.__doc__)
+    command.add_argument("--yes", action="store_true",
+                         help="confirm deleting all data")
+    command.set_defaults(func=drop_schema)
+
+    command = commands.add_parser("migrate", help=migrate.__doc__)
+    command.add_argument("--target", type=int, default=None,
+                         help="stop at this version")
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser("check-indexes", help=check_indexes.__doc__)
+    command.set_defaults(func=check_indexes)
+
+    command = commands.add_parser("rebuild-lanes", help=rebuild_lanes.__doc__)
+    command.set_defaults(func=rebuild_lanes)
+
+    command = commands.add_parser("rebuild-stats", help=rebuild_stats.__doc__)
+    command.add_argument("--check", action="store_true",
+                         help="only report drifted rows, exit 1 if any")
+    command.set_defaults(func=rebuild_stats)
+
+    command = commands.add_parser("rebuild-usage", help=rebuild_usage.__doc__)
+    command.add_argument("--check", action="store_true",
+                         help="only report drifted rows, exit 1 if any")
+    command.set_defaults(func=rebuild_usage)
+
+    command = commands.add_parser("prune-truck-events",
+                                  help=prune_truck_events.__doc__)
+    command.add_argument("--days", type=int, default=90,
+                         help="status history to keep, in days")
+    command.set_defaults(func=prune_truck_events)
+
+    command = commands.add_parser("dispatch-worker",
+                                  help=dispatch_worker.__doc__)
+    command.add_argument("--poll-interval", type=float, default=1.0)
+    command.add_argument("--batch-size", type=int, default=100)
+    command.add_argument("--once", action="store_true",
+                         help="exit once the queue is empty")
+    command.set_defaults(func=dispatch_worker)
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
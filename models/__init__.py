@@ -6,6 +6,6 @@ initialize the models package
 from models.engine.db import DBStorage
 
 storage_t = "db"
+# Configured from the environment; connects on first use
 storage = DBStorage()
-storage.reload()
 
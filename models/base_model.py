@@ -6,9 +6,9 @@ Contains class BaseModel
 from datetime import datetime, timezone
 import models
 import sqlalchemy
-from enum import Enum
 from sqlalchemy import Column, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
+from models.serializer import serializer_for
 import uuid
 
 time = "%Y-%m-%dT%H:%M:%S.%f"
@@ -49,30 +49,18 @@ class BaseModel:
                                          self.__dict__)
 
     def save(self):
-        """updates the attribute 'updated_at' with the current datetime"""
+        """
+        updates the attribute 'updated_at' with the current datetime and
+        saves the instance, as part of the open unit of work if any
+        """
         self.updated_at = datetime.utcnow()
         models.storage.new(self)
         models.storage.save()
 
     def to_dict(self, save_fs=None):
         """returns a dictionary containing all keys/values of the instance"""
-        new_dict = self.__dict__.copy()
-
-        for key, value in new_dict.items():
-            # Convert datetime to string
-            if isinstance(value, datetime):
-                new_dict[key] = value.strftime(time)
-            # Convert Enum to its name
-            elif isinstance(value, Enum):
-                new_dict[key] = value.name
-
-        new_dict["__class__"] = self.__class__.__name__
-        if "_sa_instance_state" in new_dict:
-            del new_dict["_sa_instance_state"]
-        if save_fs is None:
-            if "password" in new_dict:
-                del new_dict["password"]
-        return new_dict
+        return serializer_for(self.__class__).to_dict(
+            self, include_sensitive=save_fs is not None)
 
     def delete(self):
         """delete the current instance from the storage"""
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+"""
+Contains the dispatch worker.
+
+Consignment intake only records the consignment; the flush that saves it
+queues a lane event (see models.lanes). The worker drains those events and
+runs the dispatch evaluation for each lane outside the request path.
+
+    python manage.py dispatch-worker
+"""
+
+import logging
+import time
+from sqlalchemy.orm.exc import StaleDataError
+from models import storage
+from models.lanes import DISPATCH_THRESHOLD, enqueue_lane_events, pending_volume
+from models.planner import plan_dispatch
+from models.reference import reference
+from models.tables import Branch, Consignment, ConsignmentStatus, Dispatch
+from models.tables import LaneEvent, Truck, TruckStatus
+
+logger = logging.getLogger(__name__)
+
+# Smallest share of a truck's capacity worth dispatching once triggered
+DISPATCH_MIN_FILL = 0.5
+
+
+def requeue(branch_id, destination_address):
+    """rolls the current transaction back and queues the lane again"""
+    storage.rollback()
+    enqueue_lane_events(storage.connection(), [(branch_id, destination_address)])
+    storage.save()
+
+
+def check_and_dispatch_truck(branch_id, destination_address):
+    """dispatches a lane's pending consignments once it reaches the threshold"""
+    logger.debug("checking %s at %s", destination_address, branch_id)
+    branch = reference.get(Branch, branch_id)
+    if not branch:
+        logger.debug("branch %s not found", branch_id)
+        return
+
+    lane = dict(origin_branch_id=branch_id,
+                destination_address=destination_address,
+                status=ConsignmentStatus.AWAITING_DISPATCH)
+
+    # The lane backlog keeps the pending volume up to date on every write
+    total_volume = pending_volume(storage, branch_id, destination_address)
+    logger.debug("%s at %s has %sm³ pending", destination_address, branch_id, total_volume)
+
+    if total_volume < DISPATCH_THRESHOLD:
+        logger.debug("threshold of %sm³ not met", DISPATCH_THRESHOLD)
+        return
+
+    # Lock the lane's consignments and the branch's trucks for this
+    # transaction. Rows another worker already holds are skipped, so
+    # concurrent dispatchers never plan with the same consignment or truck.
+    consignments_for_destination = storage.filter(Consignment, for_update=True, **lane)
+    logger.debug("claimed %s consignments", len(consignments_for_destination))
+    available_trucks = storage.filter(Truck, for_update=True, current_branch_id=branch_id,
+                                      status=TruckStatus.AVAILABLE)
+    if not available_trucks:
+        storage.rollback()
+        if storage.exists(Truck, current_branch_id=branch_id, status=TruckStatus.AVAILABLE):
+            # Another worker holds them; look again once it is done
+            requeue(branch_id, destination_address)
+        else:
+            # The lane is queued again when a truck becomes available here
+            logger.debug("no available truck at %s", branch_id)
+        return
+
+    # Split the load across trucks without exceeding their capacity
+    loads, unassigned = plan_dispatch(consignments_for_destination, available_trucks,
+                                      threshold=DISPATCH_THRESHOLD, min_fill=DISPATCH_MIN_FILL)
+    logger.debug("planned %s load(s), %s consignment(s) left waiting", len(loads), len(unassigned))
+    if not loads:
+        storage.rollback()
+        return
+
+    for load in loads:
+        new_dispatch = Dispatch(
+            truck_id=load.truck.id,
+            destination_address=destination_address
+        )
+        storage.new(new_dispatch)
+        for consignment in load.consignments:
+            consignment.dispatch = new_dispatch
+            consignment.status = ConsignmentStatus.DISPATCHED
+        load.truck.status = TruckStatus.IN_TRANSIT
+        logger.debug("truck %s dispatched with %sm³ (%s consignments) as %s",
+                     load.truck.truck_number, load.volume, len(load.consignments), new_dispatch.id)
+
+    # One commit claims the trucks and consignments. Should another
+    # transaction have changed any of them since they were read, the
+    # version check fails the whole claim and the lane is queued again.
+    try:
+        storage.save()
+    except StaleDataError:
+        logger.info("lost the race for %s at %s; re-queueing", destination_address, branch_id)
+        requeue(branch_id, destination_address)
+        return
+    logger.debug("dispatched %s load(s) for %s at %s", len(loads), destination_address, branch_id)
+
+    # More than the trucks could take: look again for the rest, with the
+    # trucks left or, failing those, once one becomes available
+    if sum(c.volume_cubic_meters for c in unassigned) >= DISPATCH_THRESHOLD:
+        enqueue_lane_events(storage.connection(), [(branch_id, destination_address)])
+        storage.save()
+
+
+def process_lane_events(limit=100):
+    """
+    Runs the dispatch check for up to limit queued lanes, in the order
+    they were first queued; later changes to a queued lane do not move it
+    back.
+    Each event is removed before its lane is evaluated, so changes made
+    meanwhile queue a fresh event; a failed evaluation re-queues the lane.
+    Returns the number of events this worker claimed.
+    """
+    events = storage.filter(LaneEvent, order_by='created_at', limit=limit, for_update=True)
+
+    # Only the worker whose DELETE removes the row owns the event, so two
+    # workers polling the same queue never evaluate a lane twice.
+    table = LaneEvent.__table__
+    connection = storage.connection()
+    lanes = [(e.origin_branch_id, e.destination_address) for e in events
+             if connection.execute(table.delete().where(table.c.id == e.id)).rowcount == 1]
+    storage.save()
+
+    for branch_id, destination_address in lanes:
+        try:
+            check_and_dispatch_truck(branch_id, destination_address)
+        except Exception:
+            logger.exception("dispatch failed for %s at %s", destination_address, branch_id)
+            requeue(branch_id, destination_address)
+        finally:
+            # Drop the session so the next lane sees fresh trucks and volumes
+            storage.close()
+    return len(lanes)
+
+
+def run_worker(poll_interval=1.0, batch_size=100, once=False):
+    """
+    Processes lane events until interrupted, sleeping poll_interval
+    seconds whenever the queue is empty. With once=True it returns as soon
+    as the queue has been drained.
+    """
+    logger.info("dispatch worker started (poll every %ss, batch %s)", poll_interval, batch_size)
+    while True:
+        try:
+            processed = process_lane_events(batch_size)
+        finally:
+            storage.close()
+        if processed:
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
@@ -5,41 +5,129 @@ Contains the class DBStorage
 
 import models
 from models.tables import User, Branch, Truck, Consignment, Invoice, Dispatch
+from models.tables import LaneBacklog, LaneEvent, DestinationStat
+from models.tables import TruckStatusEvent, TruckUsage
+import models.lanes  # registers the lane backlog flush listener
+import models.stats  # registers the destination stats flush listener
+import models.transitions  # registers the status timestamps flush listener
+import models.truck_status  # registers the truck status log flush listener
+import models.truck_usage  # registers the truck usage flush listener
+import models.versions  # registers the table change counters
 from models.base_model import BaseModel, Base
 import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, func, text, and_, or_
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, scoped_session
+from models.engine.pool import InstrumentedQueuePool, PoolStats
+from contextlib import contextmanager
 from os import getenv
+import logging
+import math
+import itertools
+import threading
 
 classes = {"User": User, "Branch": Branch, "Truck": Truck,
            "Consignment": Consignment, "Invoice": Invoice, "Dispatch": Dispatch}
 
+# Bookkeeping tables maintained by the flush listeners and migrations.
+# They can be queried by class or name, but are left out of all() and of
+# count() without a class, which only cover the domain classes above.
+internal_classes = {"LaneBacklog": LaneBacklog, "LaneEvent": LaneEvent,
+                    "DestinationStat": DestinationStat,
+                    "TruckStatusEvent": TruckStatusEvent,
+                    "TruckUsage": TruckUsage}
+registry = dict(classes, **internal_classes)
+
+logger = logging.getLogger(__name__)
+
+# Engine pool keywords, with the environment variable and parser that
+# configure each when DBStorage is not given it
+pool_settings = {
+    "pool_size": ("TCC_DB_POOL_SIZE", int),
+    "max_overflow": ("TCC_DB_MAX_OVERFLOW", int),
+    "pool_timeout": ("TCC_DB_POOL_TIMEOUT", float),
+    "pool_recycle": ("TCC_DB_POOL_RECYCLE", int),
+    "pool_pre_ping": ("TCC_DB_POOL_PRE_PING",
+                      lambda value: value.lower() in ("1", "true", "yes")),
+}
+# Test connections before use and replace them before MySQL's
+# wait_timeout drops them, so no request sees "server has gone away"
+pool_defaults = {"pool_pre_ping": True, "pool_recycle": 1800}
+
+# Upper bound on ids per IN (...) clause issued by get_many
+GET_MANY_BATCH_SIZE = 500
+
+# Suffixes accepted on filter criteria keys, e.g. created_at__gte=...
+operators = {
+    "eq": lambda col, val: col.is_(None) if val is None else col == val,
+    "ne": lambda col, val: col.isnot(None) if val is None else col != val,
+    "gt": lambda col, val: col > val,
+    "gte": lambda col, val: col >= val,
+    "lt": lambda col, val: col < val,
+    "lte": lambda col, val: col <= val,
+    "in": lambda col, val: col.in_(list(val)),
+}
+
+# Tables estimated below this many rows are counted exactly even when an
+# approximate count is requested, since COUNT(*) is cheap at that size
+APPROXIMATE_COUNT_MIN = 100000
+
+aggregates = {"sum": func.sum, "count": func.count, "avg": func.avg,
+              "min": func.min, "max": func.max}
+
 class DBStorage:
     """interaacts with the MySQL database"""
     __engine = None
     __session = None
 
-    def __init__(self):
-        """Instantiate a DBStorage object"""
-        MYSQL_USER = "root"
-        MYSQL_PWD = getenv("MYSQL_PWD")
-        MYSQL_HOST = "localhost"
-        MYSQL_DB = "TEST"
-        ENV = "test"
-        self.__engine = create_engine('mysql+mysqldb://{}:{}@{}/{}'.
-                                      format(MYSQL_USER,
-                                             MYSQL_PWD,
-                                             MYSQL_HOST,
-                                             MYSQL_DB))
-        if ENV == "test":
-            Base.metadata.drop_all(self.__engine)
+    def __init__(self, url=None, env=None, replica_urls=None,
+                 **pool_options):
+        """
+        Instantiate a DBStorage object from the arguments, or else the
+        environment: TCC_DATABASE_URL (or MYSQL_USER, MYSQL_PWD,
+        MYSQL_HOST and MYSQL_DB), TCC_ENV, TCC_DATABASE_REPLICA_URLS
+        (comma separated read replicas) and the pool_settings variables.
+        Nothing connects until the storage is first used.
+        """
+        if url is None:
+            url = getenv("TCC_DATABASE_URL")
+        if url is None:
+            url = 'mysql+mysqldb://{}:{}@{}/{}'.format(
+                getenv("MYSQL_USER", "root"), getenv("MYSQL_PWD"),
+                getenv("MYSQL_HOST", "localhost"), getenv("MYSQL_DB", "TEST"))
+        self.url = url
+        self.env = env or getenv("TCC_ENV", "development")
+        if replica_urls is None:
+            replica_urls = [u.strip() for u in getenv(
+                "TCC_DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+        self.replica_urls = list(replica_urls)
+        unknown = set(pool_options) - set(pool_settings)
+        if unknown:
+            raise TypeError("unknown pool options: {}".format(
+                ", ".join(sorted(unknown))))
+        self.pool_options = dict(pool_defaults)
+        for name, (variable, parse) in pool_settings.items():
+            if pool_options.get(name) is not None:
+                self.pool_options[name] = pool_options[name]
+            elif getenv(variable):
+                self.pool_options[name] = parse(getenv(variable))
+        self.__pool_stats = PoolStats()
+        self.__replica_engines = [None] * len(self.replica_urls)
+        self.__replica_stats = [PoolStats() for _ in self.replica_urls]
+        self.__next_replica = itertools.count()
+        self.__replica_session = None
+        self.__route = threading.local()
+        self.__lock = threading.Lock()
+        self.__schema_checked = False
+        self.__work = threading.local()
+        self.reload()
 
     def all(self, cls=None):
         """query on the current database session"""
         new_dict = {}
-        for clss in classes:
-            if cls is None or cls is classes[clss] or cls is clss:
-                objs = self.__session.query(classes[clss]).all()
+        for clss in (classes if cls is None else registry):
+            if cls is None or cls is registry[clss] or cls is clss:
+                objs = self._reader().query(registry[clss]).all()
                 for obj in objs:
                     key = obj.__class__.__name__ + '.' + obj.id
                     new_dict[key] = obj
@@ -47,54 +135,474 @@ class DBStorage:
 
     def new(self, obj):
         """add the object to the current database session"""
+        self.__pin()
         self.__session.add(obj)
 
     def save(self):
-        """commit all changes of the current database session"""
-        self.__session.commit()
+        """
+        commit all changes of the current database session, or only flush
+        them when a unit of work is open so they commit with it
+        """
+        self.__pin()
+        if getattr(self.__work, "depth", 0):
+            self.__session.flush()
+        else:
+            self.__session.commit()
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Groups every write made in the block into one transaction that is
+        committed once on exit, or rolled back if the block raises. save()
+        calls inside the block, including BaseModel.save(), only flush.
+        Nested blocks join the outermost one.
+        """
+        self.__pin()
+        depth = getattr(self.__work, "depth", 0)
+        self.__work.depth = depth + 1
+        try:
+            yield self
+            if depth == 0:
+                self.__work.depth = 0
+                self.__session.commit()
+        except BaseException:
+            if depth == 0:
+                self.__session.rollback()
+            raise
+        finally:
+            self.__work.depth = depth
+
+    def rollback(self):
+        """discard all uncommitted changes of the current database session"""
+        self.__session.rollback()
+
+    def connection(self):
+        """
+        returns the connection of the current session's transaction on
+        the primary, for writes
+        """
+        self.__pin()
+        return self.__session.connection()
+
+    def engine(self, replica=None):
+        """
+        returns the primary engine, or the engine of the replica at index
+        replica, creating it on first use
+        """
+        if replica is not None:
+            if self.__replica_engines[replica] is None:
+                with self.__lock:
+                    if self.__replica_engines[replica] is None:
+                        self.__replica_engines[replica] = \
+                            self.__create_engine(self.replica_urls[replica],
+                                                 self.__replica_stats[replica])
+            return self.__replica_engines[replica]
+        if self.__engine is None:
+            with self.__lock:
+                if self.__engine is None:
+                    self.__engine = self.__create_engine(self.url,
+                                                         self.__pool_stats)
+        return self.__engine
+
+    def __create_engine(self, url, stats):
+        """creates an engine with the configured, instrumented pool"""
+        url = make_url(url)
+        if url.get_backend_name() == "sqlite" and \
+                url.database in (None, "", ":memory:"):
+            # An in-memory database lives in its single connection
+            engine = create_engine(url)
+        else:
+            engine = create_engine(url, poolclass=InstrumentedQueuePool,
+                                   **self.pool_options)
+            engine.pool.stats = stats
+        stats.listen(engine)
+        return engine
+
+    def pool_stats(self, replica=None):
+        """
+        Returns the connection pool's counters since the last reset
+        (connects, checkouts, checkins, invalidations, timeouts, total,
+        average and longest checkout wait, peak connections in use) and
+        its current state (size, idle, in_use, overflow, timeout), for the
+        primary or the replica at index replica.
+        """
+        stats = self.__pool_stats if replica is None \
+            else self.__replica_stats[replica]
+        return stats.snapshot(self.engine(replica).pool)
+
+    def reset_pool_stats(self):
+        """sets the counters of every connection pool back to zero"""
+        for stats in [self.__pool_stats] + self.__replica_stats:
+            stats.reset()
 
     def delete(self, obj=None):
         """delete from the current database session obj if not None"""
         if obj is not None:
+            self.__pin()
             self.__session.delete(obj)
 
     def reload(self):
-        """reloads data from the database"""
-        Base.metadata.create_all(self.__engine)
-        sess_factory = sessionmaker(bind=self.__engine, expire_on_commit=False)
-        Session = scoped_session(sess_factory)
-        self.__session = Session
+        """
+        discards every thread's session; the next use opens a new one,
+        connecting and checking the schema first if this is the first
+        """
+        if self.__session is not None:
+            self.__session.remove()
+            self.__replica_session.remove()
+        self.__session = scoped_session(self.__new_session)
+        self.__replica_session = scoped_session(self.__new_replica_session)
+
+    def __new_session(self):
+        """opens a session on the engine, for scoped_session"""
+        engine = self.engine()
+        if not self.__schema_checked:
+            self.check_schema()
+        return Session(bind=engine, expire_on_commit=False)
+
+    def __new_replica_session(self):
+        """opens a session on the next replica, for scoped_session"""
+        replica = next(self.__next_replica) % len(self.replica_urls)
+        return Session(bind=self.engine(replica), expire_on_commit=False)
+
+    def check_schema(self):
+        """
+        Compares the database's migration version with the latest one.
+        A database that is behind is reported, and refused outright when
+        env is "production".
+        """
+        from models.migrations import current_version, migrations
+        current, latest = current_version(self.engine()), migrations[-1][0]
+        self.__schema_checked = True
+        if current >= latest:
+            return
+        message = ("database schema is at version {}, expected {}; run "
+                   "python manage.py migrate".format(current, latest))
+        if self.env == "production":
+            self.__schema_checked = False
+            raise RuntimeError(message)
+        logger.warning(message)
+
+    def create_schema(self):
+        """
+        creates every table and index, recording the database as migrated
+        to the latest version
+        """
+        from models.migrations import stamp
+        Base.metadata.create_all(self.engine())
+        stamp(self.engine())
+
+    def drop_schema(self):
+        """drops every table, unless env is production"""
+        if self.env == "production":
+            raise RuntimeError("refusing to drop the production schema")
+        import models.migrations  # registers schema_migrations
+        self.close()
+        Base.metadata.drop_all(self.engine())
+        self.__schema_checked = False
 
     def close(self):
-        """call remove() method on the private session attribute"""
+        """
+        call remove() method on the private session attributes, ending
+        this thread's replica routing and primary pinning
+        """
         self.__session.remove()
+        self.__replica_session.remove()
+        self.__route.replica = 0
+        self.__route.pinned = False
+
+    @contextmanager
+    def replica(self):
+        """
+        Routes the reads made in the block to a read replica, unless this
+        thread has written since its session began: its reads then stay
+        on the primary so it sees its own writes. Objects read from a
+        replica are read-only copies; changes to them are not saved.
+        Without configured replicas the block reads the primary.
+        """
+        self.__route.replica = getattr(self.__route, "replica", 0) + 1
+        try:
+            yield self
+        finally:
+            self.__route.replica -= 1
+
+    @contextmanager
+    def primary(self):
+        """routes the reads made in the block to the primary"""
+        depth = getattr(self.__route, "replica", 0)
+        self.__route.replica = 0
+        try:
+            yield self
+        finally:
+            self.__route.replica = depth
+
+    def route_reads(self):
+        """routes this thread's reads to a replica until close()"""
+        self.__route.replica = getattr(self.__route, "replica", 0) + 1
+
+    def __pin(self):
+        """keeps this thread's reads on the primary until close()"""
+        self.__route.pinned = True
+
+    def _reader(self):
+        """returns the session this thread's reads are routed to"""
+        if self.replica_urls and getattr(self.__route, "replica", 0) and \
+                not getattr(self.__route, "pinned", False) and \
+                not getattr(self.__work, "depth", 0):
+            return self.__replica_session
+        return self.__session
+
+    def session_info(self):
+        """
+        returns the info dict of the current session, for state that lives
+        as long as its transaction
+        """
+        return self.__session.info
+
+    def read_connection(self):
+        """returns the connection of the session reads are routed to"""
+        return self._reader().connection()
 
     def get(self, cls, id):
         """
         Returns the object based on the class name and its ID, or
         None if not found
         """
-        if cls not in classes.values():
+        if cls not in registry.values() or id is None:
             return None
 
-        all_cls = models.storage.all(cls)
-        for value in all_cls.values():
-            if (value.id == id):
-                return value
+        # Session.get checks the identity map first and only falls back to
+        # a primary key SELECT when the object is not already loaded.
+        return self._reader().get(cls, id)
+
+    def get_many(self, cls, ids):
+        """
+        Returns a dict of id -> object for every id in ids that exists,
+        loaded with one primary key IN query per batch
+        """
+        found = {}
+        if cls not in registry.values():
+            return found
+
+        session = self._reader()
+        missing = []
+        for id in dict.fromkeys(ids):
+            if id is None:
+                continue
+            obj = session.identity_map.get(session.identity_key(cls, id))
+            if obj is not None:
+                found[id] = obj
+            else:
+                missing.append(id)
+
+        for i in range(0, len(missing), GET_MANY_BATCH_SIZE):
+            batch = missing[i:i + GET_MANY_BATCH_SIZE]
+            for obj in session.query(cls).filter(cls.id.in_(batch)):
+                found[obj.id] = obj
+
+        return found
 
-        return None
+    def _column(self, cls, name):
+        """returns the mapped column attribute name of cls"""
+        column = getattr(cls, name, None)
+        if column is None or not hasattr(column, "expression"):
+            raise AttributeError("{} has no column {}".format(cls.__name__,
+                                                              name))
+        return column
 
-    def count(self, cls=None):
+    def _query(self, cls, criteria, *entities, primary=False):
         """
-        count the number of objects in storage
+        Builds a query over cls (or the given entities) restricted by
+        criteria. Keys are column names with an optional operator suffix
+        (status=..., created_at__gte=...) and may traverse one relationship
+        (consignment__destination_address=...). The query reads from the
+        session reads are routed to, or from the primary when primary is set.
         """
-        all_class = classes.values()
+        session = self.__session if primary else self._reader()
+        query = session.query(*(entities or (cls,))).select_from(cls)
+        joined = set()
+        for key, value in criteria.items():
+            parts = key.split("__")
+            op = "eq"
+            if len(parts) > 1 and parts[-1] in operators:
+                op = parts.pop()
+            if op == "eq" and isinstance(value, (list, tuple, set)):
+                op = "in"
+            target = cls
+            if len(parts) == 2:
+                relationship = self._column(cls, parts[0])
+                target = relationship.property.mapper.class_
+                if parts[0] not in joined:
+                    query = query.join(relationship)
+                    joined.add(parts[0])
+            elif len(parts) != 1:
+                raise ValueError("Unsupported criteria: {}".format(key))
+            query = query.filter(operators[op](self._column(target,
+                                                            parts[-1]),
+                                               value))
+        return query
 
-        if not cls:
-            count = 0
-            for clas in all_class:
-                count += len(models.storage.all(clas).values())
-        else:
-            count = len(models.storage.all(cls).values())
+    def _lock(self, query, for_update):
+        """
+        Adds SELECT ... FOR UPDATE SKIP LOCKED to query when for_update is
+        set, so concurrent transactions claim disjoint rows. Dialects
+        without row locks (SQLite) render a plain SELECT; writers there
+        are serialized by the database lock and the version counters on
+        the mapped classes.
+        """
+        if for_update:
+            query = query.with_for_update(skip_locked=True)
+        return query
+
+    def filter(self, cls, order_by=None, limit=None, for_update=False,
+               **criteria):
+        """
+        returns the list of cls objects matching criteria, locking them
+        for the current transaction when for_update is set
+        """
+        query = self._lock(self._query(cls, criteria, primary=for_update),
+                           for_update)
+        if order_by is not None:
+            if isinstance(order_by, str):
+                order_by = self._column(cls, order_by)
+            query = query.order_by(order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
 
-        return count
+    def _rows_query(self, cls, criteria, rows):
+        """
+        returns the query for cls objects matching criteria, or for plain
+        result rows of its table's columns, in table order, when rows is set
+        """
+        if rows:
+            return self._query(cls, criteria, *cls.__table__.columns)
+        return self._query(cls, criteria)
+
+    def page(self, cls, limit, after=None, rows=False, **criteria):
+        """
+        returns up to limit cls objects matching criteria in (created_at, id)
+        order, starting after the (created_at, id) key given in after. The
+        keyset condition seeks straight into the (created_at, id) index, so
+        every page costs the same however deep it is. With rows=True plain
+        result rows are returned and no ORM instances are built
+        """
+        query = self._rows_query(cls, criteria, rows)
+        if after is not None:
+            created_at, id = after
+            query = query.filter(or_(cls.created_at > created_at,
+                                     and_(cls.created_at == created_at,
+                                          cls.id > id)))
+        return query.order_by(cls.created_at, cls.id).limit(limit).all()
+
+    def stream(self, cls, batch_size=1000, rows=False, **criteria):
+        """
+        yields every cls object (or plain row, with rows=True) matching
+        criteria in (created_at, id) order, fetching batch_size rows at a
+        time through a server-side cursor (yield_per) instead of loading
+        the whole result up front
+        """
+        query = self._rows_query(cls, criteria, rows)
+        query = query.order_by(cls.created_at, cls.id)
+        for obj in query.yield_per(batch_size):
+            yield obj
+
+    def first(self, cls, for_update=False, **criteria):
+        """returns one cls object matching criteria, or None"""
+        return self._lock(self._query(cls, criteria, primary=for_update),
+                          for_update).first()
+
+    def exists(self, cls, **criteria):
+        """returns True if at least one cls object matches criteria"""
+        query = self._query(cls, criteria)
+        return query.session.query(query.exists()).scalar()
+
+    def aggregate(self, cls, function, column="id", group_by=None,
+                  **criteria):
+        """
+        Computes function (sum, count, avg, min or max) of column over the
+        cls rows matching criteria. Without group_by a single value is
+        returned; with group_by (a column name or a list of them) a dict
+        maps each group value, or tuple of values, to its result.
+        column may also be a list, in which case every result above is a
+        tuple with one value per column, all computed in one query.
+        """
+        columns = column if isinstance(column, list) else [column]
+        results = [aggregates[function](self._column(cls, c)
+                                        if isinstance(c, str) else c)
+                   for c in columns]
+        width = len(results)
+        if group_by is None:
+            row = self._query(cls, criteria, *results).one()
+            return tuple(row) if isinstance(column, list) else row[0]
+
+        names = [group_by] if isinstance(group_by, str) else list(group_by)
+        keys = [self._column(cls, name) for name in names]
+        query = self._query(cls, criteria, *keys, *results).group_by(*keys)
+        groups = {}
+        for row in query:
+            key = row[0] if len(keys) == 1 else tuple(row[:-width])
+            groups[key] = tuple(row[-width:]) \
+                if isinstance(column, list) else row[-1]
+        return groups
+
+    def percentiles(self, cls, column, fractions, **criteria):
+        """
+        Returns the nearest-rank percentiles of column over the cls rows
+        matching criteria, one value per fraction in fractions (0.5 for
+        the median), or None for each when no row has a value. Each one is
+        a single row read by the database at its offset, counted from the
+        nearer end, so an index ending in column reads at most half of
+        the matching entries per percentile.
+        """
+        target = self._column(cls, column)
+        total = self._query(cls, criteria, func.count(target)).scalar()
+        if not total:
+            return [None] * len(fractions)
+        ranks = [min(total, max(1, math.ceil(fraction * total)))
+                 for fraction in fractions]
+        query = self._query(cls, criteria, target).filter(target.isnot(None))
+        found = {}
+        for rank in sorted(set(ranks)):
+            if rank > total // 2:
+                ordered = query.order_by(target.desc()).offset(total - rank)
+            else:
+                ordered = query.order_by(target).offset(rank - 1)
+            found[rank] = ordered.limit(1).scalar()
+        return [found[rank] for rank in ranks]
+
+    def count(self, cls=None, approximate=False, **criteria):
+        """
+        count the number of objects in storage, optionally restricted to
+        the rows of cls matching criteria. With approximate=True, large
+        tables are counted from the database's table statistics instead
+        of a full COUNT(*)
+        """
+        if cls is None:
+            if criteria:
+                raise ValueError("count criteria require a class")
+            return sum(self.count(clss, approximate)
+                       for clss in classes.values())
+
+        cls = registry.get(cls, cls)
+        if cls not in registry.values():
+            return 0
+
+        if approximate and not criteria:
+            estimate = self._estimated_count(cls)
+            if estimate is not None and estimate >= APPROXIMATE_COUNT_MIN:
+                return estimate
+
+        return self.aggregate(cls, "count", **criteria)
+
+    def _estimated_count(self, cls):
+        """
+        returns the row estimate the database keeps for the table of cls,
+        or None when the backend does not expose one
+        """
+        session = self._reader()
+        if session.get_bind().dialect.name != "mysql":
+            return None
+        return session.execute(
+            text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                 "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name"),
+            {"name": cls.__tablename__}).scalar()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+Contains the connection pool instrumentation behind DBStorage.pool_stats.
+
+InstrumentedQueuePool times every checkout, including any wait for a free
+connection and the pre-ping, and PoolStats counts the pool's connect,
+checkout, checkin and invalidate events, so pool sizes can be tuned from
+what each worker actually does.
+"""
+
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+    """Thread-safe counters of one engine's pool"""
+
+    def __init__(self):
+        """starts with every counter at zero"""
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """sets every counter back to zero"""
+        with self.__lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.peak_in_use = 0
+
+    def record_wait(self, seconds, timed_out=False):
+        """records how long one checkout took"""
+        with self.__lock:
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def listen(self, engine):
+        """counts the pool events of engine"""
+        event.listen(engine, "connect", self.__on_connect)
+        event.listen(engine, "checkout", self.__on_checkout)
+        event.listen(engine, "checkin", self.__on_checkin)
+        event.listen(engine, "invalidate", self.__on_invalidate)
+
+    def __on_connect(self, dbapi_connection, connection_record):
+        with self.__lock:
+            self.connects += 1
+
+    def __on_checkout(self, dbapi_connection, connection_record,
+                      connection_proxy):
+        with self.__lock:
+            self.checkouts += 1
+            self.peak_in_use = max(self.peak_in_use,
+                                   self.checkouts - self.checkins)
+
+    def __on_checkin(self, dbapi_connection, connection_record):
+        with self.__lock:
+            self.checkins += 1
+
+    def __on_invalidate(self, dbapi_connection, connection_record,
+                        exception):
+        with self.__lock:
+            self.invalidations += 1
+
+    def snapshot(self, pool):
+        """returns the counters, and the pool's current state, as a dict"""
+        with self.__lock:
+            stats = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+                "avg_wait_seconds": self.wait_seconds / self.checkouts
+                if self.checkouts else 0.0,
+                "in_use": self.checkouts - self.checkins,
+                "peak_in_use": self.peak_in_use,
+            }
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(), idle=pool.checkedin(),
+                         in_use=pool.checkedout(),
+                         overflow=max(pool.overflow(), 0),
+                         timeout=pool.timeout())
+        return stats
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that reports how long each checkout took to its stats"""
+    stats = None
+
+    def connect(self):
+        """checks out a connection, timing the wait"""
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super().connect()
+        except PoolTimeout:
+            timed_out = True
+            raise
+        finally:
+            if self.stats is not None:
+                self.stats.record_wait(time.perf_counter() - start,
+                                       timed_out)
+
+    def recreate(self):
+        """keeps reporting to the same stats after engine.dispose()"""
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+"""
+Maintains the lane backlog: the pending volume and consignment count per
+(origin_branch_id, destination_address) lane.
+
+Every flush that creates, deletes or changes a consignment applies the
+matching deltas to lane_backlogs on the same connection, so the running
+totals commit or roll back together with the consignments themselves.
+Lanes whose pending volume grew also get a lane_events row, which the
+dispatch worker (models.dispatcher) consumes. So do the lanes of a branch
+that reached DISPATCH_THRESHOLD when a truck becomes available there,
+since they may have been waiting for one.
+"""
+
+from datetime import datetime
+import uuid
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+from models.tables import Consignment, ConsignmentStatus, LaneBacklog
+from models.tables import LaneEvent, Truck, TruckStatus
+
+# Pending volume (m³) on a lane that triggers a dispatch
+DISPATCH_THRESHOLD = 500
+
+# Consignment attributes that decide which lane, if any, it counts towards
+tracked = ("status", "volume_cubic_meters", "origin_branch_id",
+           "destination_address")
+
+
+def is_pending(status):
+    """returns True if a consignment with status counts towards its lane"""
+    return status in (None, ConsignmentStatus.AWAITING_DISPATCH)
+
+
+def add_delta(deltas, branch_id, destination, volume, count):
+    """accumulates a (volume, count) change for a lane into deltas"""
+    key = (branch_id, destination)
+    old_volume, old_count = deltas.get(key, (0.0, 0))
+    deltas[key] = (old_volume + volume, old_count + count)
+
+
+def upsert(connection, table, key, insert, update):
+    """
+    Applies update to the table row matching the key columns, or inserts
+    it with the key and insert values when there is no such row yet.
+    The key columns must carry a unique constraint.
+    """
+    now = datetime.utcnow()
+    update = dict(update, updated_at=now)
+    if connection.dialect.name == "mysql":
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        stmt = mysql_insert(table).values(
+            id=str(uuid.uuid4()), created_at=now, updated_at=now,
+            **key, **insert)
+        connection.execute(stmt.on_duplicate_key_update(**update))
+        return
+    stmt = table.update()
+    for name, value in key.items():
+        stmt = stmt.where(table.c[name] == value)
+    if connection.execute(stmt.values(**update)).rowcount == 0:
+        connection.execute(table.insert().values(
+            id=str(uuid.uuid4()), created_at=now, updated_at=now,
+            **key, **insert))
+
+
+def expire_rows(session, cls, key, keys):
+    """
+    Expires the cls rows loaded in session whose key(row) is in keys, so
+    they are re-read on next access: the flush listeners change running
+    totals with Core statements, behind the ORM's back.
+    """
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, cls) and key(obj) in keys:
+            session.expire(obj)
+
+
+def reconcile(storage, cls, key, key_columns, columns, expected,
+              repair=True):
+    """
+    Compares the cls rows of running totals with expected, which maps each
+    key, a tuple of the key_columns, to the tuple of columns recomputed
+    from the rows they summarize; key(row) gives a loaded row's key.
+    Returns the keys that drifted; with repair=True those rows are
+    corrected and the missing ones created. Run it while writes are
+    quiet; concurrent ones may be overwritten.
+    """
+    expected = dict(expected)
+    drifted = []
+    for obj in storage.all(cls).values():
+        row_key = key(obj)
+        values = expected.pop(row_key, (0,) * len(columns))
+        if any(abs(getattr(obj, name) - value) > 1e-6
+               for name, value in zip(columns, values)):
+            drifted.append(row_key)
+            if repair:
+                for name, value in zip(columns, values):
+                    setattr(obj, name, value)
+    for row_key, values in expected.items():
+        drifted.append(row_key)
+        if repair:
+            storage.new(cls(**dict(zip(key_columns, row_key)),
+                            **dict(zip(columns, values))))
+    if repair:
+        storage.save()
+    else:
+        storage.rollback()
+    return drifted
+
+
+def _lane_key(lane):
+    """returns the (origin_branch_id, destination_address) of a lane row"""
+    return (lane.origin_branch_id, lane.destination_address)
+
+
+def _upsert_lane(connection, table, branch_id, destination, insert, update):
+    """upserts the table row of a lane"""
+    upsert(connection, table, dict(origin_branch_id=branch_id,
+                                   destination_address=destination),
+           insert, update)
+
+
+def apply_lane_deltas(connection, deltas):
+    """
+    Adds each lane's (volume, count) delta to lane_backlogs with atomic
+    UPDATE ... SET col = col + delta statements, creating missing lanes
+    """
+    table = LaneBacklog.__table__
+    for (branch_id, destination), (volume, count) in deltas.items():
+        if not volume and not count:
+            continue
+        _upsert_lane(connection, table, branch_id, destination,
+                     dict(pending_volume=volume, pending_count=count),
+                     dict(pending_volume=table.c.pending_volume + volume,
+                          pending_count=table.c.pending_count + count))
+
+
+def enqueue_lane_events(connection, lanes):
+    """
+    Queues a lane event for each (branch_id, destination) in lanes.
+    A lane that is already queued keeps a single row, and its place in
+    the queue (created_at), so repeated changes coalesce into one
+    dispatch evaluation.
+    """
+    table = LaneEvent.__table__
+    for branch_id, destination in lanes:
+        _upsert_lane(connection, table, branch_id, destination, {}, {})
+
+
+def enqueue_ready_lanes(connection, branch_ids, threshold=DISPATCH_THRESHOLD):
+    """queues the lanes of branch_ids whose pending volume reached threshold"""
+    if not branch_ids:
+        return
+    table = LaneBacklog.__table__
+    rows = connection.execute(
+        select(table.c.origin_branch_id, table.c.destination_address)
+        .where(table.c.origin_branch_id.in_(list(branch_ids)))
+        .where(table.c.pending_volume >= threshold))
+    enqueue_lane_events(connection, [tuple(row) for row in rows])
+
+
+def _previous(state, name):
+    """returns the value an attribute had before the pending flush"""
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.obj(), name)
+
+
+@event.listens_for(Session, "after_flush")
+def record_lane_changes(session, flush_context):
+    """applies the lane deltas of the consignments written by a flush"""
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Consignment) and is_pending(obj.status):
+            add_delta(deltas, obj.origin_branch_id, obj.destination_address,
+                      obj.volume_cubic_meters, 1)
+
+    for obj in session.dirty:
+        if not isinstance(obj, Consignment):
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[name].history.has_changes()
+                   for name in tracked):
+            continue
+        if is_pending(_previous(state, "status")):
+            add_delta(deltas, _previous(state, "origin_branch_id"),
+                      _previous(state, "destination_address"),
+                      -_previous(state, "volume_cubic_meters"), -1)
+        if is_pending(obj.status):
+            add_delta(deltas, obj.origin_branch_id, obj.destination_address,
+                      obj.volume_cubic_meters, 1)
+
+    for obj in session.deleted:
+        if isinstance(obj, Consignment) and \
+                is_pending(_previous(inspect(obj), "status")):
+            state = inspect(obj)
+            add_delta(deltas, _previous(state, "origin_branch_id"),
+                      _previous(state, "destination_address"),
+                      -_previous(state, "volume_cubic_meters"), -1)
+
+    if not deltas:
+        return
+    connection = session.connection()
+    apply_lane_deltas(connection, deltas)
+    enqueue_lane_events(connection, [lane for lane, (volume, count)
+                                     in deltas.items() if volume > 0])
+
+    expire_rows(session, LaneBacklog, _lane_key, deltas)
+
+
+@event.listens_for(Session, "after_flush")
+def wake_branches(session, flush_context):
+    """queues the ready lanes of the branches where a truck became available"""
+    branches = set()
+    for obj in session.new | session.dirty:
+        if not isinstance(obj, Truck) or \
+                obj.status != TruckStatus.AVAILABLE or \
+                obj.current_branch_id is None:
+            continue
+        state = inspect(obj)
+        if obj in session.new or state.attrs.status.history.has_changes() or \
+                state.attrs.current_branch_id.history.has_changes():
+            branches.add(obj.current_branch_id)
+    enqueue_ready_lanes(session.connection(), branches)
+
+
+def pending_volume(storage, branch_id, destination):
+    """returns the volume awaiting dispatch on a lane"""
+    lane = storage.first(LaneBacklog, origin_branch_id=branch_id,
+                         destination_address=destination)
+    return lane.pending_volume if lane else 0.0
+
+
+def expected_lanes(connection):
+    """
+    returns {(branch_id, destination): (volume, count)} of every lane with
+    consignments awaiting dispatch, computed from the consignments table
+    """
+    consignments = Consignment.__table__
+    query = select(consignments.c.origin_branch_id,
+                   consignments.c.destination_address,
+                   func.sum(consignments.c.volume_cubic_meters),
+                   func.count(consignments.c.id)) \
+        .where(consignments.c.status ==
+               ConsignmentStatus.AWAITING_DISPATCH) \
+        .group_by(consignments.c.origin_branch_id,
+                  consignments.c.destination_address)
+    return {(row[0], row[1]): (row[2] or 0.0, row[3])
+            for row in connection.execute(query)}
+
+
+def rebuild_lane_backlog(storage):
+    """
+    Recomputes every lane from the consignments table and repairs the
+    rows that drifted. Returns the list of lanes that were corrected.
+    Run it while intake is quiet; concurrent writes may be overwritten.
+    """
+    return reconcile(storage, LaneBacklog, _lane_key,
+                     ("origin_branch_id", "destination_address"),
+                     ("pending_volume", "pending_count"),
+                     expected_lanes(storage.connection()))
@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+"""
+Versioned schema migrations.
+
+Each migration is a numbered function applied once, in order, and
+recorded in schema_migrations; `python manage.py migrate` brings a
+database up to the latest version. Migrations check the live schema
+before changing it, so they are safe on a database that create_all
+already built. Any change to models/tables.py that touches an existing
+table needs a new migration at the end of the list.
+
+Tables kept up to date by the flush listeners (lane backlogs, destination
+stats, truck usage, the truck status log) and the columns stamped on
+status changes start empty on a database that predates them; the
+backfill migrations derive them from the rows they summarize, so an
+upgraded database answers like one that always had them.
+
+hot_queries declares the predicates the request and dispatch paths rely
+on; check_indexes reports those that no index of a schema serves, and
+`python manage.py check-indexes` fails on them.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, String, Table, inspect
+from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint
+from sqlalchemy import bindparam, select
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from models.base_model import Base
+from models.lanes import apply_lane_deltas, enqueue_lane_events
+from models.lanes import expected_lanes
+from models.stats import apply_stat_deltas, expected_stats
+from models.tables import User, Branch, Truck, Consignment, Invoice, Dispatch
+from models.tables import DestinationStat, LaneBacklog, TableVersion
+from models.tables import TruckStatusEvent, TruckUsage
+from models.truck_status import status_event, totals
+from models.truck_usage import apply_usage_deltas, expected_usage
+
+schema_migrations = Table(
+    "schema_migrations", Base.metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False))
+
+HotQuery = namedtuple("HotQuery", ["table", "columns", "description"])
+
+# Predicates (and the column read in order after them) that must be
+# answered from an index; an index covers one when its leading columns are
+# exactly these, in any order
+hot_queries = [
+    HotQuery("consignments",
+             ("origin_branch_id", "destination_address", "status"),
+             "pending consignments of a lane, claimed by the dispatcher"),
+    HotQuery("consignments", ("dispatch_id",),
+             "consignments of a dispatch"),
+    HotQuery("dispatches", ("truck_id", "created_at"),
+             "dispatches of a truck over a period"),
+    HotQuery("trucks", ("current_branch_id", "status"),
+             "available trucks at a branch, claimed by the dispatcher"),
+    HotQuery("invoices", ("consignment_id",),
+             "invoice of a consignment"),
+    HotQuery("table_versions", ("table_name",),
+             "change counter of a table, read by every conditional GET"),
+    HotQuery("consignments",
+             ("origin_branch_id", "destination_address", "wait_seconds"),
+             "wait time percentiles of a lane"),
+    HotQuery("consignments", ("dispatched_at", "wait_seconds"),
+             "wait time percentiles over a time window"),
+]
+
+# Tables listed page by page in (created_at, id) order
+paginated_classes = (User, Branch, Truck, Consignment, Invoice, Dispatch)
+hot_queries += [HotQuery(cls.__tablename__, ("created_at", "id"),
+                         "keyset pagination of the {} list".format(
+                             cls.__tablename__))
+                for cls in paginated_classes]
+
+
+def _index(cls, name):
+    """returns the Index called name declared on cls's table"""
+    for index in cls.__table__.indexes:
+        if index.name == name:
+            return index
+    raise KeyError(name)
+
+
+def _create_index(connection, index):
+    """
+    Creates index unless the table already has one by that name. MySQL
+    builds it in place without locking the table, so writes continue.
+    """
+    names = {i["name"] for i in inspect(connection).get_indexes(
+        index.table.name)}
+    if index.name in names:
+        return
+    ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+    if connection.dialect.name == "mysql":
+        ddl += " ALGORITHM=INPLACE LOCK=NONE"
+    connection.exec_driver_sql(ddl)
+
+
+def _add_columns(connection, cls, *names):
+    """
+    adds the named columns of cls to its table unless present; existing
+    rows of a NOT NULL column get its Python-side default
+    """
+    table = cls.__table__
+    present = {c["name"] for c in inspect(connection).get_columns(
+        table.name)}
+    for name in names:
+        if name in present:
+            continue
+        column = table.c[name]
+        spec = str(CreateColumn(column).compile(dialect=connection.dialect))
+        if not column.nullable and column.server_default is None and \
+                column.default is not None and column.default.is_scalar:
+            spec += " DEFAULT {!r}".format(column.default.arg)
+        connection.exec_driver_sql("ALTER TABLE {} ADD COLUMN {}".format(
+            table.name, spec))
+
+
+def _baseline(connection):
+    """creates the tables missing from the database"""
+    Base.metadata.create_all(connection, checkfirst=True)
+
+
+def _transition_timestamps(connection):
+    """adds the consignment status transition columns and indexes"""
+    _add_columns(connection, Consignment, "dispatched_at", "delivered_at",
+                 "wait_seconds")
+    _create_index(connection, _index(Consignment,
+                                     "ix_consignments_dispatched_at"))
+    _create_index(connection, _index(Consignment,
+                                     "ix_consignments_lane_dispatched_at"))
+
+
+def _truck_status_totals(connection):
+    """adds the truck running status totals"""
+    _add_columns(connection, Truck, "status_since", "available_seconds",
+                 "in_transit_seconds", "idle_seconds")
+
+
+def _hot_path_indexes(connection):
+    """adds the indexes of the hot queries"""
+    _create_index(connection, _index(Consignment,
+                                     "ix_consignments_lane_status"))
+    _create_index(connection, _index(Consignment,
+                                     "ix_consignments_dispatch_id"))
+    _create_index(connection, _index(Dispatch,
+                                     "ix_dispatches_truck_id_created_at"))
+    _create_index(connection, _index(Truck, "ix_trucks_branch_status"))
+
+
+def _table_versions(connection):
+    """creates the table change counters"""
+    TableVersion.__table__.create(connection, checkfirst=True)
+
+
+def _version_counters(connection):
+    """adds the optimistic locking counters of trucks and consignments"""
+    _add_columns(connection, Truck, "version_id")
+    _add_columns(connection, Consignment, "version_id")
+
+
+def _keyset_indexes(connection):
+    """adds the (created_at, id) indexes of the paginated tables"""
+    for cls in paginated_classes:
+        _create_index(connection, _index(
+            cls, "ix_{}_created_at_id".format(cls.__tablename__)))
+
+
+def _dispatch_timestamps(connection):
+    """
+    stamps dispatched_at and wait_seconds on the consignments dispatched
+    before they were recorded, from the creation time of their dispatch
+    """
+    consignments = Consignment.__table__
+    dispatches = Dispatch.__table__
+    query = select(consignments.c.id, consignments.c.created_at,
+                   dispatches.c.created_at) \
+        .select_from(consignments.join(
+            dispatches, dispatches.c.id == consignments.c.dispatch_id)) \
+        .where(consignments.c.dispatched_at.is_(None))
+    rows = [dict(b_id=id, b_dispatched_at=dispatched_at,
+                 b_wait_seconds=None if created_at is None or
+                 dispatched_at is None else
+                 max((dispatched_at - created_at).total_seconds(), 0.0))
+            for id, created_at, dispatched_at in connection.execute(query)]
+    if rows:
+        connection.execute(
+            consignments.update()
+            .where(consignments.c.id == bindparam("b_id"))
+            .values(dispatched_at=bindparam("b_dispatched_at"),
+                    wait_seconds=bindparam("b_wait_seconds")), rows)
+
+
+def _truck_status_log(connection):
+    """
+    starts the status log of the trucks that have none, in their current
+    status since their last update; time spent before that is unknown
+    and left out of their totals
+    """
+    trucks = Truck.__table__
+    events = TruckStatusEvent.__table__
+    now = datetime.utcnow()
+    rows = connection.execute(
+        select(trucks).where(trucks.c.id.not_in(select(events.c.truck_id))))
+    started, logged = [], []
+    for truck in rows:
+        since = truck.status_since or truck.updated_at or \
+            truck.created_at or now
+        started.append(dict(b_id=truck.id, b_since=since))
+        logged.append(status_event(truck.id, truck.status, since, {
+            name: getattr(truck, name) or 0.0 for name in totals}))
+    if started:
+        connection.execute(trucks.update()
+                           .where(trucks.c.id == bindparam("b_id"))
+                           .values(status_since=bindparam("b_since")),
+                           started)
+        connection.execute(events.insert(), logged)
+
+
+def _derived_tables(connection):
+    """
+    rebuilds the lane backlogs, destination stats and truck usage from
+    the consignments, invoices and dispatches, and queues every lane with
+    a backlog for the dispatch worker
+    """
+    lanes = expected_lanes(connection)
+    connection.execute(LaneBacklog.__table__.delete())
+    apply_lane_deltas(connection, lanes)
+    enqueue_lane_events(connection, lanes)
+    stats = expected_stats(connection)
+    connection.execute(DestinationStat.__table__.delete())
+    apply_stat_deltas(connection, stats)
+    usage = expected_usage(connection)
+    connection.execute(TruckUsage.__table__.delete())
+    apply_usage_deltas(connection, usage)
+
+
+def _percentile_indexes(connection):
+    """adds the index the wait time percentiles of a lane are read from"""
+    _create_index(connection, _index(Consignment, "ix_consignments_lane_wait"))
+
+
+migrations = [
+    (1, "baseline schema", _baseline),
+    (2, "consignment status transition timestamps", _transition_timestamps),
+    (3, "truck running status totals", _truck_status_totals),
+    (4, "hot path indexes", _hot_path_indexes),
+    (5, "table change counters", _table_versions),
+    (6, "truck and consignment version counters", _version_counters),
+    (7, "keyset pagination indexes", _keyset_indexes),
+    (8, "dispatch timestamps of earlier consignments", _dispatch_timestamps),
+    (9, "status log of earlier trucks", _truck_status_log),
+    (10, "lane backlog, destination stats and truck usage backfill",
+     _derived_tables),
+    (11, "wait time percentile indexes", _percentile_indexes),
+]
+
+
+def current_version(engine):
+    """returns the latest migration applied to the database, 0 if none"""
+    with engine.connect() as connection:
+        if not inspect(connection).has_table(schema_migrations.name):
+            return 0
+        versions = [row[0] for row in connection.execute(
+            schema_migrations.select())]
+    return max(versions, default=0)
+
+
+def upgrade(engine, target=None):
+    """
+    Applies the migrations newer than the database's version, up to
+    target (the latest by default), each in its own transaction.
+    Returns the (version, description) pairs applied.
+    """
+    version = current_version(engine)
+    applied = []
+    for number, description, migrate in migrations:
+        if number <= version or (target is not None and number > target):
+            continue
+        with engine.begin() as connection:
+            schema_migrations.create(connection, checkfirst=True)
+            migrate(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=number, description=description,
+                applied_at=datetime.utcnow()))
+        applied.append((number, description))
+    return applied
+
+
+def stamp(engine):
+    """
+    records every migration as applied, for a database whose schema was
+    just created from the models
+    """
+    with engine.begin() as connection:
+        schema_migrations.create(connection, checkfirst=True)
+        applied = {row[0] for row in connection.execute(
+            schema_migrations.select())}
+        rows = [dict(version=number, description=description,
+                     applied_at=datetime.utcnow())
+                for number, description, _ in migrations
+                if number not in applied]
+        if rows:
+            connection.execute(schema_migrations.insert(), rows)
+
+
+def _indexed_columns(engine, table):
+    """returns the column lists of every index of a live table"""
+    inspector = inspect(engine)
+    columns = [index["column_names"]
+               for index in inspector.get_indexes(table)]
+    columns += [constraint["column_names"]
+                for constraint in inspector.get_unique_constraints(table)]
+    columns.append(inspector.get_pk_constraint(table)["constrained_columns"])
+    return columns
+
+
+def _declared_columns(table):
+    """returns the column lists of every index declared on a table"""
+    table = Base.metadata.tables[table]
+    columns = [[c.name for c in index.columns] for index in table.indexes]
+    columns += [[c.name for c in constraint.columns]
+                for constraint in table.constraints
+                if isinstance(constraint, (PrimaryKeyConstraint,
+                                           UniqueConstraint))]
+    columns += [[c.name] for c in table.columns if c.unique]
+    return columns
+
+
+def check_indexes(engine=None):
+    """
+    Returns the hot queries no index covers, in the database behind
+    engine, or in the models' declared schema when engine is None
+    """
+    missing = []
+    for query in hot_queries:
+        if engine is None:
+            indexes = _declared_columns(query.table)
+        else:
+            indexes = _indexed_columns(engine, query.table)
+        wanted = set(query.columns)
+        if not any(set(columns[:len(wanted)]) == wanted
+                   for columns in indexes):
+            missing.append(query)
+    return missing
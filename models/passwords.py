@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+"""
+Hashes and verifies passwords off the request thread.
+
+Password hashing is deliberately slow, and werkzeug's implementations
+hold the GIL while they run, so hashing in a request thread stalls every
+other request of the worker. PasswordHasher runs generate_password_hash
+and check_password_hash on a process pool of its own instead, so logins
+use every core and the request thread only waits.
+
+At most `workers + queue_size` jobs are accepted at once (`1 +
+queue_size` without workers); past that PasswordQueueFull is raised at
+once rather than letting a login storm queue without bound. The pool
+starts on first use, and is replaced when one of its processes dies, the
+job that found it broken being retried once on the new pool. Settings
+come from the arguments or the environment:
+
+    TCC_PASSWORD_WORKERS  processes (default: the number of cores;
+                          0 hashes in the calling threads)
+    TCC_PASSWORD_QUEUE    jobs that may wait for a process, or without
+                          workers, that may hash alongside the first
+                          (default: 4 per process, 4 without workers)
+    TCC_PASSWORD_METHOD   werkzeug hash method, with its work factor, e.g.
+                          scrypt:32768:8:1 or pbkdf2:sha256:1000000
+                          (default: werkzeug's)
+
+Existing hashes keep verifying after the method changes; each records the
+method and work factor it was made with.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import threading
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordQueueFull(Exception):
+    """Raised when more password jobs are pending than the queue holds"""
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords on a bounded process pool"""
+
+    def __init__(self, workers=None, queue_size=None, method=None):
+        """configures the hasher; the pool starts on first use"""
+        self.__lock = threading.Lock()
+        self.__pool = None
+        self.configure(workers, queue_size, method)
+
+    def configure(self, workers=None, queue_size=None, method=None):
+        """applies new settings, shutting the current pool down"""
+        if workers is None:
+            workers = int(os.getenv("TCC_PASSWORD_WORKERS",
+                                    os.cpu_count() or 1))
+        if queue_size is None:
+            queue_size = int(os.getenv("TCC_PASSWORD_QUEUE",
+                                       4 * max(workers, 1)))
+        self.shutdown()
+        self.workers = workers
+        self.queue_size = queue_size
+        self.method = method or os.getenv("TCC_PASSWORD_METHOD")
+        self.__slots = threading.BoundedSemaphore(max(workers, 1) +
+                                                  queue_size)
+
+    def shutdown(self):
+        """stops the pool's processes"""
+        with self.__lock:
+            pool, self.__pool = self.__pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def __executor(self):
+        """returns the process pool, starting it on first use"""
+        if self.__pool is None:
+            with self.__lock:
+                if self.__pool is None:
+                    # Forking a threaded server is unsafe; start clean
+                    self.__pool = ProcessPoolExecutor(
+                        self.workers,
+                        mp_context=multiprocessing.get_context("spawn"))
+        return self.__pool
+
+    def __discard(self, pool):
+        """drops a broken pool, unless another thread already replaced it"""
+        with self.__lock:
+            if self.__pool is pool:
+                self.__pool = None
+        pool.shutdown(wait=False)
+
+    def __run(self, fn, *args):
+        """runs fn on the pool, or inline without workers, and waits"""
+        if not self.__slots.acquire(blocking=False):
+            raise PasswordQueueFull("too many password jobs pending")
+        try:
+            if not self.workers:
+                return fn(*args)
+            pool = self.__executor()
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # A process died (e.g. killed for memory); start a new pool
+                self.__discard(pool)
+                return self.__executor().submit(fn, *args).result()
+        finally:
+            self.__slots.release()
+
+    def hash(self, password):
+        """returns the hash of password, made with the configured method"""
+        if self.method:
+            return self.__run(generate_password_hash, password, self.method)
+        return self.__run(generate_password_hash, password)
+
+    def verify(self, password_hash, password):
+        """tells whether password matches password_hash"""
+        return self.__run(check_password_hash, password_hash, password)
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+"""
+Capacity-aware dispatch planning.
+
+plan_dispatch packs a lane's pending consignments onto the available trucks
+with first-fit-decreasing: consignments are placed largest first into the
+first truck, largest trucks first, that still has room. A max segment tree
+over the trucks' remaining capacity finds that truck in O(log trucks), so a
+plan costs O(n log n) for n consignments. Loads are then moved onto the
+smallest unused truck that can still carry them, so big trucks are not
+tied up by small loads.
+"""
+
+from bisect import bisect_left
+from collections import namedtuple
+
+# Tolerance for float volumes that fill a truck exactly
+EPSILON = 1e-9
+
+Load = namedtuple("Load", ["truck", "consignments", "volume"])
+
+
+class _RemainingCapacity:
+    """max segment tree over the remaining capacity of each truck"""
+
+    def __init__(self, capacities):
+        self.size = 1
+        while self.size < len(capacities):
+            self.size *= 2
+        self.tree = [float("-inf")] * (2 * self.size)
+        self.tree[self.size:self.size + len(capacities)] = capacities
+        for i in range(self.size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+
+    def first_fit(self, volume):
+        """returns the index of the first truck with room for volume"""
+        tree = self.tree
+        if tree[1] + EPSILON < volume:
+            return None
+        i = 1
+        while i < self.size:
+            i *= 2
+            if tree[i] + EPSILON < volume:
+                i += 1
+        return i - self.size
+
+    def take(self, index, volume):
+        """reserves volume on the truck at index"""
+        i = index + self.size
+        self.tree[i] -= volume
+        i //= 2
+        while i:
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+            i //= 2
+
+
+def plan_dispatch(consignments, trucks, threshold=0.0, min_fill=0.0):
+    """
+    Packs consignments onto trucks without exceeding any truck's
+    capacity_cubic_meters. A load is only kept if it carries at least
+    min(threshold, min_fill * capacity) of volume, so near-empty trucks
+    are not sent out. Returns (loads, unassigned), where loads is a list
+    of Load(truck, consignments, volume) and unassigned the consignments
+    left waiting.
+    """
+    trucks = sorted(trucks, key=lambda t: t.capacity_cubic_meters,
+                    reverse=True)
+    items = sorted(consignments, key=lambda c: c.volume_cubic_meters,
+                   reverse=True)
+    remaining = _RemainingCapacity([t.capacity_cubic_meters for t in trucks])
+
+    packed = [[] for _ in trucks]
+    volumes = [0.0] * len(trucks)
+    unassigned = []
+    for consignment in items:
+        volume = consignment.volume_cubic_meters
+        index = remaining.first_fit(volume)
+        if index is None:
+            unassigned.append(consignment)
+            continue
+        remaining.take(index, volume)
+        packed[index].append(consignment)
+        volumes[index] += volume
+
+    used = [i for i in range(len(trucks)) if packed[i]]
+    assigned = {i: trucks[i] for i in used}
+
+    # Move each load, smallest first, onto the smallest idle truck that
+    # still holds it.
+    spare = sorted((trucks[i] for i in range(len(trucks)) if not packed[i]),
+                   key=lambda t: t.capacity_cubic_meters)
+    spare_capacity = [t.capacity_cubic_meters for t in spare]
+    for i in sorted(used, key=lambda i: volumes[i]):
+        j = bisect_left(spare_capacity, volumes[i] - EPSILON)
+        if j < len(spare) and \
+                spare_capacity[j] < assigned[i].capacity_cubic_meters:
+            smaller = spare.pop(j)
+            spare_capacity.pop(j)
+            k = bisect_left(spare_capacity, assigned[i].capacity_cubic_meters)
+            spare.insert(k, assigned[i])
+            spare_capacity.insert(k, assigned[i].capacity_cubic_meters)
+            assigned[i] = smaller
+
+    loads = []
+    for i in used:
+        truck = assigned[i]
+        minimum = min(threshold, min_fill * truck.capacity_cubic_meters)
+        if volumes[i] + EPSILON < minimum:
+            unassigned.extend(packed[i])
+            continue
+        loads.append(Load(truck, packed[i], volumes[i]))
+    return loads, unassigned
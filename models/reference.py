@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""
+Caches reference data: branches and trucks, read far more often than
+they change.
+
+ReferenceCache is read-through: a lookup that misses loads the value from
+the database and keeps it, already serialized. Every cached value is
+stamped with the version of its table in table_versions
+(models.versions), which is bumped right after every commit that writes
+a branch or a truck, whichever worker makes it. A lookup looks for the
+value under the current version, so none loaded before a write is served
+once the cache has seen the write's version. Versions are read, one
+primary-key lookup, at most once per `version_ttl` seconds per table, and
+again as soon as this process has committed a write: another worker's
+write is seen within version_ttl (1 second by default) of its commit,
+this process's own at once, and a conditional GET's at the version its
+ETag names. Lookups of rows that do not exist are not
+kept, and neither are values read by a transaction that wrote their
+table and has yet to commit.
+
+Values live in a CacheBackend. MemoryBackend keeps them in the process,
+at most `size` entries, least recently used evicted first, each for at
+most `ttl` seconds. A backend shared by the workers (memcached, Redis)
+only has to implement get, set and clear.
+
+    TCC_REFERENCE_CACHE_SIZE   entries kept per process (default 4096)
+    TCC_REFERENCE_CACHE_TTL    seconds each entry is kept (default 30)
+    TCC_REFERENCE_VERSION_TTL  seconds a table version is reused (default 1)
+"""
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import os
+import threading
+import time
+import models
+from models.tables import Branch, Truck
+from models.versions import local_generation, table_versions
+from models.versions import written_tables
+
+# Tables whose rows are cached
+cached_classes = (Branch, Truck)
+
+# Returned by CacheBackend.get for keys it does not hold
+MISSING = object()
+
+
+class CacheBackend(ABC):
+    """Where a ReferenceCache keeps its values"""
+
+    @abstractmethod
+    def get(self, key):
+        """returns the value stored under key, or MISSING"""
+
+    @abstractmethod
+    def set(self, key, value):
+        """stores value under key"""
+
+    @abstractmethod
+    def clear(self):
+        """drops every value"""
+
+    def stats(self):
+        """returns the backend's own counters"""
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    """A thread-safe, size-bounded LRU dict whose entries expire"""
+
+    def __init__(self, size=None, ttl=None):
+        """starts empty"""
+        self.size = size if size is not None else \
+            int(os.getenv("TCC_REFERENCE_CACHE_SIZE", 4096))
+        self.ttl = ttl if ttl is not None else \
+            float(os.getenv("TCC_REFERENCE_CACHE_TTL", 30))
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key):
+        """returns the value stored under key, or MISSING"""
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return MISSING
+            if entry[0] <= now:
+                del self.__entries[key]
+                return MISSING
+            self.__entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """stores value under key, evicting the least recently used"""
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """drops every entry"""
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        """returns the number of entries and evictions"""
+        with self.__lock:
+            return {"entries": len(self.__entries),
+                    "evictions": self.evictions}
+
+
+def _table_version(cls):
+    """returns the committed version of cls's table"""
+    return table_versions(models.storage, [cls])[0][0]
+
+
+class ReferenceCache:
+    """A read-through cache of serialized rows, invalidated per table"""
+
+    def __init__(self, backend=None, version=_table_version,
+                 version_ttl=None):
+        """caches into backend, a MemoryBackend by default"""
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.version = version
+        self.version_ttl = version_ttl if version_ttl is not None else \
+            float(os.getenv("TCC_REFERENCE_VERSION_TTL", 1))
+        self.__lock = threading.Lock()
+        self.__versions = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """sets the hit and miss counters back to zero"""
+        with self.__lock:
+            self.hits = {cls.__tablename__: 0 for cls in cached_classes}
+            self.misses = {cls.__tablename__: 0 for cls in cached_classes}
+
+    def clear(self):
+        """drops every cached value and version"""
+        self.backend.clear()
+        with self.__lock:
+            self.__versions.clear()
+
+    def current_version(self, cls):
+        """
+        returns the version of cls's table, read again once version_ttl
+        seconds have passed or this process has bumped a version since
+        """
+        now = time.monotonic()
+        generation = local_generation()
+        with self.__lock:
+            entry = self.__versions.get(cls)
+        if entry is not None and entry[0] > now and entry[1] == generation:
+            return entry[2]
+        version = self.version(cls)
+        with self.__lock:
+            self.__versions[cls] = (now + self.version_ttl, generation,
+                                    version)
+        return version
+
+    def observe(self, cls, version):
+        """
+        records a version of cls's table read elsewhere, by the
+        conditional GETs, so a value served after it is never older
+        """
+        if cls not in cached_classes:
+            return
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__versions.get(cls)
+            if entry is None or entry[2] < version:
+                self.__versions[cls] = (now + self.version_ttl,
+                                        local_generation(), version)
+
+    def fetch(self, cls, key, load):
+        """
+        Returns the value cached under key for cls's table, calling load()
+        to compute and keep it on a miss. The version is read before
+        loading, so a value loaded while a write commits is kept under
+        the older version and never served once the newer one is read.
+        """
+        table = cls.__tablename__
+        if cls in written_tables(models.storage):
+            # This transaction's own writes are not the committed state
+            return load()
+        stamped = (table, self.current_version(cls), key)
+        value = self.backend.get(stamped)
+        if value is not MISSING:
+            with self.__lock:
+                self.hits[table] += 1
+            return value
+        with self.__lock:
+            self.misses[table] += 1
+        value = load()
+        if value is not None:
+            self.backend.set(stamped, value)
+        return value
+
+    def get(self, cls, id):
+        """returns the dict of the cls object with id, None if missing"""
+        def load():
+            obj = models.storage.get(cls, id)
+            return None if obj is None else obj.to_dict()
+        return self.fetch(cls, ("id", id), load)
+
+    def stats(self):
+        """returns the hits and misses per table, and the backend's counters"""
+        with self.__lock:
+            stats = {"hits": dict(self.hits), "misses": dict(self.misses)}
+        stats.update(self.backend.stats())
+        return stats
+
+
+reference = ReferenceCache()
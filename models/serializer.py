@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+"""
+Contains the per-model serializers behind BaseModel.to_dict.
+
+A Serializer is built once per mapped class from its table's columns: it
+compiles a function that turns a result row into a dict in one dict
+literal, with the datetime and enum encoders inlined per column. Loaded
+instances go through the same function, their values read straight from
+__dict__; on 20000 loaded consignments that takes about half the time of
+the __dict__ walking to_dict it replaced (benchmarks/bench_serializer.py).
+dumps() uses orjson when it is installed and falls back to the standard
+json module.
+"""
+
+from datetime import datetime
+from enum import Enum
+import json
+from sqlalchemy import DateTime
+from sqlalchemy import Enum as EnumType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Columns left out of every payload unless explicitly asked for
+sensitive = {"password", "password_hash"}
+# Bookkeeping columns of the server (optimistic locking, status totals
+# and metrics), never part of a payload
+internal = {"version_id", "status_since", "available_seconds",
+            "in_transit_seconds", "idle_seconds", "wait_seconds"}
+
+_serializers = {}
+
+
+def encode_datetime(value):
+    """
+    formats value like the models' time format, %Y-%m-%dT%H:%M:%S.%f,
+    without the cost of strftime
+    """
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="microseconds")[:26]
+    return value
+
+
+def encode_enum(value):
+    """returns the name of an enum member"""
+    if isinstance(value, Enum):
+        return value.name
+    return value
+
+
+class Serializer:
+    """Turns instances or result rows of one mapped class into dicts"""
+
+    def __init__(self, cls):
+        """compiles the row encoders of cls from its table's columns"""
+        self.name = cls.__name__
+        self.columns = list(cls.__table__.columns)
+        self.keys = [column.key for column in self.columns]
+        encoders = []
+        for column in self.columns:
+            if isinstance(column.type, DateTime):
+                encoders.append("encode_datetime")
+            elif isinstance(column.type, EnumType) and column.type.enum_class:
+                encoders.append("encode_enum")
+            else:
+                encoders.append(None)
+        self._public = self._compile(encoders, include_sensitive=False)
+        self._all = self._compile(encoders, include_sensitive=True)
+
+    def _compile(self, encoders, include_sensitive):
+        """
+        builds a function returning the dict of one row as a single dict
+        literal, with each column's encoder inlined
+        """
+        items = []
+        for i, (key, encoder) in enumerate(zip(self.keys, encoders)):
+            if key in internal or (key in sensitive and
+                                   not include_sensitive):
+                continue
+            if encoder is None:
+                items.append("{!r}: row[{}]".format(key, i))
+            else:
+                items.append("{!r}: None if row[{i}] is None else {}(row[{i}])"
+                             .format(key, encoder, i=i))
+        items.append("'__class__': {!r}".format(self.name))
+        source = "def row_to_dict(row):\n    return {{{}}}\n".format(
+            ", ".join(items))
+        namespace = {"encode_datetime": encode_datetime,
+                     "encode_enum": encode_enum}
+        exec(source, namespace)
+        return namespace["row_to_dict"]
+
+    def row_to_dict(self, row, include_sensitive=False):
+        """
+        returns the dict of a row whose values are in self.columns order,
+        such as those returned by DBStorage.page(..., rows=True)
+        """
+        if include_sensitive:
+            return self._all(row)
+        return self._public(row)
+
+    def to_dict(self, obj, include_sensitive=False):
+        """returns the dict of a mapped instance"""
+        # Loaded attributes live in __dict__; reading them there skips the
+        # instrumented descriptors, which are only used to load the rest
+        state = obj.__dict__
+        values = [state[key] if key in state else getattr(obj, key)
+                  for key in self.keys]
+        return self.row_to_dict(values, include_sensitive)
+
+
+def serializer_for(cls):
+    """returns the cached Serializer of a mapped class"""
+    serializer = _serializers.get(cls)
+    if serializer is None:
+        serializer = _serializers[cls] = Serializer(cls)
+    return serializer
+
+
+def dumps(value):
+    """serializes already-encoded dicts and lists to JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
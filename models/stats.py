@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+"""
+Maintains destination_stats: the consignment count, volume and invoiced
+revenue per (destination_address, origin_branch_id, day).
+
+A consignment adds one to the count and its volume to the total of the
+row for its destination, origin branch and creation day; its invoice adds
+its amount to the revenue of that same row. Every flush that writes
+consignments or invoices applies the matching deltas on the same
+connection, like the lane backlog in models.lanes, so GET
+/consignments/stats reads a handful of rows instead of scanning both
+tables.
+"""
+
+from datetime import date, datetime
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+from models.lanes import _previous, expire_rows, reconcile, upsert
+from models.tables import Consignment, DestinationStat, Invoice
+
+# Consignment attributes that decide which stats row it counts towards
+tracked = ("volume_cubic_meters", "origin_branch_id", "destination_address")
+
+
+def day_of(value):
+    """returns the stats day of a created_at value, as a date"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value
+
+
+def _stat_key(stat):
+    """returns the (destination_address, origin_branch_id, day) of a row"""
+    return (stat.destination_address, stat.origin_branch_id, day_of(stat.day))
+
+
+def add_stat(deltas, key, count, volume, revenue):
+    """accumulates a (count, volume, revenue) change for a key into deltas"""
+    if key is None:
+        return
+    old = deltas.get(key, (0, 0.0, 0.0))
+    deltas[key] = (old[0] + count, old[1] + volume, old[2] + revenue)
+
+
+def apply_stat_deltas(connection, deltas):
+    """
+    Adds each (destination, branch_id, day) key's (count, volume, revenue)
+    delta to destination_stats, creating the missing rows
+    """
+    table = DestinationStat.__table__
+    for (destination, branch_id, day), (count, volume, revenue) in \
+            deltas.items():
+        if not count and not volume and not revenue:
+            continue
+        upsert(connection, table,
+               dict(destination_address=destination,
+                    origin_branch_id=branch_id, day=day),
+               dict(consignment_count=count, total_volume=volume,
+                    total_revenue=revenue),
+               dict(consignment_count=table.c.consignment_count + count,
+                    total_volume=table.c.total_volume + volume,
+                    total_revenue=table.c.total_revenue + revenue))
+
+
+def _key(destination, branch_id, created_at):
+    """returns the stats key of a consignment"""
+    return (destination, branch_id, day_of(created_at))
+
+
+def _current_keys(session, ids):
+    """
+    returns {consignment_id: key} for consignments this flush did not
+    touch, from the session when loaded and from the table otherwise
+    """
+    keys, missing = {}, set()
+    for consignment_id in ids:
+        obj = session.identity_map.get(
+            session.identity_key(Consignment, consignment_id))
+        if obj is None:
+            missing.add(consignment_id)
+        else:
+            keys[consignment_id] = _key(obj.destination_address,
+                                        obj.origin_branch_id, obj.created_at)
+    if missing:
+        table = Consignment.__table__
+        rows = session.connection().execute(
+            select(table.c.id, table.c.destination_address,
+                   table.c.origin_branch_id, table.c.created_at)
+            .where(table.c.id.in_(missing)))
+        for row in rows:
+            keys[row[0]] = _key(row[1], row[2], row[3])
+    return keys
+
+
+@event.listens_for(Session, "after_flush")
+def record_stat_changes(session, flush_context):
+    """applies the stats deltas of the consignments and invoices flushed"""
+    deltas = {}
+    # Stats key of each consignment this flush touched, before and after
+    # it; None means it did not exist on that side of the flush
+    old_keys, new_keys = {}, {}
+    moved = []
+
+    for obj in session.new:
+        if isinstance(obj, Consignment):
+            key = _key(obj.destination_address, obj.origin_branch_id,
+                       obj.created_at)
+            old_keys[obj.id], new_keys[obj.id] = None, key
+            add_stat(deltas, key, 1, obj.volume_cubic_meters, 0.0)
+
+    for obj in session.dirty:
+        if not isinstance(obj, Consignment):
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[name].history.has_changes()
+                   for name in tracked):
+            continue
+        old = _key(_previous(state, "destination_address"),
+                   _previous(state, "origin_branch_id"), obj.created_at)
+        new = _key(obj.destination_address, obj.origin_branch_id,
+                   obj.created_at)
+        old_keys[obj.id], new_keys[obj.id] = old, new
+        add_stat(deltas, old, -1, -_previous(state, "volume_cubic_meters"),
+                 0.0)
+        add_stat(deltas, new, 1, obj.volume_cubic_meters, 0.0)
+        if old != new:
+            moved.append(obj.id)
+
+    for obj in session.deleted:
+        if isinstance(obj, Consignment):
+            state = inspect(obj)
+            old = _key(_previous(state, "destination_address"),
+                       _previous(state, "origin_branch_id"), obj.created_at)
+            old_keys[obj.id], new_keys[obj.id] = old, None
+            add_stat(deltas, old, -1,
+                     -_previous(state, "volume_cubic_meters"), 0.0)
+
+    # Invoice amounts count towards their consignment's row: the row it
+    # had before the flush for the old amount, after it for the new one
+    changes, touched = [], set()
+    for obj in session.new:
+        if isinstance(obj, Invoice):
+            changes.append((None, None, obj.consignment_id, obj.amount))
+            touched.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Invoice):
+            state = inspect(obj)
+            if not state.attrs.amount.history.has_changes() and \
+                    not state.attrs.consignment_id.history.has_changes():
+                continue
+            changes.append((_previous(state, "consignment_id"),
+                            _previous(state, "amount"),
+                            obj.consignment_id, obj.amount))
+            touched.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Invoice):
+            state = inspect(obj)
+            changes.append((_previous(state, "consignment_id"),
+                            _previous(state, "amount"), None, None))
+            touched.add(obj.id)
+
+    if not deltas and not changes:
+        return
+    connection = session.connection()
+
+    untouched = {cid for old_id, _, new_id, _ in changes
+                 for cid in (old_id, new_id)
+                 if cid is not None and cid not in new_keys}
+    current = _current_keys(session, untouched)
+    for old_id, old_amount, new_id, new_amount in changes:
+        if old_id is not None:
+            add_stat(deltas, old_keys.get(old_id, current.get(old_id)),
+                     0, 0.0, -old_amount)
+        if new_id is not None:
+            add_stat(deltas, new_keys.get(new_id, current.get(new_id)),
+                     0, 0.0, new_amount)
+
+    # A consignment that changed rows takes its unchanged invoice along
+    if moved:
+        table = Invoice.__table__
+        rows = connection.execute(
+            select(table.c.id, table.c.consignment_id, table.c.amount)
+            .where(table.c.consignment_id.in_(moved)))
+        for invoice_id, consignment_id, amount in rows:
+            if invoice_id in touched:
+                continue
+            add_stat(deltas, old_keys[consignment_id], 0, 0.0, -amount)
+            add_stat(deltas, new_keys[consignment_id], 0, 0.0, amount)
+
+    apply_stat_deltas(connection, deltas)
+
+    expire_rows(session, DestinationStat, _stat_key, deltas)
+
+
+def expected_stats(connection):
+    """
+    returns {(destination, branch_id, day): (count, volume, revenue)}
+    computed from the consignments and invoices tables
+    """
+    consignments = Consignment.__table__
+    invoices = Invoice.__table__
+    day = func.date(consignments.c.created_at)
+    query = select(consignments.c.destination_address,
+                   consignments.c.origin_branch_id, day,
+                   func.count(consignments.c.id),
+                   func.sum(consignments.c.volume_cubic_meters),
+                   func.sum(func.coalesce(invoices.c.amount, 0.0))) \
+        .select_from(consignments.outerjoin(
+            invoices, invoices.c.consignment_id == consignments.c.id)) \
+        .group_by(consignments.c.destination_address,
+                  consignments.c.origin_branch_id, day)
+    return {(row[0], row[1], day_of(row[2])): (row[3], row[4] or 0.0,
+                                               row[5] or 0.0)
+            for row in connection.execute(query)}
+
+
+def rebuild_destination_stats(storage, repair=True):
+    """
+    Recomputes every stats row from the consignments and invoices tables
+    and compares it with destination_stats. Returns the keys that drifted;
+    with repair=True those rows are corrected as well. Run it while intake
+    is quiet; concurrent writes may be overwritten.
+    """
+    return reconcile(storage, DestinationStat, _stat_key,
+                     ("destination_address", "origin_branch_id", "day"),
+                     ("consignment_count", "total_volume", "total_revenue"),
+                     expected_stats(storage.connection()), repair)
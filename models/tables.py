@@ -4,9 +4,9 @@ Contains the database models for the logistics application.
 """
 
 import sqlalchemy
-from sqlalchemy import Column, String, ForeignKey
+from sqlalchemy import Column, String, ForeignKey, Integer, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
-from sqlalchemy import Float, Boolean, Enum
+from sqlalchemy import Float, Boolean, Enum, Date, DateTime
 import enum
 from models.base_model import BaseModel, Base
 
@@ -45,6 +45,16 @@ class Truck(BaseModel, Base):
     capacity_cubic_meters = Column(Float, nullable=False, default=500.0)
     status = Column(Enum(TruckStatus), nullable=False, default=TruckStatus.AVAILABLE)
     current_branch_id = Column(String(60), ForeignKey('branches.id'), nullable=True)
+    # Bumped on every UPDATE; a write based on a stale read fails instead of
+    # silently double-booking the truck
+    version_id = Column(Integer, nullable=False, default=1)
+    # Running time spent in each status up to status_since, kept by
+    # models.truck_status
+    status_since = Column(DateTime, nullable=True)
+    available_seconds = Column(Float, nullable=False, default=0.0)
+    in_transit_seconds = Column(Float, nullable=False, default=0.0)
+    idle_seconds = Column(Float, nullable=False, default=0.0)
+    __mapper_args__ = {'version_id_col': version_id}
 
 class Consignment(BaseModel, Base):
     __tablename__ = 'consignments'
@@ -55,7 +65,13 @@ class Consignment(BaseModel, Base):
     status = Column(Enum(ConsignmentStatus), nullable=False, default=ConsignmentStatus.AWAITING_DISPATCH)
     origin_branch_id = Column(String(60), ForeignKey('branches.id'), nullable=False)
     dispatch_id = Column(String(60), ForeignKey('dispatches.id'), nullable=True)
+    version_id = Column(Integer, nullable=False, default=1)
+    # Set by models.transitions when the status changes
+    dispatched_at = Column(DateTime, nullable=True)
+    delivered_at = Column(DateTime, nullable=True)
+    wait_seconds = Column(Float, nullable=True)
     invoice = relationship('Invoice', backref='consignment', uselist=False, lazy=True)
+    __mapper_args__ = {'version_id_col': version_id}
 
 class Invoice(BaseModel, Base):
     __tablename__ = 'invoices'
@@ -69,3 +85,79 @@ class Dispatch(BaseModel, Base):
 
     consignments = relationship('Consignment', backref='dispatch', lazy=True)
     truck = relationship('Truck', backref='dispatches')
+    __table_args__ = (Index('ix_dispatches_truck_id_created_at', 'truck_id', 'created_at'),)
+
+class LaneBacklog(BaseModel, Base):
+    """Pending volume per (origin branch, destination), kept by models.lanes"""
+    __tablename__ = 'lane_backlogs'
+    __table_args__ = (UniqueConstraint('origin_branch_id', 'destination_address'),)
+    origin_branch_id = Column(String(60), ForeignKey('branches.id'), nullable=False)
+    destination_address = Column(String(255), nullable=False)
+    pending_volume = Column(Float, nullable=False, default=0.0)
+    pending_count = Column(Integer, nullable=False, default=0)
+
+class LaneEvent(BaseModel, Base):
+    """Queued 'lane changed' notice for the dispatch worker, one per lane"""
+    __tablename__ = 'lane_events'
+    __table_args__ = (UniqueConstraint('origin_branch_id', 'destination_address'),)
+    origin_branch_id = Column(String(60), ForeignKey('branches.id'), nullable=False)
+    destination_address = Column(String(255), nullable=False)
+
+class DestinationStat(BaseModel, Base):
+    """Consignment totals per (destination, origin branch, day), kept by models.stats"""
+    __tablename__ = 'destination_stats'
+    __table_args__ = (UniqueConstraint('destination_address', 'origin_branch_id', 'day'),)
+    destination_address = Column(String(255), nullable=False)
+    origin_branch_id = Column(String(60), ForeignKey('branches.id'), nullable=False)
+    day = Column(Date, nullable=False)
+    consignment_count = Column(Integer, nullable=False, default=0)
+    total_volume = Column(Float, nullable=False, default=0.0)
+    total_revenue = Column(Float, nullable=False, default=0.0)
+
+class TruckUsage(BaseModel, Base):
+    """Dispatches, volume carried and capacity sent out per (truck, day), kept by models.truck_usage"""
+    __tablename__ = 'truck_usages'
+    __table_args__ = (UniqueConstraint('truck_id', 'day'),)
+    truck_id = Column(String(60), ForeignKey('trucks.id'), nullable=False)
+    day = Column(Date, nullable=False)
+    dispatch_count = Column(Integer, nullable=False, default=0)
+    volume_carried = Column(Float, nullable=False, default=0.0)
+    capacity_offered = Column(Float, nullable=False, default=0.0)
+
+class TruckStatusEvent(BaseModel, Base):
+    """Append-only truck status change, with the truck's running totals at that time"""
+    __tablename__ = 'truck_status_events'
+    truck_id = Column(String(60), ForeignKey('trucks.id'), nullable=False)
+    status = Column(Enum(TruckStatus), nullable=False)
+    changed_at = Column(DateTime, nullable=False)
+    available_seconds = Column(Float, nullable=False, default=0.0)
+    in_transit_seconds = Column(Float, nullable=False, default=0.0)
+    idle_seconds = Column(Float, nullable=False, default=0.0)
+    __table_args__ = (Index('ix_truck_status_events_truck_id_changed_at', 'truck_id', 'changed_at'),
+                      Index('ix_truck_status_events_changed_at', 'changed_at'))
+
+class TableVersion(BaseModel, Base):
+    """Change counter of a table, bumped by every write to it; kept by models.versions"""
+    __tablename__ = 'table_versions'
+    table_name = Column(String(64), nullable=False, unique=True)
+    version = Column(Integer, nullable=False, default=0)
+
+# Hot paths of the dispatcher (see hot_queries in models.migrations)
+Index('ix_consignments_lane_status', Consignment.origin_branch_id,
+      Consignment.destination_address, Consignment.status)
+Index('ix_consignments_dispatch_id', Consignment.dispatch_id)
+Index('ix_trucks_branch_status', Truck.current_branch_id, Truck.status)
+
+# Wait time metrics filter dispatched consignments by time window, and
+# optionally by lane, then read wait_seconds; the percentiles of a lane
+# are read in wait_seconds order from the lane's entries
+Index('ix_consignments_dispatched_at', Consignment.dispatched_at, Consignment.wait_seconds)
+Index('ix_consignments_lane_dispatched_at', Consignment.origin_branch_id,
+      Consignment.destination_address, Consignment.dispatched_at)
+Index('ix_consignments_lane_wait', Consignment.origin_branch_id,
+      Consignment.destination_address, Consignment.wait_seconds,
+      Consignment.dispatched_at)
+
+# Keyset pagination walks each listed table in (created_at, id) order
+for _cls in (User, Branch, Truck, Consignment, Invoice, Dispatch):
+    Index('ix_{}_created_at_id'.format(_cls.__tablename__), _cls.created_at, _cls.id)
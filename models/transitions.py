@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+"""
+Records when consignments change status.
+
+Before each flush, consignments whose status became DISPATCHED or
+DELIVERED get dispatched_at or delivered_at stamped, whichever code path
+changed the status. wait_seconds, the time from creation to dispatch, is
+stored with dispatched_at so wait time metrics are plain column
+aggregates.
+"""
+
+from datetime import datetime
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models.tables import Consignment, ConsignmentStatus
+
+
+def naive_utc(value):
+    """returns a datetime as naive UTC, as stored by the database"""
+    if value is not None and value.tzinfo is not None:
+        return value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+def stamp_transition(consignment, now=None):
+    """sets the timestamps of the consignment's current status if unset"""
+    now = now or datetime.utcnow()
+    status = consignment.status
+    if status in (ConsignmentStatus.DISPATCHED, ConsignmentStatus.DELIVERED) \
+            and consignment.dispatched_at is None:
+        consignment.dispatched_at = now
+        created_at = naive_utc(consignment.created_at)
+        if created_at is not None:
+            consignment.wait_seconds = max(
+                (now - created_at).total_seconds(), 0.0)
+    if status == ConsignmentStatus.DELIVERED and \
+            consignment.delivered_at is None:
+        consignment.delivered_at = now
+
+
+@event.listens_for(Session, "before_flush")
+def record_transitions(session, flush_context, instances):
+    """stamps the consignments whose status this flush changes"""
+    now = datetime.utcnow()
+    for obj in session.new:
+        if isinstance(obj, Consignment):
+            stamp_transition(obj, now)
+    for obj in session.dirty:
+        if isinstance(obj, Consignment) and \
+                inspect(obj).attrs.status.history.has_changes():
+            stamp_transition(obj, now)
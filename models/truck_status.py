@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+"""
+Keeps the truck status history.
+
+Every truck carries running totals of the seconds it has spent in each
+TruckStatus up to status_since, when its current status began. Before
+each flush that creates a truck or changes its status, whether through
+PUT /trucks/<id> or the dispatcher, the time spent in the old status is
+added to its total. A truck_status_events row is appended with the new
+status and a copy of the totals. The bulk truck import, which bypasses
+the flush, writes the first event of its trucks itself.
+
+The time a truck spent in a status up to any instant t is the total in
+its last event before t, plus t minus that event's changed_at when that
+event's status is the one asked about. Fleet time over a window is
+therefore two indexed "last event before t" lookups, whatever the length
+of the history. prune_status_events drops old events but keeps each
+truck's latest one, so windows that start after the cutoff stay exact.
+"""
+
+from datetime import datetime
+import uuid
+from sqlalchemy import and_, event, func, inspect, select
+from sqlalchemy.orm import Session
+from models.tables import Truck, TruckStatus, TruckStatusEvent
+from models.transitions import naive_utc
+
+
+def seconds_column(status):
+    """returns the name of the running total column of a TruckStatus"""
+    return "{}_seconds".format(status.name.lower())
+
+
+totals = [seconds_column(status) for status in TruckStatus]
+
+
+def _totals(obj):
+    """returns the running totals of a truck or event as a dict"""
+    return {name: getattr(obj, name) or 0.0 for name in totals}
+
+
+def status_event(truck_id, status, changed_at, seconds):
+    """returns the truck_status_events values of one status change"""
+    return dict(id=str(uuid.uuid4()), truck_id=truck_id, status=status,
+                changed_at=changed_at, created_at=changed_at,
+                updated_at=changed_at, **seconds)
+
+
+def zero_totals():
+    """returns the running totals of a truck that was just created"""
+    return {name: 0.0 for name in totals}
+
+
+def initial_status(now):
+    """returns the status columns of a truck created at now"""
+    return dict(status_since=now, **zero_totals())
+
+
+@event.listens_for(Session, "before_flush")
+def record_truck_status(session, flush_context, instances):
+    """closes the old status and logs the new one of trucks in this flush"""
+    now = datetime.utcnow()
+    for obj in list(session.new):
+        if isinstance(obj, Truck):
+            if obj.status is None:
+                obj.status = TruckStatus.AVAILABLE
+            for name, value in initial_status(now).items():
+                setattr(obj, name, value)
+            session.add(TruckStatusEvent(**status_event(
+                obj.id, obj.status, now, _totals(obj))))
+
+    for obj in list(session.dirty):
+        if not isinstance(obj, Truck):
+            continue
+        history = inspect(obj).attrs.status.history
+        if not history.has_changes() or not history.deleted or \
+                history.deleted[0] == obj.status:
+            continue
+        previous = history.deleted[0]
+        since = obj.status_since or naive_utc(obj.created_at) or now
+        name = seconds_column(previous)
+        setattr(obj, name, (getattr(obj, name) or 0.0) +
+                max((now - since).total_seconds(), 0.0))
+        obj.status_since = now
+        session.add(TruckStatusEvent(**status_event(
+            obj.id, obj.status, now, _totals(obj))))
+
+
+def _last_events(connection, at, truck_ids=None):
+    """returns each truck's last status event at or before at"""
+    table = TruckStatusEvent.__table__
+    latest = select(table.c.truck_id,
+                    func.max(table.c.changed_at).label("changed_at")) \
+        .where(table.c.changed_at <= at)
+    if truck_ids is not None:
+        latest = latest.where(table.c.truck_id.in_(truck_ids))
+    latest = latest.group_by(table.c.truck_id).subquery()
+    query = select(table).join(latest, and_(
+        table.c.truck_id == latest.c.truck_id,
+        table.c.changed_at == latest.c.changed_at))
+    events = {}
+    for row in connection.execute(query):
+        # Changes flushed within the same instant: the larger totals win
+        kept = events.get(row.truck_id)
+        if kept is None or sum(getattr(row, n) for n in totals) >= \
+                sum(getattr(kept, n) for n in totals):
+            events[row.truck_id] = row
+    return events
+
+
+def _seconds_at(events, at):
+    """returns the fleet's total seconds per status up to at"""
+    seconds = {status: 0.0 for status in TruckStatus}
+    for row in events.values():
+        for status in TruckStatus:
+            seconds[status] += getattr(row, seconds_column(status))
+        seconds[row.status] += max((at - row.changed_at).total_seconds(),
+                                   0.0)
+    return seconds
+
+
+def status_seconds(storage, since=None, until=None, truck_ids=None):
+    """
+    Returns (trucks, seconds): the number of trucks known at until (now by
+    default), and the seconds the fleet, or the trucks in truck_ids, spent
+    in each TruckStatus between since (the start of the log by default)
+    and until.
+    """
+    connection = storage.read_connection()
+    until = naive_utc(until) or datetime.utcnow()
+    end_events = _last_events(connection, until, truck_ids)
+    seconds = _seconds_at(end_events, until)
+    if since is not None:
+        since = naive_utc(since)
+        start = _seconds_at(_last_events(connection, since, truck_ids),
+                            since)
+        seconds = {status: max(seconds[status] - start[status], 0.0)
+                   for status in TruckStatus}
+    return len(end_events), seconds
+
+
+def prune_status_events(storage, before):
+    """
+    Deletes the status events older than before, except each truck's
+    latest one, which still anchors its totals. Returns the number of
+    events deleted.
+    """
+    before = naive_utc(before)
+    connection = storage.connection()
+    keep = [row.id for row in _last_events(connection, before).values()]
+    table = TruckStatusEvent.__table__
+    stmt = table.delete().where(table.c.changed_at < before)
+    if keep:
+        stmt = stmt.where(table.c.id.notin_(keep))
+    deleted = connection.execute(stmt).rowcount
+    storage.save()
+    return deleted
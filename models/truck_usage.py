@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+"""
+Maintains truck_usages: the dispatches, volume carried and capacity sent
+out per (truck_id, day).
+
+A dispatch adds one dispatch and its truck's capacity to the row for the
+truck and the dispatch's creation day; every consignment assigned to it
+adds its volume there. Every flush that writes dispatches or changes a
+consignment's dispatch applies the matching deltas on the same
+connection, like the lane backlog in models.lanes, so GET /trucks/usage
+reads one row per truck and day instead of the dispatch history.
+Utilization over any range is volume_carried / capacity_offered.
+"""
+
+from datetime import timedelta
+from sqlalchemy import and_, event, func, inspect, select
+from sqlalchemy.orm import Session
+from models.lanes import _previous, expire_rows, reconcile, upsert
+from models.stats import day_of
+from models.tables import Consignment, Dispatch, Truck, TruckUsage
+
+# Bucket sizes accepted by GET /trucks/usage, mapped to the first day of
+# the bucket a day falls in
+buckets = {
+    "day": lambda day: day,
+    "week": lambda day: day - timedelta(days=day.weekday()),
+    "month": lambda day: day.replace(day=1),
+}
+
+
+def _usage_key(usage):
+    """returns the (truck_id, day) of a usage row"""
+    return (usage.truck_id, day_of(usage.day))
+
+
+def add_usage(deltas, key, count, volume, capacity):
+    """accumulates a (count, volume, capacity) change for a key into deltas"""
+    if key is None:
+        return
+    old = deltas.get(key, (0, 0.0, 0.0))
+    deltas[key] = (old[0] + count, old[1] + volume, old[2] + capacity)
+
+
+def apply_usage_deltas(connection, deltas):
+    """
+    Adds each (truck_id, day) key's (count, volume, capacity) delta to
+    truck_usages, creating the missing rows
+    """
+    table = TruckUsage.__table__
+    for (truck_id, day), (count, volume, capacity) in deltas.items():
+        if not count and not volume and not capacity:
+            continue
+        upsert(connection, table, dict(truck_id=truck_id, day=day),
+               dict(dispatch_count=count, volume_carried=volume,
+                    capacity_offered=capacity),
+               dict(dispatch_count=table.c.dispatch_count + count,
+                    volume_carried=table.c.volume_carried + volume,
+                    capacity_offered=table.c.capacity_offered + capacity))
+
+
+def _capacities(session, truck_ids):
+    """returns {truck_id: capacity} from the session or the trucks table"""
+    capacities, missing = {}, set()
+    for truck_id in truck_ids:
+        obj = session.identity_map.get(session.identity_key(Truck, truck_id))
+        if obj is None:
+            missing.add(truck_id)
+        else:
+            capacities[truck_id] = obj.capacity_cubic_meters
+    if missing:
+        table = Truck.__table__
+        rows = session.connection().execute(
+            select(table.c.id, table.c.capacity_cubic_meters)
+            .where(table.c.id.in_(missing)))
+        capacities.update((row[0], row[1]) for row in rows)
+    return capacities
+
+
+def _dispatch_keys(session, dispatch_ids):
+    """returns {dispatch_id: (truck_id, day)} for the given dispatches"""
+    keys, missing = {}, set()
+    for dispatch_id in dispatch_ids:
+        obj = session.identity_map.get(
+            session.identity_key(Dispatch, dispatch_id))
+        if obj is None:
+            missing.add(dispatch_id)
+        else:
+            keys[dispatch_id] = (obj.truck_id, day_of(obj.created_at))
+    if missing:
+        table = Dispatch.__table__
+        rows = session.connection().execute(
+            select(table.c.id, table.c.truck_id, table.c.created_at)
+            .where(table.c.id.in_(missing)))
+        keys.update((row[0], (row[1], day_of(row[2]))) for row in rows)
+    return keys
+
+
+@event.listens_for(Session, "after_flush")
+def record_usage_changes(session, flush_context):
+    """applies the usage deltas of the dispatches and consignments flushed"""
+    deltas = {}
+    dispatches = [(obj, 1) for obj in session.new
+                  if isinstance(obj, Dispatch)]
+    dispatches += [(obj, -1) for obj in session.deleted
+                   if isinstance(obj, Dispatch)]
+
+    # (old dispatch_id, old volume, new dispatch_id, new volume) of each
+    # consignment whose load changed
+    moves = []
+    for obj in session.new:
+        if isinstance(obj, Consignment) and obj.dispatch_id is not None:
+            moves.append((None, 0.0, obj.dispatch_id,
+                          obj.volume_cubic_meters))
+    for obj in session.dirty:
+        if not isinstance(obj, Consignment):
+            continue
+        state = inspect(obj)
+        if not state.attrs.dispatch_id.history.has_changes() and \
+                not state.attrs.volume_cubic_meters.history.has_changes():
+            continue
+        moves.append((_previous(state, "dispatch_id"),
+                      _previous(state, "volume_cubic_meters"),
+                      obj.dispatch_id, obj.volume_cubic_meters))
+    for obj in session.deleted:
+        if isinstance(obj, Consignment):
+            state = inspect(obj)
+            moves.append((_previous(state, "dispatch_id"),
+                          _previous(state, "volume_cubic_meters"), None, 0.0))
+    moves = [move for move in moves
+             if move[0] is not None or move[2] is not None]
+
+    if not dispatches and not moves:
+        return
+
+    capacities = _capacities(session, {obj.truck_id
+                                       for obj, _ in dispatches})
+    keys = {obj.id: (obj.truck_id, day_of(obj.created_at))
+            for obj, _ in dispatches}
+    keys.update(_dispatch_keys(session, {
+        dispatch_id for old, _, new, _ in moves for dispatch_id in (old, new)
+        if dispatch_id is not None and dispatch_id not in keys}))
+
+    for obj, sign in dispatches:
+        add_usage(deltas, keys[obj.id], sign, 0.0,
+                  sign * (capacities.get(obj.truck_id) or 0.0))
+    for old, old_volume, new, new_volume in moves:
+        if old is not None:
+            add_usage(deltas, keys.get(old), 0, -old_volume, 0.0)
+        if new is not None:
+            add_usage(deltas, keys.get(new), 0, new_volume, 0.0)
+
+    apply_usage_deltas(session.connection(), deltas)
+
+    expire_rows(session, TruckUsage, _usage_key, deltas)
+
+
+def usage_rows(storage, since, until, branch_id=None):
+    """
+    Returns (truck_id, truck_number, day, count, volume, capacity) for
+    every truck of the fleet, or of the branch with branch_id, and day from
+    since to until it was used. Trucks not used in the period get a single
+    row whose day is None and whose counts are zero.
+    """
+    trucks = Truck.__table__
+    usages = TruckUsage.__table__
+    query = select(trucks.c.id, trucks.c.truck_number, usages.c.day,
+                   func.coalesce(func.sum(usages.c.dispatch_count), 0),
+                   func.coalesce(func.sum(usages.c.volume_carried), 0.0),
+                   func.coalesce(func.sum(usages.c.capacity_offered), 0.0)) \
+        .select_from(trucks.outerjoin(usages, and_(
+            usages.c.truck_id == trucks.c.id,
+            usages.c.day >= since, usages.c.day <= until))) \
+        .group_by(trucks.c.id, trucks.c.truck_number, usages.c.day) \
+        .order_by(trucks.c.id, usages.c.day)
+    if branch_id is not None:
+        query = query.where(trucks.c.current_branch_id == branch_id)
+    return storage.read_connection().execute(query).all()
+
+
+def expected_usage(connection):
+    """
+    returns {(truck_id, day): (count, volume, capacity)} computed from the
+    dispatches, trucks and consignments tables
+    """
+    dispatches = Dispatch.__table__
+    trucks = Truck.__table__
+    consignments = Consignment.__table__
+    day = func.date(dispatches.c.created_at)
+    expected = {}
+    query = select(dispatches.c.truck_id, day,
+                   func.count(dispatches.c.id),
+                   func.sum(trucks.c.capacity_cubic_meters)) \
+        .select_from(dispatches.join(
+            trucks, trucks.c.id == dispatches.c.truck_id)) \
+        .group_by(dispatches.c.truck_id, day)
+    for truck_id, dispatch_day, count, capacity in connection.execute(query):
+        expected[(truck_id, day_of(dispatch_day))] = (count, 0.0,
+                                                      capacity or 0.0)
+    query = select(dispatches.c.truck_id, day,
+                   func.sum(consignments.c.volume_cubic_meters)) \
+        .select_from(dispatches.join(
+            consignments, consignments.c.dispatch_id == dispatches.c.id)) \
+        .group_by(dispatches.c.truck_id, day)
+    for truck_id, dispatch_day, volume in connection.execute(query):
+        key = (truck_id, day_of(dispatch_day))
+        count, _, capacity = expected.get(key, (0, 0.0, 0.0))
+        expected[key] = (count, volume or 0.0, capacity)
+    return expected
+
+
+def rebuild_truck_usage(storage, repair=True):
+    """
+    Recomputes every usage row from the dispatch history and compares it
+    with truck_usages. Returns the keys that drifted; with repair=True
+    those rows are corrected as well. Run it while dispatching is paused;
+    concurrent writes may be overwritten.
+    """
+    return reconcile(storage, TruckUsage, _usage_key, ("truck_id", "day"),
+                     ("dispatch_count", "volume_carried", "capacity_offered"),
+                     expected_usage(storage.connection()), repair)
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+"""
+Keeps table_versions: a change counter per polled table.
+
+Every transaction that inserts, changes or deletes a branch or a truck
+adds one to its table's counter, and stamps the counter's updated_at,
+once it has committed: the flush listener notes the tables written, and
+the bump runs right after the commit in a short transaction of its own,
+so concurrent writers only contend for the counter row for that one
+statement. The bulk imports, which bypass the flush, note their tables
+with mark_written. Between a commit and its bump, a few milliseconds,
+readers still see the previous version; a bump lost to a failure
+(logged) leaves it behind until the table's next write.
+
+A reader learns whether a table changed since it last looked from one
+primary-key lookup, without reading the table itself; the conditional
+GETs of the API (api.v1.views.conditional) derive their ETag and
+Last-Modified from it, and the reference cache (models.reference) stamps
+its values with it.
+
+Dispatches are polled too, but only ever inserted, by the dispatch
+workers; counting them would make every dispatch wait for the others'
+bumps. Their version is the creation time of the newest dispatch and the
+number of dispatches created at that time, read from the (created_at, id)
+index.
+
+Until it commits, a transaction's writes are not in the committed
+versions; written_tables tells which counted tables the current one has
+written, so readers do not take its own writes for committed state.
+"""
+
+import logging
+import threading
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from models.lanes import upsert
+from models.tables import Branch, Dispatch, TableVersion, Truck
+
+# Tables whose writes are counted
+versioned_classes = (Branch, Truck)
+# Insert-only tables versioned by their newest rows instead
+appended_classes = (Dispatch,)
+
+logger = logging.getLogger(__name__)
+
+# Number of bumps made by this process, so that per-process copies of the
+# versions (models.reference) know when its own commits made them stale
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def bump_versions(connection, classes):
+    """adds one to the change counter of the tables of classes"""
+    table = TableVersion.__table__
+    for name in sorted({cls.__tablename__ for cls in classes}):
+        upsert(connection, table, dict(table_name=name), dict(version=1),
+               dict(version=table.c.version + 1))
+
+
+def mark_written(info, classes):
+    """
+    notes in a session's info that its transaction wrote the tables of
+    classes, whose counters are bumped once it commits
+    """
+    info.setdefault("table_changes", set()).update(classes)
+
+
+@event.listens_for(Session, "after_flush")
+def record_table_changes(session, flush_context):
+    """notes the counted tables this flush wrote"""
+    changed = {type(obj) for obj in session.new | session.deleted
+               if isinstance(obj, versioned_classes)}
+    changed.update(type(obj) for obj in session.dirty
+                   if isinstance(obj, versioned_classes) and
+                   session.is_modified(obj))
+    if changed:
+        mark_written(session.info, changed)
+
+
+@event.listens_for(Session, "after_commit")
+def bump_committed_changes(session):
+    """bumps the counters of the tables the committed transaction wrote"""
+    changed = session.info.pop("table_changes", None)
+    if not changed:
+        return
+    global _generation
+    try:
+        with session.get_bind().begin() as connection:
+            bump_versions(connection, changed)
+    except Exception:
+        logger.exception("could not bump the versions of %s",
+                         sorted(cls.__tablename__ for cls in changed))
+    with _generation_lock:
+        _generation += 1
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def forget_rolled_back_changes(session, previous_transaction):
+    """drops the changes of a rolled back transaction"""
+    if not session.in_transaction():
+        session.info.pop("table_changes", None)
+
+
+def local_generation():
+    """returns the number of bumps this process has made"""
+    return _generation
+
+
+def written_tables(storage):
+    """returns the versioned classes the current transaction has written"""
+    return storage.session_info().get("table_changes", ())
+
+
+def _newest_rows(connection, cls):
+    """
+    returns the (version, changed_at) of an insert-only table: its newest
+    creation time, with the number of rows created then
+    """
+    table = cls.__table__
+    newest = select(func.max(table.c.created_at)).scalar_subquery()
+    row = connection.execute(
+        select(table.c.created_at, func.count())
+        .where(table.c.created_at == newest)
+        .group_by(table.c.created_at)).first()
+    if row is None:
+        return (0, None)
+    return ("{}/{}".format(row[0].isoformat(), row[1]), row[0])
+
+
+def table_versions(storage, classes):
+    """
+    Returns the (version, changed_at) of the tables of classes, in order;
+    (0, None) for a table never written since versions were kept
+    """
+    connection = storage.read_connection()
+    table = TableVersion.__table__
+    names = [cls.__tablename__ for cls in classes
+             if cls not in appended_classes]
+    rows = {}
+    if names:
+        rows = {row.table_name: (row.version, row.updated_at)
+                for row in connection.execute(
+                    select(table.c.table_name, table.c.version,
+                           table.c.updated_at)
+                    .where(table.c.table_name.in_(names)))}
+    return [_newest_rows(connection, cls) if cls in appended_classes
+            else rows.get(cls.__tablename__, (0, None))
+            for cls in classes]
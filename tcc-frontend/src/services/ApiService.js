@@ -12,10 +12,29 @@ const getAuthHeader = () => {
   return {};
 };
 
+// Largest page the list endpoints serve
+const PAGE_LIMIT = 1000;
+
+// List endpoints answer one page at a time, with the cursor of the next
+// page in X-Next-Cursor; follow it so callers get the whole list in
+// response.data, as before the API was paginated.
+const getAllPages = async (url, config = {}) => {
+  const params = { ...config.params, limit: PAGE_LIMIT };
+  let response = await axios.get(url, { ...config, params });
+  const items = [...response.data];
+  let cursor = response.headers['x-next-cursor'];
+  while (cursor) {
+    response = await axios.get(url, { ...config, params: { ...params, cursor } });
+    items.push(...response.data);
+    cursor = response.headers['x-next-cursor'];
+  }
+  return { ...response, data: items };
+};
+
 const ApiService = {
   // Branches
   getBranches: () => {
-    return axios.get(API_URL + '/branches');
+    return getAllPages(API_URL + '/branches');
   },
   createBranch: (name, is_hq) => {
     return axios.post(API_URL + '/branches', { name, is_hq }, { headers: getAuthHeader() });
@@ -26,7 +45,7 @@ const ApiService = {
     return axios.post(API_URL + '/consignments', data, { headers: getAuthHeader() });
   },
   getConsignments: () => {
-    return axios.get(API_URL + '/consignments', { headers: getAuthHeader() });
+    return getAllPages(API_URL + '/consignments', { headers: getAuthHeader() });
   },
   getConsignment: (id) => {
     return axios.get(API_URL + '/consignments/' + id, { headers: getAuthHeader() });
@@ -43,7 +62,7 @@ const ApiService = {
 
   // Dispatches
   getDispatches: () => {
-    return axios.get(API_URL + '/dispatches', { headers: getAuthHeader() });
+    return getAllPages(API_URL + '/dispatches', { headers: getAuthHeader() });
   },
   getDispatch: (id) => {
     return axios.get(API_URL + '/dispatches/' + id, { headers: getAuthHeader() });
@@ -51,7 +70,7 @@ const ApiService = {
 
   // Invoices
   getInvoices: () => {
-    return axios.get(API_URL + '/invoices', { headers: getAuthHeader() });
+    return getAllPages(API_URL + '/invoices', { headers: getAuthHeader() });
   },
   getInvoice: (id) => {
     return axios.get(API_URL + '/invoices/' + id, { headers: getAuthHeader() });
@@ -62,7 +81,7 @@ const ApiService = {
     return axios.post(API_URL + '/trucks', data, { headers: getAuthHeader() });
   },
   getTrucks: () => {
-    return axios.get(API_URL + '/trucks', { headers: getAuthHeader() });
+    return getAllPages(API_URL + '/trucks', { headers: getAuthHeader() });
   },
   getTruck: (id) => {
     return axios.get(API_URL + '/trucks/' + id, { headers: getAuthHeader() });
@@ -71,7 +90,7 @@ const ApiService = {
     return axios.put(API_URL + '/trucks/' + id, data, { headers: getAuthHeader() });
   },
   getTruckStatuses: () => {
-    return axios.get(API_URL + '/trucks/status', { headers: getAuthHeader() });
+    return getAllPages(API_URL + '/trucks/status', { headers: getAuthHeader() });
   },
   getTruckUsage: (days) => {
     return axios.get(API_URL + '/trucks/usage', { params: { days }, headers: getAuthHeader() });
@@ -87,7 +106,7 @@ const ApiService = {
 
   // Users
   getUsers: () => {
-    return axios.get(API_URL + '/users', { headers: getAuthHeader() });
+    return getAllPages(API_URL + '/users', { headers: getAuthHeader() });
   },
   getUser: (id) => {
     return axios.get(API_URL + '/users/' + id, { headers: getAuthHeader() });
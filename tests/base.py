@@ -2,7 +2,7 @@
 import unittest
 from api.v1.app import app
 from models import storage
-from models.base_model import Base
+from models.reference import reference
 
 
 class BaseTestCase(unittest.TestCase):
@@ -13,8 +13,10 @@ class BaseTestCase(unittest.TestCase):
         app.config['TESTING'] = True
         self.client = app.test_client()
         storage.reload()
+        storage.create_schema()
+        reference.clear()
 
     def tearDown(self):
         """Tear down the database."""
         storage.close()
-        Base.metadata.drop_all(storage._DBStorage__engine)
+        storage.drop_schema()
@@ -1,7 +1,12 @@
 # tests/test_branches.py
 import json
+import time
+import unittest
+from unittest.mock import patch
 from tests.base import BaseTestCase
-from models.tables import Branch
+from models.tables import Branch, Dispatch, TableVersion
+from models.reference import MISSING, CacheBackend, MemoryBackend, ReferenceCache, reference
+from models.versions import bump_versions, table_versions
 from models import storage
 
 class TestBranches(BaseTestCase):
@@ -19,6 +24,28 @@ class TestBranches(BaseTestCase):
         self.assertEqual(data['name'], 'Main Branch')
         self.assertTrue(data['is_hq'])
 
+    def test_bulk_create_branches(self):
+        """Test importing branches from a JSON array."""
+        body = json.dumps([{"name": "Bulk North"}, {"is_hq": True}, {"name": "Bulk South", "is_hq": True}])
+        response = self.client.post('/api/v1/branches/bulk', data=body, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual((data['inserted'], data['failed']), (2, 1))
+        self.assertEqual(data['errors'], [{"row": 2, "error": "Missing branch name"}])
+        self.assertTrue(storage.exists(Branch, name="Bulk South", is_hq=True))
+
+    def test_bulk_rejects_only_the_refused_row(self):
+        """Test a row the database refuses fails alone, not with its chunk."""
+        body = json.dumps([{"name": "Bulk East"}, {"name": {"not": "a string"}}, {"name": "Bulk West"}])
+        with self.assertLogs('api.v1.views.bulk', 'ERROR') as logs:
+            response = self.client.post('/api/v1/branches/bulk', data=body, content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual((data['inserted'], data['failed']), (2, 1))
+        self.assertEqual(data['errors'], [{"row": 2, "error": "Row could not be stored"}])
+        self.assertIn("Traceback", logs.output[0])
+        self.assertTrue(storage.exists(Branch, name="Bulk East"))
+        self.assertTrue(storage.exists(Branch, name="Bulk West"))
+
     def test_get_branches(self):
         """Test getting all branches."""
         # First, create a branch to ensure there is data
@@ -48,5 +75,147 @@ class TestBranches(BaseTestCase):
         response = self.client.get('/api/v1/branches/non-existent-id')
         self.assertEqual(response.status_code, 404)
 
+    def test_reference_cache(self):
+        """Test branch reads are served from the cache until a write commits."""
+        branch = Branch(name="Cached Branch")
+        storage.new(branch)
+        storage.save()
+        reference.reset_stats()
+        for _ in range(2):
+            self.assertEqual(self.client.get('/api/v1/branches/' + branch.id).status_code, 200)
+            self.assertEqual(len(json.loads(self.client.get('/api/v1/branches/').data)), 1)
+        self.assertEqual(reference.stats()["hits"]["branches"], 2)
+        self.assertEqual(reference.stats()["misses"]["branches"], 2)
+
+        self.client.post('/api/v1/branches/', data=json.dumps({"name": "New Branch"}),
+                         content_type='application/json')
+        self.assertEqual(len(json.loads(self.client.get('/api/v1/branches/').data)), 2)
+        self.client.post('/api/v1/branches/bulk', data=json.dumps([{"name": "Bulk Branch"}]),
+                         content_type='application/json')
+        self.assertEqual(len(json.loads(self.client.get('/api/v1/branches/').data)), 3)
+
+    def test_conditional_get(self):
+        """Test branch lists are revalidated with their ETag, and bulk imports change it."""
+        response = self.client.get('/api/v1/branches/')
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+        etag = response.headers['ETag']
+        response = self.client.get('/api/v1/branches/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.client.post('/api/v1/branches/bulk', data=json.dumps([{"name": "Bulk Branch"}]),
+                         content_type='application/json')
+        response = self.client.get('/api/v1/branches/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 1)
+
+    def test_other_workers_writes_invalidate(self):
+        """Test a write committed elsewhere, which bumps the shared version, is seen within the version TTL."""
+        branch = Branch(name="Shared Branch")
+        storage.new(branch)
+        storage.save()
+        branch_id = branch.id
+        self.assertEqual(reference.get(Branch, branch_id)['name'], "Shared Branch")
+        table = Branch.__table__
+
+        def rename(name):
+            with storage.engine().begin() as connection:
+                connection.execute(table.update().where(table.c.id == branch_id).values(name=name))
+                bump_versions(connection, [Branch])
+            storage.close()
+
+        rename("Renamed")
+        self.assertEqual(reference.get(Branch, branch_id)['name'], "Shared Branch")
+        with patch('models.reference.time.monotonic', return_value=time.monotonic() + reference.version_ttl):
+            self.assertEqual(reference.get(Branch, branch_id)['name'], "Renamed")
+        # A conditional GET reads the version its ETag names, and its body follows it
+        rename("Renamed Again")
+        response = self.client.get('/api/v1/branches/' + branch_id)
+        self.assertEqual(json.loads(response.data)['name'], "Renamed Again")
+
+    def test_versions_are_read_once_per_ttl(self):
+        """Test cache hits reuse the table version instead of reading it on every lookup."""
+        branch = Branch(name="Hot Branch")
+        storage.new(branch)
+        storage.save()
+        reads = []
+        cache = ReferenceCache(MemoryBackend(), version=lambda cls: reads.append(cls) or 0, version_ttl=60)
+        for _ in range(5):
+            cache.fetch(Branch, branch.id, lambda: "hot")
+        self.assertEqual(len(reads), 1)
+        branch.name = "Renamed Hot Branch"
+        storage.save()
+        cache.fetch(Branch, branch.id, lambda: "hot")
+        self.assertEqual(len(reads), 2)  # this process's own write is seen at once
+
+    def test_versions_bump_after_commit(self):
+        """Test the counter is bumped once the write commits, not in its transaction, and dispatches are not counted."""
+        [(version, _)] = table_versions(storage, [Branch])
+        table = TableVersion.__table__
+
+        def counted():
+            with storage.engine().connect() as connection:
+                return connection.execute(table.select().where(table.c.table_name == 'branches')).first()
+
+        with storage.unit_of_work():
+            storage.new(Branch(name="Counted Branch"))
+            storage.save()
+            row = counted()
+            self.assertEqual(row.version if row else 0, version)
+        self.assertEqual(counted().version, version + 1)
+        self.assertFalse(storage.exists(TableVersion, table_name=Dispatch.__tablename__))
+
+    def test_missing_rows_are_not_cached(self):
+        """Test a lookup of a missing row is not kept."""
+        reference.reset_stats()
+        self.assertIsNone(reference.get(Branch, "not-yet"))
+        self.assertIsNone(reference.get(Branch, "not-yet"))
+        self.assertEqual(reference.stats()["misses"]["branches"], 2)
+
+    def test_uncommitted_writes_are_not_cached(self):
+        """Test values read by a transaction that wrote their table are not kept."""
+        reference.reset_stats()
+        with self.assertRaises(ValueError):
+            with storage.unit_of_work():
+                branch = Branch(name="Uncommitted")
+                branch.save()
+                self.assertEqual(reference.get(Branch, branch.id)['name'], "Uncommitted")
+                raise ValueError
+        self.assertEqual(reference.stats()["entries"], 0)
+
+    def test_rolled_back_writes_keep_cache(self):
+        """Test a rolled back write does not invalidate the cache."""
+        version = reference.version(Branch)
+        storage.new(Branch(name="Rolled Back"))
+        with self.assertRaises(ValueError):
+            with storage.unit_of_work():
+                storage.save()
+                raise ValueError
+        self.assertEqual(reference.version(Branch), version)
+
+
+class TestMemoryBackend(unittest.TestCase):
+    """Tests for the in-process cache backend."""
+
+    def test_backend_interface(self):
+        """Test a backend must implement get, set and clear."""
+        class Partial(CacheBackend):
+            def get(self, key):
+                return MISSING
+        with self.assertRaises(TypeError):
+            Partial()
+
+    def test_lru_and_ttl(self):
+        """Test entries are evicted least recently used first, and expire."""
+        cache = ReferenceCache(MemoryBackend(size=2, ttl=30), version=lambda cls: 0)
+        loads = []
+        for name in ["a", "b", "a", "c", "b"]:
+            cache.fetch(Branch, name, lambda: loads.append(name) or name)
+        self.assertEqual(loads, ["a", "b", "c", "b"])
+        self.assertEqual(cache.stats()["evictions"], 2)
+        with patch('models.reference.time.monotonic', return_value=1e12):
+            cache.fetch(Branch, "b", lambda: loads.append("b") or "b")
+        self.assertEqual(loads[-1:], ["b"])
+        self.assertEqual(len(loads), 5)
+
+
 if __name__ == '__main__':
     unittest.main()
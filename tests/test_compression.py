@@ -0,0 +1,50 @@
+# tests/test_compression.py
+import gzip
+import json
+import zlib
+from tests.base import BaseTestCase
+from api.v1.compression import compression_stats, stats
+
+
+class TestCompression(BaseTestCase):
+    """Tests for response compression."""
+
+    def setUp(self):
+        """Import enough branches for a page above the size threshold."""
+        super().setUp()
+        body = json.dumps([{"name": "Branch {}".format(n)} for n in range(50)])
+        self.client.post('/api/v1/branches/bulk', data=body, content_type='application/json')
+        stats.reset()
+
+    def test_gzip(self):
+        """Test a large response is gzipped for a client that accepts it."""
+        plain = self.client.get('/api/v1/branches/')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        response = self.client.get('/api/v1/branches/', headers={'Accept-Encoding': 'br;q=0.5, gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('compress;dur=', response.headers['Server-Timing'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertLess(len(response.data), len(plain.data))
+        totals = compression_stats()['gzip']
+        self.assertEqual((totals['responses'], totals['bytes_in'], totals['bytes_out']),
+                         (1, len(plain.data), len(response.data)))
+
+    def test_small_responses_uncompressed(self):
+        """Test responses under the threshold are sent as they are."""
+        response = self.client.get('/api/v1/branches/?limit=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(json.loads(response.data)), 1)
+        response = self.client.get('/api/v1/branches/no-such-branch', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_streamed_export(self):
+        """Test a streamed export is compressed chunk by chunk."""
+        plain = self.client.get('/api/v1/branches/?export=ndjson')
+        response = self.client.get('/api/v1/branches/?export=ndjson', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decoder.decompress(response.data) + decoder.flush(), plain.data)
+        self.assertEqual(len(plain.data.splitlines()), 50)
+        self.assertEqual(compression_stats()['gzip']['bytes_in'], len(plain.data))
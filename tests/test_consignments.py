@@ -1,7 +1,12 @@
 # tests/test_consignments.py
 import json
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from tests.base import BaseTestCase
-from models.tables import Consignment, Branch
+from models.tables import Consignment, Branch, ConsignmentStatus, Invoice, LaneBacklog, LaneEvent, DestinationStat
+from models.lanes import pending_volume, rebuild_lane_backlog
+from models.stats import rebuild_destination_stats
 from models import storage
 
 class TestConsignments(BaseTestCase):
@@ -28,6 +33,26 @@ class TestConsignments(BaseTestCase):
         data = json.loads(response.data)
         self.assertEqual(data['destination_address'], '123 Main St')
 
+    def test_create_consignment_single_commit(self):
+        """Test the consignment and its invoice are written in one commit."""
+        commits = []
+        listener = lambda session: commits.append(session)
+        event.listen(Session, "after_commit", listener)
+        try:
+            consignment_data = {
+                "volume_cubic_meters": 3.0,
+                "destination_address": "123 Main St",
+                "sender_address": "456 Oak Ave",
+                "receiver_name": "John Doe",
+                "origin_branch_id": self.branch.id
+            }
+            response = self.client.post('/api/v1/consignments/', data=json.dumps(consignment_data), content_type='application/json')
+        finally:
+            event.remove(Session, "after_commit", listener)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(commits), 1)
+        self.assertTrue(storage.exists(Invoice, consignment_id=json.loads(response.data)['id']))
+
     def test_get_consignments(self):
         """Test getting all consignments."""
         consignment = Consignment(
@@ -46,6 +71,36 @@ class TestConsignments(BaseTestCase):
         self.assertIsInstance(data, list)
         self.assertGreater(len(data), 0)
 
+    def test_get_consignments_paginated(self):
+        """Test walking the consignments list with cursors."""
+        for i in range(5):
+            storage.new(Consignment(
+                volume_cubic_meters=1.0,
+                destination_address="Page Destination",
+                sender_address="101 Maple Dr",
+                receiver_name=f"Receiver {i}",
+                origin_branch_id=self.branch.id
+            ))
+        storage.save()
+
+        seen = []
+        url = '/api/v1/consignments/?limit=2'
+        while True:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.data)
+            self.assertLessEqual(len(page), 2)
+            seen.extend(item['id'] for item in page)
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+            url = f'/api/v1/consignments/?limit=2&cursor={cursor}'
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+        response = self.client.get('/api/v1/consignments/?cursor=garbage')
+        self.assertEqual(response.status_code, 400)
+
     def test_get_consignment(self):
         """Test getting a single consignment."""
         consignment = Consignment(
@@ -98,6 +153,68 @@ class TestConsignments(BaseTestCase):
         self.assertEqual(data['destination'], 'Test Destination')
         self.assertEqual(data['total_consignments'], 1)
 
+    def test_destination_stats(self):
+        """Test the stats rows follow consignment and invoice writes."""
+        for volume in (4.0, 6.0):
+            response = self.client.post('/api/v1/consignments/', data=json.dumps({
+                "volume_cubic_meters": volume,
+                "destination_address": "Stats Destination",
+                "sender_address": "616 Pine St",
+                "receiver_name": "James Wilson",
+                "origin_branch_id": self.branch.id
+            }), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+        moved = storage.get(Consignment, json.loads(response.data)['id'])
+        moved.destination_address = "Other Destination"
+        moved.invoice.amount = 50.0
+        storage.save()
+
+        data = json.loads(self.client.get('/api/v1/consignments/stats?destination=Stats%20Destination').data)
+        self.assertEqual((data['total_consignments'], data['total_volume'], data['total_revenue']),
+                         (1, 4.0, 400.0))
+        data = json.loads(self.client.get('/api/v1/consignments/stats?destination=Other%20Destination').data)
+        self.assertEqual((data['total_consignments'], data['total_volume'], data['total_revenue']),
+                         (1, 6.0, 50.0))
+        self.assertEqual(rebuild_destination_stats(storage, repair=False), [])
+
+    def test_get_consignment_stats_filters(self):
+        """Test the stats filters by branch and day."""
+        storage.new(Consignment(
+            volume_cubic_meters=2.0,
+            destination_address="Filter Destination",
+            sender_address="616 Pine St",
+            receiver_name="James Wilson",
+            origin_branch_id=self.branch.id
+        ))
+        storage.save()
+        today = storage.first(DestinationStat, destination_address="Filter Destination").day.isoformat()
+
+        url = '/api/v1/consignments/stats?destination=Filter%20Destination'
+        self.assertEqual(json.loads(self.client.get(f'{url}&since={today}&until={today}').data)['total_consignments'], 1)
+        self.assertEqual(json.loads(self.client.get(f'{url}&origin_branch_id=other').data)['total_consignments'], 0)
+        self.assertEqual(json.loads(self.client.get(f'{url}&since=2000-01-01&until=2000-01-02').data)['total_volume'], 0)
+        self.assertEqual(self.client.get(f'{url}&since=yesterday').status_code, 400)
+
+    def test_rebuild_destination_stats(self):
+        """Test the stats rebuild reports and repairs drifted rows."""
+        storage.new(Consignment(
+            volume_cubic_meters=7.0,
+            destination_address="Rebuild Destination",
+            sender_address="616 Pine St",
+            receiver_name="James Wilson",
+            origin_branch_id=self.branch.id
+        ))
+        storage.save()
+        stat = storage.first(DestinationStat, destination_address="Rebuild Destination")
+        stat.total_volume = 99.0
+        storage.save()
+        key = (stat.destination_address, stat.origin_branch_id, stat.day)
+
+        self.assertEqual(rebuild_destination_stats(storage, repair=False), [key])
+        self.assertEqual(rebuild_destination_stats(storage), [key])
+        self.assertEqual(storage.first(DestinationStat, destination_address="Rebuild Destination").total_volume, 7.0)
+        self.assertEqual(rebuild_destination_stats(storage), [])
+
     def test_get_average_wait_time(self):
         """Test getting the average wait time for consignments."""
         response = self.client.get('/api/v1/consignments/average_wait_time')
@@ -105,6 +222,147 @@ class TestConsignments(BaseTestCase):
         data = json.loads(response.data)
         self.assertIn('average_wait_time_seconds', data)
 
+    def test_status_transition_timestamps(self):
+        """Test dispatching and delivering stamp the consignment."""
+        consignment = Consignment(
+            volume_cubic_meters=1.0,
+            destination_address="Transit Destination",
+            sender_address="616 Pine St",
+            receiver_name="James Wilson",
+            origin_branch_id=self.branch.id
+        )
+        storage.new(consignment)
+        storage.save()
+        self.assertIsNone(consignment.dispatched_at)
+
+        self.client.put(f'/api/v1/consignments/{consignment.id}', data=json.dumps({"status": "dispatched"}),
+                        content_type='application/json')
+        consignment = storage.get(Consignment, consignment.id)
+        dispatched_at = consignment.dispatched_at
+        self.assertIsNotNone(dispatched_at)
+        self.assertGreaterEqual(consignment.wait_seconds, 0.0)
+        self.assertIsNone(consignment.delivered_at)
+
+        self.client.put(f'/api/v1/consignments/{consignment.id}', data=json.dumps({"status": "delivered"}),
+                        content_type='application/json')
+        consignment = storage.get(Consignment, consignment.id)
+        self.assertEqual(consignment.dispatched_at, dispatched_at)
+        self.assertIsNotNone(consignment.delivered_at)
+
+    def test_wait_time_percentiles(self):
+        """Test the wait time metrics and their filters."""
+        for i in range(1, 101):
+            storage.new(Consignment(
+                volume_cubic_meters=1.0,
+                destination_address="Far" if i % 2 else "Near",
+                sender_address="616 Pine St",
+                receiver_name="James Wilson",
+                origin_branch_id=self.branch.id,
+                status=ConsignmentStatus.DISPATCHED,
+                dispatched_at=datetime(2026, 1, 1, 12),
+                wait_seconds=float(i)
+            ))
+        storage.save()
+
+        data = json.loads(self.client.get('/api/v1/consignments/average_wait_time').data)
+        self.assertEqual(data['dispatched_consignments'], 100)
+        self.assertEqual(data['average_wait_time_seconds'], 50.5)
+        self.assertEqual((data['p50_wait_time_seconds'], data['p95_wait_time_seconds'],
+                          data['p99_wait_time_seconds']), (50.0, 95.0, 99.0))
+
+        data = json.loads(self.client.get('/api/v1/consignments/average_wait_time?destination=Near').data)
+        self.assertEqual((data['dispatched_consignments'], data['p99_wait_time_seconds']), (50, 100.0))
+        data = json.loads(self.client.get(
+            f'/api/v1/consignments/average_wait_time?origin_branch_id={self.branch.id}'
+            '&since=2026-01-01T12:00:00Z&until=2026-01-02').data)
+        self.assertEqual(data['dispatched_consignments'], 100)
+        data = json.loads(self.client.get('/api/v1/consignments/average_wait_time?since=2026-01-02').data)
+        self.assertEqual((data['dispatched_consignments'], data['p50_wait_time_seconds']), (0, None))
+        self.assertEqual(self.client.get('/api/v1/consignments/average_wait_time?until=soon').status_code, 400)
+
+    def test_lane_backlog(self):
+        """Test the lane backlog follows consignment writes."""
+        for volume in (10.0, 20.0):
+            consignment_data = {
+                "volume_cubic_meters": volume,
+                "destination_address": "Lane Destination",
+                "sender_address": "456 Oak Ave",
+                "receiver_name": "John Doe",
+                "origin_branch_id": self.branch.id
+            }
+            response = self.client.post('/api/v1/consignments/', data=json.dumps(consignment_data), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(pending_volume(storage, self.branch.id, "Lane Destination"), 30.0)
+
+        consignment_id = json.loads(response.data)['id']
+        response = self.client.put(f'/api/v1/consignments/{consignment_id}', data=json.dumps({"status": "delivered"}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        lane = storage.first(LaneBacklog, origin_branch_id=self.branch.id, destination_address="Lane Destination")
+        self.assertEqual((lane.pending_volume, lane.pending_count), (10.0, 1))
+
+    def test_update_conflict(self):
+        """Test a PUT racing another writer of the consignment gets 409."""
+        consignment = Consignment(volume_cubic_meters=5.0, destination_address="Race Destination",
+                                  sender_address="456 Oak Ave", receiver_name="John Doe",
+                                  origin_branch_id=self.branch.id)
+        storage.new(consignment)
+        storage.save()
+        consignment_id = consignment.id
+        table = Consignment.__table__
+        with storage.engine().begin() as connection:
+            connection.execute(table.update().where(table.c.id == consignment_id)
+                               .values(version_id=table.c.version_id + 1))
+        response = self.client.put(f'/api/v1/consignments/{consignment_id}', data=json.dumps({"status": "delivered"}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("error", json.loads(response.data))
+        self.assertEqual(storage.get(Consignment, consignment_id).status, ConsignmentStatus.AWAITING_DISPATCH)
+
+    def test_rebuild_lane_backlog(self):
+        """Test rebuilding the lane backlog repairs drifted lanes."""
+        consignment = Consignment(
+            volume_cubic_meters=7.0,
+            destination_address="Rebuild Destination",
+            sender_address="616 Pine St",
+            receiver_name="James Wilson",
+            origin_branch_id=self.branch.id
+        )
+        storage.new(consignment)
+        storage.save()
+        lane = storage.first(LaneBacklog, origin_branch_id=self.branch.id, destination_address="Rebuild Destination")
+        lane.pending_volume = 99.0
+        storage.save()
+
+        self.assertEqual(rebuild_lane_backlog(storage), [(self.branch.id, "Rebuild Destination")])
+        self.assertEqual(pending_volume(storage, self.branch.id, "Rebuild Destination"), 7.0)
+        self.assertEqual(rebuild_lane_backlog(storage), [])
+
+    def test_bulk_create_consignments(self):
+        """Test importing consignments from NDJSON with per-row errors."""
+        rows = [
+            {"volume_cubic_meters": 10.0, "destination_address": "Bulk Destination", "sender_address": "S",
+             "receiver_name": "R1", "origin_branch_id": self.branch.id},
+            {"volume_cubic_meters": "lots", "destination_address": "Bulk Destination", "sender_address": "S",
+             "receiver_name": "R2", "origin_branch_id": self.branch.id},
+            {"volume_cubic_meters": 5.0, "destination_address": "Bulk Destination", "sender_address": "S",
+             "receiver_name": "R3", "origin_branch_id": "non-existent-id"},
+            {"volume_cubic_meters": 20.0, "destination_address": "Bulk Destination", "sender_address": "S",
+             "receiver_name": "R4", "origin_branch_id": self.branch.id},
+        ]
+        body = "\n".join(json.dumps(row) for row in rows) + "\n{not json}\n"
+        response = self.client.post('/api/v1/consignments/bulk', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['failed'], 3)
+        self.assertEqual(sorted(error['row'] for error in data['errors']), [2, 3, 5])
+        self.assertEqual(storage.count(Consignment, destination_address="Bulk Destination"), 2)
+        self.assertEqual(storage.count(Invoice), 2)
+        self.assertEqual(pending_volume(storage, self.branch.id, "Bulk Destination"), 30.0)
+        self.assertEqual(storage.count(LaneEvent, destination_address="Bulk Destination"), 1)
+        stats = json.loads(self.client.get('/api/v1/consignments/stats?destination=Bulk%20Destination').data)
+        self.assertEqual((stats['total_consignments'], stats['total_volume'], stats['total_revenue']), (2, 30.0, 3000.0))
+
 
 if __name__ == '__main__':
     unittest.main()
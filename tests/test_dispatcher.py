@@ -0,0 +1,183 @@
+# tests/test_dispatcher.py
+import json
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from sqlalchemy.orm.exc import StaleDataError
+from tests.base import BaseTestCase
+from models.tables import Branch, Truck, Consignment, ConsignmentStatus, Dispatch, LaneEvent, TruckStatus, TruckStatusEvent, TruckUsage
+from models.dispatcher import check_and_dispatch_truck, process_lane_events
+from models.lanes import enqueue_lane_events
+from models import storage
+
+class TestDispatcher(BaseTestCase):
+    """Tests for the dispatch worker."""
+
+    def setUp(self):
+        """Set up test data."""
+        super().setUp()
+        self.branch = Branch(name="Test Branch")
+        self.truck = Truck(truck_number="TRUCK-001", current_branch_id=self.branch.id)
+        storage.new(self.branch)
+        storage.new(self.truck)
+        storage.save()
+
+    def post_consignment(self, volume, destination="Dispatch Destination"):
+        consignment_data = {
+            "volume_cubic_meters": volume,
+            "destination_address": destination,
+            "sender_address": "456 Oak Ave",
+            "receiver_name": "John Doe",
+            "origin_branch_id": self.branch.id
+        }
+        response = self.client.post('/api/v1/consignments/', data=json.dumps(consignment_data), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.data)
+
+    def test_intake_queues_lane_event(self):
+        """Test intake queues one coalesced event per lane without dispatching."""
+        self.post_consignment(300.0)
+        data = self.post_consignment(250.0)
+        self.post_consignment(5.0, destination="Other Destination")
+        self.assertEqual(data['status'], ConsignmentStatus.AWAITING_DISPATCH.name)
+        self.assertEqual(storage.count(LaneEvent), 2)
+        self.assertEqual(storage.count(LaneEvent, destination_address="Dispatch Destination"), 1)
+
+    def test_process_lane_events(self):
+        """Test the worker dispatches queued lanes that reached the threshold."""
+        self.post_consignment(300.0)
+        self.post_consignment(200.0)
+        self.assertEqual(process_lane_events(), 1)
+        self.assertEqual(storage.count(LaneEvent), 0)
+        self.assertEqual(storage.count(Consignment, status=ConsignmentStatus.DISPATCHED), 2)
+        self.assertEqual(storage.count(Consignment, dispatched_at__ne=None), 2)
+        self.assertEqual(storage.count(TruckStatusEvent, truck_id=self.truck.id, status=TruckStatus.IN_TRANSIT), 1)
+        usage = storage.first(TruckUsage, truck_id=self.truck.id)
+        self.assertEqual((usage.dispatch_count, usage.volume_carried), (1, 500.0))
+        self.assertEqual(storage.get(Truck, self.truck.id).status, TruckStatus.IN_TRANSIT)
+        self.assertEqual(process_lane_events(), 0)
+
+    def test_backlog_beyond_the_trucks_is_requeued(self):
+        """Test a lane left over the threshold after a dispatch is queued again."""
+        for _ in range(12):
+            self.post_consignment(100.0)
+        self.assertEqual(process_lane_events(), 1)
+        self.assertEqual(storage.count(Consignment, status=ConsignmentStatus.DISPATCHED), 5)
+        self.assertEqual(storage.count(LaneEvent), 1)
+
+        # No truck left: the lane waits without being polled again
+        self.assertEqual(process_lane_events(), 1)
+        self.assertEqual(storage.count(LaneEvent), 0)
+        self.assertEqual(storage.count(Consignment, status=ConsignmentStatus.DISPATCHED), 5)
+
+    def test_available_truck_wakes_its_branch(self):
+        """Test a truck becoming available queues the branch's lanes that reached the threshold."""
+        self.truck.status = TruckStatus.IN_TRANSIT
+        storage.save()
+        truck_id = self.truck.id
+        self.post_consignment(300.0)
+        self.post_consignment(300.0)
+        self.post_consignment(10.0, destination="Small Destination")
+        self.assertEqual(process_lane_events(), 2)
+        self.assertEqual(storage.count(LaneEvent), 0)
+
+        response = self.client.put(f'/api/v1/trucks/{truck_id}', data=json.dumps({"status": "available"}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([event.destination_address for event in storage.all(LaneEvent).values()],
+                         ["Dispatch Destination"])
+        self.assertEqual(process_lane_events(), 1)
+        self.assertEqual(storage.get(Truck, truck_id).status, TruckStatus.IN_TRANSIT)
+
+    def test_lost_race_is_logged_and_requeued(self):
+        """Test a claim that loses the version check is logged and its lane queued again."""
+        self.post_consignment(300.0)
+        self.post_consignment(200.0)
+        save, calls = storage.save, []
+
+        def racing_save():
+            calls.append(1)
+            if len(calls) == 2:  # the claim, after the events were taken
+                raise StaleDataError("changed concurrently")
+            save()
+
+        with patch.object(storage, 'save', side_effect=racing_save), \
+                self.assertLogs('models.dispatcher', 'INFO') as logs:
+            self.assertEqual(process_lane_events(), 1)
+        self.assertIn("lost the race", logs.output[0])
+        self.assertEqual(storage.count(LaneEvent), 1)
+        self.assertEqual(storage.count(Consignment, status=ConsignmentStatus.DISPATCHED), 0)
+
+    def test_lane_events_keep_their_place(self):
+        """Test a lane changed again while queued is not moved behind later lanes."""
+        start = datetime(2026, 1, 1)
+        with patch('models.lanes.datetime') as clock:
+            for minute, destination in enumerate(["First", "Second", "First"]):
+                clock.utcnow.return_value = start + timedelta(minutes=minute)
+                enqueue_lane_events(storage.connection(), [(self.branch.id, destination)])
+                storage.save()
+        with patch('models.dispatcher.check_and_dispatch_truck') as check:
+            self.assertEqual(process_lane_events(limit=1), 1)
+        check.assert_called_once_with(self.branch.id, "First")
+
+    def test_failed_lane_is_logged_and_requeued(self):
+        """Test a failing evaluation is logged with its traceback and queued again."""
+        enqueue_lane_events(storage.connection(), [(self.branch.id, "Broken")])
+        storage.save()
+        with patch('models.dispatcher.check_and_dispatch_truck', side_effect=RuntimeError("boom")), \
+                self.assertLogs('models.dispatcher', 'ERROR') as logs:
+            self.assertEqual(process_lane_events(), 1)
+        self.assertIn("Traceback", logs.output[0])
+        self.assertEqual(storage.count(LaneEvent, destination_address="Broken"), 1)
+
+    def test_concurrent_dispatch_stress(self):
+        """Test concurrent dispatchers never double-book trucks or consignments."""
+        trucks = [Truck(truck_number=f"STRESS-{i}", capacity_cubic_meters=100.0,
+                        current_branch_id=self.branch.id) for i in range(10)]
+        for truck in trucks:
+            storage.new(truck)
+        storage.save()
+        branch_id = self.branch.id
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def worker(n):
+            try:
+                barrier.wait()
+                for i in range(3):
+                    for j in range(10):
+                        storage.new(Consignment(volume_cubic_meters=20.0, destination_address="Stress Destination",
+                                                sender_address="S", receiver_name=f"R{n}-{i}-{j}",
+                                                origin_branch_id=branch_id))
+                    storage.save()
+                    check_and_dispatch_truck(branch_id, "Stress Destination")
+                    storage.close()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                storage.close()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        storage.close()
+        dispatches = storage.all(Dispatch).values()
+        self.assertGreater(len(dispatches), 0)
+        truck_ids = [d.truck_id for d in dispatches]
+        self.assertEqual(len(truck_ids), len(set(truck_ids)))
+        for dispatch in dispatches:
+            volume = storage.aggregate(Consignment, 'sum', 'volume_cubic_meters', dispatch_id=dispatch.id)
+            self.assertIsNotNone(volume)
+            self.assertLessEqual(volume, storage.get(Truck, dispatch.truck_id).capacity_cubic_meters)
+        self.assertEqual(storage.count(Truck, status=TruckStatus.IN_TRANSIT), len(dispatches))
+        self.assertEqual(storage.count(Consignment, status=ConsignmentStatus.DISPATCHED),
+                         storage.count(Consignment, dispatch_id__ne=None))
+
+
+if __name__ == '__main__':
+    unittest.main()
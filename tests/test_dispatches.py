@@ -1,5 +1,6 @@
 # tests/test_dispatches.py
 import json
+from datetime import datetime
 from tests.base import BaseTestCase
 from models.tables import Dispatch, Truck
 from models import storage
@@ -37,6 +38,24 @@ class TestDispatches(BaseTestCase):
         data = json.loads(response.data)
         self.assertEqual(data['destination_address'], '456 Test Ave')
 
+    def test_conditional_get(self):
+        """Test the dispatches ETag changes with every new dispatch, even one created the same instant."""
+        created_at = datetime(2026, 5, 1, 12, 0, 0)
+        dispatch = Dispatch(truck_id=self.truck.id, destination_address="Polled St")
+        dispatch.created_at = created_at
+        storage.new(dispatch)
+        storage.save()
+        etag = self.client.get('/api/v1/dispatches/').headers['ETag']
+        response = self.client.get('/api/v1/dispatches/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        dispatch = Dispatch(truck_id=self.truck.id, destination_address="Polled St")
+        dispatch.created_at = created_at
+        storage.new(dispatch)
+        storage.save()
+        response = self.client.get('/api/v1/dispatches/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 2)
+
     def test_get_non_existent_dispatch(self):
         """Test getting a dispatch that does not exist."""
         response = self.client.get('/api/v1/dispatches/non-existent-id')
@@ -1,5 +1,6 @@
 # tests/test_invoices.py
 import json
+from unittest import mock
 from tests.base import BaseTestCase
 from models.tables import Invoice, Consignment, Branch
 from models import storage
@@ -35,6 +36,31 @@ class TestInvoices(BaseTestCase):
         self.assertIsInstance(data, list)
         self.assertGreater(len(data), 0)
 
+    def test_export_invoices(self):
+        """Test streaming every invoice as NDJSON and as a JSON array."""
+        storage.new(Invoice(consignment_id=self.consignment.id, amount=10.0))
+        for amount in (20.0, 30.0):
+            consignment = Consignment(volume_cubic_meters=1.0, destination_address="Export St",
+                                      sender_address="S", receiver_name="R",
+                                      origin_branch_id=self.consignment.origin_branch_id)
+            storage.new(consignment)
+            storage.new(Invoice(consignment_id=consignment.id, amount=amount))
+        storage.save()
+
+        with mock.patch('api.v1.views.pagination.EXPORT_BATCH_SIZE', 2):
+            response = self.client.get('/api/v1/invoices/?export=ndjson')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            self.assertEqual(sorted(row['amount'] for row in rows), [10.0, 20.0, 30.0])
+
+            response = self.client.get('/api/v1/invoices/?export=json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(json.loads(response.data)), 3)
+
+        response = self.client.get('/api/v1/invoices/?export=xml')
+        self.assertEqual(response.status_code, 400)
+
     def test_get_invoice(self):
         """Test getting a single invoice."""
         invoice = Invoice(consignment_id=self.consignment.id, amount=200.0)
@@ -0,0 +1,105 @@
+# tests/test_migrations.py
+import os
+import tempfile
+import unittest
+from sqlalchemy import create_engine, inspect
+from models.base_model import Base
+from models.migrations import check_indexes, current_version, migrations, upgrade
+
+class TestMigrations(unittest.TestCase):
+    """Tests for the schema migrations and the hot query index check."""
+
+    def setUp(self):
+        """Create an empty SQLite database."""
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.engine = create_engine("sqlite:///" + self.path)
+
+    def tearDown(self):
+        """Remove the database."""
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_declared_schema_covers_hot_queries(self):
+        """Test every hot query has a declared index."""
+        self.assertEqual(check_indexes(), [])
+
+    def test_upgrade_empty_database(self):
+        """Test migrating an empty database builds the whole schema once."""
+        self.assertEqual(current_version(self.engine), 0)
+        self.assertEqual([number for number, _ in upgrade(self.engine)], [number for number, _, _ in migrations])
+        self.assertEqual(current_version(self.engine), migrations[-1][0])
+        self.assertEqual(set(inspect(self.engine).get_table_names()), set(Base.metadata.tables))
+        self.assertEqual(check_indexes(self.engine), [])
+        self.assertEqual(upgrade(self.engine), [])
+
+    def test_upgrade_legacy_database(self):
+        """Test migrating a database built before the columns and indexes existed."""
+        Base.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            for index in ("ix_consignments_dispatched_at", "ix_consignments_lane_dispatched_at",
+                          "ix_consignments_lane_wait",
+                          "ix_consignments_lane_status", "ix_consignments_dispatch_id",
+                          "ix_dispatches_truck_id_created_at", "ix_trucks_branch_status",
+                          "ix_consignments_created_at_id", "ix_trucks_created_at_id"):
+                connection.exec_driver_sql(f"DROP INDEX {index}")
+            for column in ("dispatched_at", "delivered_at", "wait_seconds", "version_id"):
+                connection.exec_driver_sql(f"ALTER TABLE consignments DROP COLUMN {column}")
+            for column in ("status_since", "available_seconds", "in_transit_seconds", "idle_seconds", "version_id"):
+                connection.exec_driver_sql(f"ALTER TABLE trucks DROP COLUMN {column}")
+            connection.exec_driver_sql("INSERT INTO branches (id, name, is_hq) VALUES ('b1', 'B1', 0)")
+            connection.exec_driver_sql("INSERT INTO trucks (id, truck_number, capacity_cubic_meters, status, "
+                                       "updated_at) VALUES ('t1', 'T1', 100.0, 'AVAILABLE', '2024-01-01 06:00:00')")
+            connection.exec_driver_sql("INSERT INTO dispatches (id, truck_id, destination_address, created_at) "
+                                       "VALUES ('d1', 't1', 'Far', '2024-01-01 10:00:00')")
+            for id, volume, status, dispatch in (("c1", 40.0, "DISPATCHED", "'d1'"), ("c2", 5.0, "AWAITING_DISPATCH", "NULL"),
+                                                 ("c3", 7.0, "AWAITING_DISPATCH", "NULL")):
+                connection.exec_driver_sql(
+                    "INSERT INTO consignments (id, volume_cubic_meters, destination_address, sender_address, "
+                    "receiver_name, status, origin_branch_id, dispatch_id, created_at) VALUES "
+                    f"('{id}', {volume}, 'Far', 'S', 'R', '{status}', 'b1', {dispatch}, '2024-01-01 08:00:00')")
+                connection.exec_driver_sql(f"INSERT INTO invoices (id, consignment_id, amount) VALUES "
+                                           f"('i{id}', '{id}', {volume * 100})")
+        self.assertEqual([(query.table, query.columns) for query in check_indexes(self.engine)], [
+            ("consignments", ("origin_branch_id", "destination_address", "status")),
+            ("consignments", ("dispatch_id",)),
+            ("dispatches", ("truck_id", "created_at")),
+            ("trucks", ("current_branch_id", "status")),
+            ("consignments", ("origin_branch_id", "destination_address", "wait_seconds")),
+            ("consignments", ("dispatched_at", "wait_seconds")),
+            ("trucks", ("created_at", "id")),
+            ("consignments", ("created_at", "id")),
+        ])
+
+        upgrade(self.engine)
+        columns = {column["name"] for column in inspect(self.engine).get_columns("consignments")}
+        self.assertTrue({"dispatched_at", "delivered_at", "wait_seconds", "version_id"} <= columns)
+        columns = {column["name"] for column in inspect(self.engine).get_columns("trucks")}
+        self.assertTrue({"status_since", "available_seconds", "in_transit_seconds", "idle_seconds",
+                         "version_id"} <= columns)
+        self.assertEqual(check_indexes(self.engine), [])
+        with self.engine.connect() as connection:
+            sql = lambda query: connection.exec_driver_sql(query).all()
+            self.assertEqual(sql("SELECT idle_seconds, version_id, status_since FROM trucks"),
+                             [(0.0, 1, '2024-01-01 06:00:00.000000')])
+            self.assertEqual(sql("SELECT DISTINCT version_id FROM consignments"), [(1,)])
+            self.assertEqual(sql("SELECT id, dispatched_at, wait_seconds FROM consignments "
+                                 "WHERE dispatched_at IS NOT NULL"),
+                             [("c1", '2024-01-01 10:00:00.000000', 7200.0)])
+            self.assertEqual(sql("SELECT truck_id, status, changed_at FROM truck_status_events"),
+                             [("t1", "AVAILABLE", '2024-01-01 06:00:00.000000')])
+            self.assertEqual(sql("SELECT origin_branch_id, destination_address, pending_volume, pending_count "
+                                 "FROM lane_backlogs"), [("b1", "Far", 12.0, 2)])
+            self.assertEqual(sql("SELECT origin_branch_id, destination_address FROM lane_events"), [("b1", "Far")])
+            self.assertEqual(sql("SELECT day, consignment_count, total_volume, total_revenue FROM destination_stats"),
+                             [('2024-01-01', 3, 52.0, 5200.0)])
+            self.assertEqual(sql("SELECT truck_id, day, dispatch_count, volume_carried, capacity_offered "
+                                 "FROM truck_usages"), [("t1", '2024-01-01', 1, 40.0, 100.0)])
+
+    def test_upgrade_to_target(self):
+        """Test migrating stops at the requested version."""
+        self.assertEqual(upgrade(self.engine, target=1), [migrations[0][:2]])
+        self.assertEqual(current_version(self.engine), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# tests/test_planner.py
+import unittest
+from collections import namedtuple
+from models.planner import plan_dispatch
+
+Item = namedtuple("Item", ["id", "volume_cubic_meters"])
+Truck = namedtuple("Truck", ["id", "capacity_cubic_meters"])
+
+class TestPlanner(unittest.TestCase):
+    """Tests for the dispatch planner."""
+
+    def test_respects_capacity(self):
+        """Test no load exceeds its truck's capacity."""
+        items = [Item(i, v) for i, v in enumerate([300, 250, 200, 150, 100])]
+        trucks = [Truck("small", 400), Truck("large", 600)]
+        loads, unassigned = plan_dispatch(items, trucks)
+        self.assertEqual(len(loads), 2)
+        for load in loads:
+            self.assertLessEqual(load.volume, load.truck.capacity_cubic_meters)
+            self.assertEqual(load.volume, sum(c.volume_cubic_meters for c in load.consignments))
+        self.assertEqual(sum(load.volume for load in loads) + sum(c.volume_cubic_meters for c in unassigned), 1000)
+
+    def test_oversized_consignment_left_waiting(self):
+        """Test a consignment larger than every truck is not assigned."""
+        loads, unassigned = plan_dispatch([Item(1, 700), Item(2, 100)], [Truck("t", 500)])
+        self.assertEqual([c.id for c in unassigned], [1])
+        self.assertEqual([c.id for c in loads[0].consignments], [2])
+
+    def test_prefers_smallest_fitting_truck(self):
+        """Test a small load is moved off a large truck."""
+        loads, _ = plan_dispatch([Item(1, 80)], [Truck("large", 1000), Truck("small", 100)])
+        self.assertEqual(loads[0].truck.id, "small")
+
+    def test_minimum_load(self):
+        """Test near-empty loads are released back to the lane."""
+        items = [Item(1, 500), Item(2, 20)]
+        trucks = [Truck("a", 500), Truck("b", 500)]
+        loads, unassigned = plan_dispatch(items, trucks, threshold=500, min_fill=0.5)
+        self.assertEqual([load.volume for load in loads], [500])
+        self.assertEqual([c.id for c in unassigned], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
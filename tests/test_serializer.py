@@ -0,0 +1,53 @@
+# tests/test_serializer.py
+import unittest
+from datetime import datetime
+from tests.base import BaseTestCase
+from models.base_model import time
+from models.serializer import dumps, internal, serializer_for
+from models.tables import Branch, Truck, TruckStatus, User
+from models import storage
+
+class TestSerializer(BaseTestCase):
+    """Tests for the precompiled model serializers."""
+
+    def setUp(self):
+        """Set up test data."""
+        super().setUp()
+        self.branch = Branch(name="Test Branch")
+        self.truck = Truck(truck_number="TRUCK-001", status=TruckStatus.IDLE, current_branch_id=self.branch.id)
+        storage.new(self.branch)
+        storage.new(self.truck)
+        storage.save()
+
+    def test_to_dict(self):
+        """Test instances serialize with encoded datetimes and enums."""
+        data = self.truck.to_dict()
+        self.assertEqual(data['__class__'], 'Truck')
+        self.assertEqual(data['status'], 'IDLE')
+        self.assertEqual(data['truck_number'], 'TRUCK-001')
+        self.assertEqual(data['created_at'], self.truck.created_at.strftime(time))
+        self.assertEqual(list(data), [c.key for c in Truck.__table__.columns
+                                      if c.key not in internal] + ['__class__'])
+        self.assertNotIn('version_id', data)
+        self.assertNotIn('idle_seconds', data)
+
+    def test_rows_match_instances(self):
+        """Test result rows serialize exactly like loaded instances."""
+        storage.close()
+        truck = storage.get(Truck, self.truck.id)
+        [row] = storage.page(Truck, 10, rows=True)
+        self.assertEqual(serializer_for(Truck).row_to_dict(row), truck.to_dict())
+
+    def test_sensitive_columns(self):
+        """Test password hashes are only included on request."""
+        user = User(username="someone", password_hash="secret", branch_id=self.branch.id)
+        self.assertNotIn('password_hash', user.to_dict())
+        self.assertEqual(user.to_dict(save_fs=True)['password_hash'], "secret")
+
+    def test_dumps(self):
+        """Test encoded dicts dump to JSON bytes."""
+        self.assertEqual(dumps([{"a": 1}]), b'[{"a":1}]')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+# tests/test_storage.py
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from sqlalchemy import event
+from tests.base import BaseTestCase
+from models.engine.db import DBStorage
+from models.tables import Branch, Truck, TruckStatus, Consignment, Invoice
+from models import storage
+
+class TestStorage(BaseTestCase):
+    """Tests for the DBStorage engine."""
+
+    def setUp(self):
+        """Set up test data."""
+        super().setUp()
+        self.branch = Branch(name="Test Branch")
+        self.trucks = [Truck(truck_number=f"TRUCK-{i}", current_branch_id=self.branch.id) for i in range(3)]
+        storage.new(self.branch)
+        for truck in self.trucks:
+            storage.new(truck)
+        storage.save()
+
+    def test_get(self):
+        """Test fetching a single object by primary key."""
+        self.assertIs(storage.get(Branch, self.branch.id), self.branch)
+        storage.close()
+        branch = storage.get(Branch, self.branch.id)
+        self.assertEqual(branch.name, "Test Branch")
+
+    def test_get_missing(self):
+        """Test fetching objects that do not exist."""
+        self.assertIsNone(storage.get(Branch, "non-existent-id"))
+        self.assertIsNone(storage.get(Branch, None))
+        self.assertIsNone(storage.get(str, self.branch.id))
+
+    def test_get_many(self):
+        """Test fetching several objects by primary key at once."""
+        storage.close()
+        ids = [truck.id for truck in self.trucks] + ["non-existent-id"]
+        trucks = storage.get_many(Truck, ids)
+        self.assertEqual(set(trucks), {truck.id for truck in self.trucks})
+        self.assertEqual(trucks[self.trucks[0].id].truck_number, "TRUCK-0")
+
+    def test_filter_first_exists(self):
+        """Test filtering objects with SQL criteria."""
+        self.trucks[0].status = TruckStatus.IN_TRANSIT
+        storage.save()
+        available = storage.filter(Truck, status=TruckStatus.AVAILABLE, order_by='truck_number')
+        self.assertEqual([t.truck_number for t in available], ["TRUCK-1", "TRUCK-2"])
+        self.assertEqual(len(storage.filter(Truck, truck_number__in=["TRUCK-0", "TRUCK-2"])), 2)
+        self.assertEqual(storage.first(Truck, status=TruckStatus.IN_TRANSIT).truck_number, "TRUCK-0")
+        self.assertTrue(storage.exists(Truck, truck_number="TRUCK-1"))
+        self.assertFalse(storage.exists(Truck, truck_number="TRUCK-9"))
+        with self.assertRaises(AttributeError):
+            storage.filter(Truck, no_such_column=1)
+
+    def test_aggregate(self):
+        """Test SUM/COUNT aggregates with and without grouping."""
+        for volume, destination in [(10.0, "A"), (20.0, "A"), (5.0, "B")]:
+            consignment = Consignment(volume_cubic_meters=volume, destination_address=destination,
+                                      sender_address="S", receiver_name="R",
+                                      origin_branch_id=self.branch.id)
+            storage.new(consignment)
+            storage.new(Invoice(consignment_id=consignment.id, amount=volume * 100))
+        storage.save()
+        self.assertEqual(storage.aggregate(Consignment, 'count', destination_address="A"), 2)
+        self.assertEqual(storage.aggregate(Consignment, 'sum', 'volume_cubic_meters'), 35.0)
+        self.assertEqual(storage.aggregate(Consignment, 'sum', 'volume_cubic_meters', group_by='destination_address'),
+                         {"A": 30.0, "B": 5.0})
+        self.assertEqual(storage.aggregate(Invoice, 'sum', 'amount', consignment__destination_address="A"), 3000.0)
+        self.assertEqual(storage.aggregate(Consignment, 'sum', ['volume_cubic_meters', 'volume_cubic_meters'],
+                                           destination_address="B"), (5.0, 5.0))
+        self.assertEqual(storage.aggregate(Consignment, 'max', ['volume_cubic_meters', 'receiver_name'],
+                                           group_by='destination_address'),
+                         {"A": (20.0, "R"), "B": (5.0, "R")})
+
+    def test_percentiles(self):
+        """Test each percentile is one row read from the nearer end."""
+        for volume in [4.0, 1.0, 3.0, 2.0]:
+            storage.new(Consignment(volume_cubic_meters=volume, destination_address="P",
+                                    sender_address="S", receiver_name="R",
+                                    origin_branch_id=self.branch.id))
+        storage.save()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(storage.engine(), "before_cursor_execute", listener)
+        try:
+            values = storage.percentiles(Consignment, 'volume_cubic_meters', (0.5, 0.75, 0.99),
+                                         destination_address="P")
+        finally:
+            event.remove(storage.engine(), "before_cursor_execute", listener)
+        self.assertEqual(values, [2.0, 3.0, 4.0])
+        self.assertEqual(len(statements), 4)  # the count, then one row per rank
+        self.assertTrue(all("LIMIT" in statement and "OFFSET" in statement for statement in statements[1:]))
+        self.assertIn("DESC", statements[3])  # the 99th is read from the top
+        self.assertEqual(storage.percentiles(Consignment, 'volume_cubic_meters', (0.5,),
+                                             destination_address="none"), [None])
+
+    def test_count(self):
+        """Test counting objects with and without criteria."""
+        self.trucks[0].status = TruckStatus.IN_TRANSIT
+        storage.save()
+        self.assertEqual(storage.count(Truck), 3)
+        self.assertEqual(storage.count("Truck"), 3)
+        self.assertEqual(storage.count(Truck, status=TruckStatus.AVAILABLE), 2)
+        self.assertEqual(storage.count(Truck, approximate=True), 3)
+        self.assertEqual(storage.count(), 4)
+        # 3 created and 1 change; bookkeeping tables are counted by name only
+        self.assertEqual(storage.count("TruckStatusEvent"), 4)
+
+    def test_unit_of_work_commits_once(self):
+        """Test writes in a unit of work commit together."""
+        with storage.unit_of_work():
+            branch = Branch(name="Unit Branch")
+            branch.save()
+            storage.new(Truck(truck_number="UNIT-1", current_branch_id=branch.id))
+            storage.save()
+        storage.close()
+        self.assertIsNotNone(storage.get(Branch, branch.id))
+        self.assertTrue(storage.exists(Truck, truck_number="UNIT-1"))
+
+    def test_unit_of_work_rolls_back(self):
+        """Test a failing unit of work leaves nothing behind."""
+        with self.assertRaises(RuntimeError):
+            with storage.unit_of_work():
+                branch = Branch(name="Rolled Back Branch")
+                branch.save()
+                with storage.unit_of_work():
+                    storage.new(Truck(truck_number="UNIT-2", current_branch_id=branch.id))
+                raise RuntimeError("boom")
+        storage.close()
+        self.assertFalse(storage.exists(Branch, name="Rolled Back Branch"))
+        self.assertFalse(storage.exists(Truck, truck_number="UNIT-2"))
+
+
+class TestStorageSetup(unittest.TestCase):
+    """Tests for configuring and initializing a DBStorage."""
+
+    def setUp(self):
+        """Point a storage at an empty SQLite file."""
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.url = "sqlite:///" + self.path
+
+    def tearDown(self):
+        """Remove the database."""
+        os.remove(self.path)
+
+    def test_configured_from_environment(self):
+        """Test the URL and env come from the environment."""
+        with patch.dict(os.environ, {"TCC_DATABASE_URL": self.url, "TCC_ENV": "staging"}):
+            db = DBStorage()
+        self.assertEqual((db.url, db.env), (self.url, "staging"))
+
+    def test_lazy_engine(self):
+        """Test nothing connects or runs DDL until first use."""
+        db = DBStorage(self.url)
+        self.assertIsNone(db._DBStorage__engine)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        db.create_schema()
+        self.assertEqual(db.count(Branch), 0)
+        db.close()
+        db.drop_schema()
+
+    def test_pool_configured_from_environment(self):
+        """Test pool settings come from the arguments, then the environment."""
+        with patch.dict(os.environ, {"TCC_DB_POOL_SIZE": "3", "TCC_DB_POOL_PRE_PING": "no"}):
+            db = DBStorage(self.url, max_overflow=2)
+        self.assertEqual(db.pool_options, {"pool_size": 3, "max_overflow": 2,
+                                           "pool_pre_ping": False, "pool_recycle": 1800})
+        pool = db.engine().pool
+        self.assertEqual((pool.size(), pool._max_overflow, pool._pre_ping), (3, 2, False))
+        with self.assertRaises(TypeError):
+            DBStorage(self.url, pool_sise=3)
+
+    def test_pool_stats(self):
+        """Test checkouts, connections in use, overflow and timeouts are reported."""
+        db = DBStorage(self.url, pool_size=1, max_overflow=1, pool_timeout=0.05)
+        engine = db.engine()
+        first, second = engine.connect(), engine.connect()
+        stats = db.pool_stats()
+        self.assertEqual((stats["checkouts"], stats["in_use"], stats["overflow"], stats["peak_in_use"]),
+                         (2, 2, 1, 2))
+        with self.assertRaises(Exception):
+            engine.connect()
+        self.assertEqual(db.pool_stats()["timeouts"], 1)
+        self.assertGreaterEqual(db.pool_stats()["max_wait_seconds"], 0.05)
+        first.close()
+        second.close()
+        stats = db.pool_stats()
+        self.assertEqual((stats["checkins"], stats["in_use"]), (2, 0))
+        db.reset_pool_stats()
+        self.assertEqual(db.pool_stats()["checkouts"], 0)
+        engine.dispose()
+
+    def test_schema_check(self):
+        """Test an unmigrated database is reported, and refused in production."""
+        with self.assertLogs('models.engine.db', level='WARNING') as log:
+            DBStorage(self.url).check_schema()
+        self.assertIn("run python manage.py migrate", log.output[0])
+        with self.assertRaises(RuntimeError):
+            DBStorage(self.url, env="production").check_schema()
+        with self.assertRaises(RuntimeError):
+            DBStorage(self.url, env="production").drop_schema()
+
+
+class TestReadReplicas(unittest.TestCase):
+    """Tests for routing reads to a replica, on two SQLite files."""
+
+    def setUp(self):
+        """Create a primary and a replica that does not replicate."""
+        self.paths = []
+        for _ in range(2):
+            fd, path = tempfile.mkstemp(suffix=".db")
+            os.close(fd)
+            self.paths.append(path)
+        primary, replica = ["sqlite:///" + path for path in self.paths]
+        self.replica = DBStorage(replica)
+        self.replica.create_schema()
+        self.replica.new(Branch(name="Replica Branch"))
+        self.replica.save()
+        self.db = DBStorage(primary, replica_urls=[replica])
+        self.db.create_schema()
+        self.db.new(Branch(name="Primary Branch"))
+        self.db.save()
+        self.db.close()
+
+    def tearDown(self):
+        """Remove both databases."""
+        self.db.close()
+        self.replica.close()
+        for path in self.paths:
+            os.remove(path)
+
+    def names(self):
+        """Return the names of the branches reads are routed to."""
+        return [branch.name for branch in self.db.all(Branch).values()]
+
+    def test_reads_primary_by_default(self):
+        """Test reads outside a replica block go to the primary."""
+        self.assertEqual(self.names(), ["Primary Branch"])
+        with self.db.replica():
+            self.assertEqual(self.names(), ["Replica Branch"])
+            self.assertEqual(self.db.count(Branch, name="Replica Branch"), 1)
+            with self.db.primary():
+                self.assertEqual(self.names(), ["Primary Branch"])
+        self.assertEqual(self.names(), ["Primary Branch"])
+
+    def test_writes_pin_reads_to_primary(self):
+        """Test a thread reads its own writes until its session closes."""
+        self.db.route_reads()
+        self.assertEqual(self.names(), ["Replica Branch"])
+        self.db.new(Branch(name="New Branch"))
+        self.db.save()
+        self.assertIn("New Branch", self.names())
+        self.db.close()
+        self.assertEqual(self.names(), ["Primary Branch", "New Branch"])
+        with self.db.replica():
+            self.assertEqual(self.names(), ["Replica Branch"])
+
+    def test_locking_reads_use_primary(self):
+        """Test reads for update and inside a unit of work stay on the primary."""
+        with self.db.replica():
+            self.assertEqual(self.db.first(Branch, for_update=True).name, "Primary Branch")
+            with self.db.unit_of_work():
+                self.assertEqual(self.db.first(Branch).name, "Primary Branch")
+
+    def test_replica_pool_stats(self):
+        """Test each replica reports its own pool."""
+        self.db.reset_pool_stats()
+        with self.db.replica():
+            self.names()
+        self.assertEqual(self.db.pool_stats(0)["checkouts"], 1)
+        self.assertEqual(self.db.pool_stats()["checkouts"], 0)
+
+    def test_replicas_from_environment(self):
+        """Test replica URLs come from the environment."""
+        with patch.dict(os.environ, {"TCC_DATABASE_REPLICA_URLS": "sqlite:///a.db, sqlite:///b.db"}):
+            db = DBStorage(self.db.url)
+        self.assertEqual(db.replica_urls, ["sqlite:///a.db", "sqlite:///b.db"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,11 @@
 # tests/test_trucks.py
 import json
+from datetime import datetime, timedelta
+from unittest.mock import patch
 from tests.base import BaseTestCase
-from models.tables import Truck
+from models.tables import Branch, Consignment, Dispatch, Truck, TruckStatus, TruckStatusEvent, TruckUsage
+from models.truck_status import prune_status_events, status_seconds
+from models.truck_usage import rebuild_truck_usage
 from models import storage
 
 class TestTrucks(BaseTestCase):
@@ -47,5 +51,136 @@ class TestTrucks(BaseTestCase):
         response = self.client.get('/api/v1/trucks/non-existent-id')
         self.assertEqual(response.status_code, 404)
 
+    def test_conditional_missing_truck(self):
+        """Test a missing truck is a 404 whatever validators the client sends."""
+        truck = Truck(truck_number="TRUCK-012")
+        storage.new(truck)
+        storage.save()
+        response = self.client.get(f'/api/v1/trucks/{truck.id}')
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        self.assertEqual(self.client.get(f'/api/v1/trucks/{truck.id}',
+                                         headers={'If-None-Match': etag}).status_code, 304)
+        for headers in ({'If-None-Match': etag}, {'If-Modified-Since': last_modified}):
+            response = self.client.get('/api/v1/trucks/missing-id', headers=headers)
+            self.assertEqual(response.status_code, 404)
+
+    def test_update_conflict(self):
+        """Test a PUT racing the dispatcher gets 409."""
+        truck = Truck(truck_number="TRUCK-011")
+        storage.new(truck)
+        storage.save()
+        truck_id = truck.id
+        table = Truck.__table__
+        with storage.engine().begin() as connection:
+            connection.execute(table.update().where(table.c.id == truck_id)
+                               .values(version_id=table.c.version_id + 1, status=TruckStatus.IN_TRANSIT.name))
+        response = self.client.put(f'/api/v1/trucks/{truck_id}', data=json.dumps({"status": "idle"}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("error", json.loads(response.data))
+        self.assertEqual(storage.get(Truck, truck_id).status, TruckStatus.IN_TRANSIT)
+
+    def test_conditional_status(self):
+        """Test polling /trucks/status gets 304 until a truck changes."""
+        truck = Truck(truck_number="TRUCK-010")
+        storage.new(truck)
+        storage.save()
+
+        response = self.client.get('/api/v1/trucks/status')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        with patch.object(storage, 'page') as page:
+            response = self.client.get('/api/v1/trucks/status', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+        page.assert_not_called()
+        response = self.client.get('/api/v1/trucks/status', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        truck = storage.get(Truck, truck.id)
+        truck.status = TruckStatus.IN_TRANSIT
+        storage.save()
+        response = self.client.get('/api/v1/trucks/status', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.data)[0]['status'], 'in_transit')
+
+    def test_truck_status_history(self):
+        """Test status changes are logged with running totals per status."""
+        start = datetime(2026, 1, 1)
+        with patch('models.truck_status.datetime') as clock:
+            clock.utcnow.return_value = start
+            truck = Truck(truck_number="TRUCK-004")
+            storage.new(truck)
+            storage.save()
+            for seconds, status in ((100, "in_transit"), (400, "idle"), (1000, "available")):
+                clock.utcnow.return_value = start + timedelta(seconds=seconds)
+                response = self.client.put(f'/api/v1/trucks/{truck.id}', data=json.dumps({"status": status}),
+                                           content_type='application/json')
+                self.assertEqual(response.status_code, 200)
+
+        truck = storage.get(Truck, truck.id)
+        self.assertEqual((truck.available_seconds, truck.in_transit_seconds, truck.idle_seconds),
+                         (100.0, 300.0, 600.0))
+        self.assertEqual(storage.count(TruckStatusEvent, truck_id=truck.id), 4)
+
+        trucks, seconds = status_seconds(storage, start + timedelta(seconds=50), start + timedelta(seconds=700))
+        self.assertEqual(trucks, 1)
+        self.assertEqual((seconds[TruckStatus.AVAILABLE], seconds[TruckStatus.IN_TRANSIT],
+                          seconds[TruckStatus.IDLE]), (50.0, 300.0, 300.0))
+        response = self.client.get('/api/v1/trucks/average_idle_time?since=2026-01-01T00:00:50Z&until=2026-01-01T00:11:40')
+        data = json.loads(response.data)
+        self.assertEqual(data['average_idle_time_seconds'], 300.0)
+        self.assertEqual(data['fleet_status_seconds']['in_transit'], 300.0)
+
+        # Pruning keeps the last event before the cutoff, so later windows stay exact
+        self.assertEqual(prune_status_events(storage, start + timedelta(seconds=500)), 2)
+        _, seconds = status_seconds(storage, start + timedelta(seconds=450), start + timedelta(seconds=700))
+        self.assertEqual(seconds[TruckStatus.IDLE], 250.0)
+
+    def test_truck_usage_rollup(self):
+        """Test dispatches roll up into per-day usage read in buckets."""
+        branch = Branch(name="Usage Branch")
+        other = Branch(name="Other Usage Branch")
+        truck = Truck(truck_number="TRUCK-005", capacity_cubic_meters=100.0, current_branch_id=branch.id)
+        storage.new(branch)
+        storage.new(other)
+        storage.new(truck)
+        storage.new(Truck(truck_number="TRUCK-006", capacity_cubic_meters=100.0, current_branch_id=other.id))
+        storage.save()
+        for day, volumes in ((datetime(2026, 3, 2), (30.0, 20.0)), (datetime(2026, 3, 4), (80.0,))):
+            dispatch = Dispatch(truck_id=truck.id, destination_address="Usage Destination")
+            dispatch.created_at = day
+            storage.new(dispatch)
+            for volume in volumes:
+                storage.new(Consignment(volume_cubic_meters=volume, destination_address="Usage Destination",
+                                        sender_address="S", receiver_name="R", origin_branch_id=branch.id,
+                                        dispatch=dispatch))
+            storage.save()
+        self.assertEqual(storage.count(TruckUsage, truck_id=truck.id), 2)
+
+        url = '/api/v1/trucks/usage?since=2026-03-01&until=2026-03-31&branch_id=' + branch.id
+        data = json.loads(self.client.get(url).data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual((data[0]['truck_number'], data[0]['dispatch_count'], data[0]['volume_carried'],
+                          data[0]['utilization']), ("TRUCK-005", 2, 130.0, 0.65))
+        self.assertEqual([(b['start'], b['dispatch_count'], b['utilization']) for b in data[0]['buckets']],
+                         [("2026-03-02", 1, 0.5), ("2026-03-04", 1, 0.8)])
+        data = json.loads(self.client.get(url + '&bucket=week').data)
+        self.assertEqual([(b['start'], b['volume_carried']) for b in data[0]['buckets']], [("2026-03-02", 130.0)])
+        # Trucks not dispatched in the period are listed with zero usage
+        data = json.loads(self.client.get('/api/v1/trucks/usage?since=2026-03-03&until=2026-03-03').data)
+        self.assertEqual(sorted((t['truck_number'], t['dispatch_count'], t['utilization'], t['buckets'])
+                                for t in data), [("TRUCK-005", 0, 0.0, []), ("TRUCK-006", 0, 0.0, [])])
+        self.assertEqual(self.client.get(url + '&bucket=year').status_code, 400)
+        self.assertEqual(rebuild_truck_usage(storage, repair=False), [])
+
+    def test_average_idle_time_invalid_window(self):
+        """Test an unparseable window is rejected."""
+        response = self.client.get('/api/v1/trucks/average_idle_time?since=last-week')
+        self.assertEqual(response.status_code, 400)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,15 @@
 # tests/test_users.py
 import json
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from flask_jwt_extended import create_access_token
 from tests.base import BaseTestCase
-from models.tables import User, Branch
+from api.v1.app import app
+from api.v1.views.auth import PRINCIPAL_CACHE_TTL, Principal, PrincipalCache, principals, trusts
+from models.passwords import PasswordHasher, PasswordQueueFull, passwords
+from models.tables import User, UserRole, Branch
 from models import storage
 from werkzeug.security import generate_password_hash
 
@@ -86,6 +94,178 @@ class TestUsers(BaseTestCase):
         response = self.client.post('/api/v1/users/login', data=json.dumps(login_data), content_type='application/json')
         self.assertEqual(response.status_code, 401)
 
+    def test_login_busy(self):
+        """Test a login the password pool cannot take is turned away."""
+        user = User(username="busyuser", password_hash=generate_password_hash("password"), branch_id=self.branch.id)
+        storage.new(user)
+        storage.save()
+        login_data = {"username": "busyuser", "password": "password"}
+        with patch.object(passwords, 'verify', side_effect=PasswordQueueFull):
+            response = self.client.post('/api/v1/users/login', data=json.dumps(login_data), content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+
+class TestPasswordHasher(unittest.TestCase):
+    """Tests for the PasswordHasher."""
+
+    def test_hash_and_verify(self):
+        """Test hashes use the configured work factor, in a thread or a process."""
+        for workers in (0, 1):
+            hasher = PasswordHasher(workers=workers, method="pbkdf2:sha256:1000")
+            password_hash = hasher.hash("secret")
+            self.assertTrue(password_hash.startswith("pbkdf2:sha256:1000$"))
+            self.assertTrue(hasher.verify(password_hash, "secret"))
+            self.assertFalse(hasher.verify(password_hash, "wrong"))
+            self.assertTrue(hasher.verify(generate_password_hash("old"), "old"))
+            hasher.shutdown()
+
+    def test_bounded_queue(self):
+        """Test jobs beyond the workers and queue are refused."""
+        hasher = PasswordHasher(workers=0, queue_size=1)
+        slots = hasher._PasswordHasher__slots
+        slots.acquire()
+        slots.acquire()
+        with self.assertRaises(PasswordQueueFull):
+            hasher.hash("secret")
+        slots.release()
+        self.assertTrue(hasher.hash("secret"))
+
+    def test_inline_queue(self):
+        """Test hashing without workers still admits a queue's worth of jobs."""
+        with patch.dict('os.environ', {}, clear=False) as environ:
+            environ.pop('TCC_PASSWORD_QUEUE', None)
+            hasher = PasswordHasher(workers=0)
+        self.assertEqual(hasher.queue_size, 4)
+        slots = hasher._PasswordHasher__slots
+        for _ in range(4):
+            slots.acquire()
+        self.assertTrue(hasher.hash("secret"))
+
+    def test_broken_pool_is_replaced(self):
+        """Test a job that finds a worker process dead is retried on a new pool."""
+        hasher = PasswordHasher(workers=1, method="pbkdf2:sha256:1000")
+        try:
+            self.assertTrue(hasher.hash("secret"))
+            pool = hasher._PasswordHasher__pool
+            for process in list(pool._processes.values()):
+                process.kill()
+                process.join()
+            self.assertTrue(hasher.verify(hasher.hash("secret"), "secret"))
+            self.assertIsNot(hasher._PasswordHasher__pool, pool)
+        finally:
+            hasher.shutdown()
+
+
+class TestRoleRequired(BaseTestCase):
+    """Tests for authorizing from token claims and the principal cache."""
+
+    def setUp(self):
+        """Create a manager and clear the principal cache."""
+        super().setUp()
+        principals.clear()
+        branch = Branch(name="Test Branch")
+        self.manager = User(username="manager", password_hash="x", role=UserRole.MANAGER,
+                            branch_id=branch.id)
+        self.manager.updated_at = datetime.utcnow() - timedelta(hours=1)
+        self.manager_id = self.manager.id
+        storage.new(branch)
+        storage.new(self.manager)
+        storage.save()
+
+    def token(self, **claims):
+        """Return an access token of the manager with the given claims."""
+        with app.app_context():
+            return create_access_token(identity=self.manager_id, additional_claims=claims)
+
+    def change_manager(self, **values):
+        """Change the manager's row as another worker would, behind this one's cache."""
+        table = User.__table__
+        with storage.engine().begin() as connection:
+            connection.execute(table.update().where(table.c.id == self.manager_id)
+                               .values(updated_at=datetime.utcnow(), **values))
+
+    def expired(self):
+        """Return a patch making every cached principal expire."""
+        return patch('api.v1.views.auth.time.monotonic',
+                     return_value=time.monotonic() + PRINCIPAL_CACHE_TTL + 1)
+
+    def create_truck(self, token, number):
+        """POST a truck, which needs the MANAGER role, and return the status."""
+        response = self.client.post('/api/v1/trucks/', data=json.dumps({"truck_number": number}),
+                                    content_type='application/json',
+                                    headers={"Authorization": "Bearer " + token})
+        return response.status_code
+
+    def test_authorized_from_claims(self):
+        """Test a role claim is trusted while the user is unchanged since the token."""
+        self.assertEqual(self.create_truck(self.token(role="manager"), "T-1"), 201)
+        self.assertEqual(self.create_truck(self.token(role="staff"), "T-2"), 403)
+        self.assertEqual((principals.misses, principals.hits), (1, 1))
+
+    def test_changed_user_is_checked(self):
+        """Test tokens issued before a user changed in any worker fall back to the current role."""
+        token = self.token(role="manager")
+        self.assertEqual(self.create_truck(token, "T-1"), 201)
+        self.change_manager(role=UserRole.STAFF)
+        with self.expired():
+            self.assertEqual(self.create_truck(token, "T-2"), 403)
+        self.assertEqual(self.create_truck(self.token(role="staff"), "T-3"), 403)
+
+    def test_deleted_user_is_refused(self):
+        """Test the tokens of a user deleted by another worker stop vouching for it."""
+        token = self.token(role="manager")
+        table = User.__table__
+        with storage.engine().begin() as connection:
+            connection.execute(table.delete().where(table.c.id == self.manager_id))
+        self.assertEqual(self.create_truck(token, "T-1"), 403)
+
+    def test_tokens_without_role_use_cache(self):
+        """Test a token without a role claim is authorized through the cache."""
+        token = self.token()
+        self.assertEqual(self.create_truck(token, "T-1"), 201)
+        self.assertEqual(self.create_truck(token, "T-2"), 201)
+        self.assertEqual((principals.misses, principals.hits), (1, 1))
+
+
+class TestPrincipalCache(unittest.TestCase):
+    """Tests for the PrincipalCache."""
+
+    def setUp(self):
+        """Create a cache of two principals loaded from a dict."""
+        self.users = {name: Principal(name, "staff", None, 100.0) for name in "abc"}
+        self.cache = PrincipalCache(size=2, ttl=60, load=self.users.get)
+
+    def test_lru_eviction(self):
+        """Test the least recently used principal is evicted."""
+        for name in "abac":
+            self.cache.get(name)
+        self.cache.get("a")
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 3))
+        self.cache.get("b")
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_ttl_and_invalidate(self):
+        """Test principals expire and are dropped when their user changes."""
+        with patch('api.v1.views.auth.time.monotonic', return_value=0):
+            self.cache.get("a")
+        with patch('api.v1.views.auth.time.monotonic', return_value=61):
+            self.cache.get("a")
+        self.assertEqual(self.cache.misses, 2)
+        self.users["a"] = Principal("a", "manager", None, 200.0)
+        with patch('api.v1.views.auth.time.monotonic', return_value=62):
+            self.assertEqual(self.cache.get("a").role, "staff")
+            self.cache.invalidate("a")
+            self.assertEqual(self.cache.get("a").role, "manager")
+
+    def test_trusts(self):
+        """Test only tokens issued after the user's last change are trusted."""
+        principal = self.users["a"]
+        self.assertTrue(trusts(principal, 101))
+        self.assertFalse(trusts(principal, 100))
+        self.assertFalse(trusts(principal, None))
+        self.assertFalse(trusts(None, 101))
+
 
 if __name__ == '__main__':
     unittest.main()